@@ -1,49 +1,72 @@
 # --- agent.py ---
+import os
 import logging
-from google.adk.agents import LlmAgent
-
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-
-def create_review_agent():
-    """Creates the Gitea PR Review Agent configured for Flutter/Dart."""
-    logging.info("Creating Flutter review agent instance...")
-
-    # --- MODIFIED INSTRUCTION ---
-    # Removed the {diff_content} placeholder.
-    # Instruct the agent to find the diff within the user message.
-    review_instruction = """
-    You are an AI code reviewer specialized in analyzing Flutter/Dart code.
-    The user has provided a Git diff below in their message. Your goal is to identify potential issues
-    and suggest improvements based on Flutter and Dart best practices found within that diff.
-
-    Focus on:
-    1.  **Dart Language & Style:** Check for adherence to Effective Dart guidelines (e.g., proper naming conventions, use of `final`/`const`, null safety handling `?` `!`, type annotations). Check for common Dart lint rule violations (like those in `flutter_lints` or `lints`).
-    2.  **Flutter Widget Usage:** Look for correct widget lifecycle management (e.g., `initState`, `dispose`), proper use of `BuildContext`, avoiding unnecessary widget rebuilds (e.g., misuse of `setState`), potential performance issues (e.g., large build methods, lack of `const` constructors where applicable).
-    3.  **State Management:** Analyze the use of state management (e.g., `setState`, Provider, Riverpod, BLoC). Check for potential issues like memory leaks (not disposing controllers/streams), improper state updates, or overly complex state logic discernible from the diff.
-    4.  **Asynchronous Code:** Examine `async`/`await` usage, `Future` and `Stream` handling. Look for unhandled errors in async operations or potential race conditions.
-    5.  **Error Handling:** Check for adequate `try`/`catch` blocks, especially around API calls or potentially failing operations.
-    6.  **Readability & Maintainability:** Suggest improvements for code clarity, widget composition (breaking down large widgets), removing commented-out code, and adding necessary comments for complex logic.
-    7.  **Potential Bugs:** Look for common logical errors, off-by-one errors, issues with list/map manipulation, incorrect conditional logic.
-    8.  **Security:** Check for basic security anti-patterns like hardcoded API keys or sensitive information.
-
-    Analyze the diff provided in the user's message and provide your feedback as a concise, bulleted list of potential issues or suggestions relevant to Flutter/Dart development.
-    If no significant issues are found, state 'No major Flutter/Dart issues identified in this analysis.'
-    Be constructive and specific in your feedback. Start your response with "AI Flutter/Dart Code Review Analysis:".
+
+# --- MODIFIED INSTRUCTION ---
+# Removed the {diff_content} placeholder.
+# Instruct the agent to find the diff within the user message.
+REVIEW_FOCUS = """
+You are an AI code reviewer specialized in analyzing Flutter/Dart code.
+The user has provided a Git diff below in their message. Your goal is to identify potential issues
+and suggest improvements based on Flutter and Dart best practices found within that diff.
+
+Focus on:
+1.  **Dart Language & Style:** Check for adherence to Effective Dart guidelines (e.g., proper naming conventions, use of `final`/`const`, null safety handling `?` `!`, type annotations). Check for common Dart lint rule violations (like those in `flutter_lints` or `lints`).
+2.  **Flutter Widget Usage:** Look for correct widget lifecycle management (e.g., `initState`, `dispose`), proper use of `BuildContext`, avoiding unnecessary widget rebuilds (e.g., misuse of `setState`), potential performance issues (e.g., large build methods, lack of `const` constructors where applicable).
+3.  **State Management:** Analyze the use of state management (e.g., `setState`, Provider, Riverpod, BLoC). Check for potential issues like memory leaks (not disposing controllers/streams), improper state updates, or overly complex state logic discernible from the diff.
+4.  **Asynchronous Code:** Examine `async`/`await` usage, `Future` and `Stream` handling. Look for unhandled errors in async operations or potential race conditions.
+5.  **Error Handling:** Check for adequate `try`/`catch` blocks, especially around API calls or potentially failing operations.
+6.  **Readability & Maintainability:** Suggest improvements for code clarity, widget composition (breaking down large widgets), removing commented-out code, and adding necessary comments for complex logic.
+7.  **Potential Bugs:** Look for common logical errors, off-by-one errors, issues with list/map manipulation, incorrect conditional logic.
+8.  **Security:** Check for basic security anti-patterns like hardcoded API keys or sensitive information.
+
+Analyze the diff provided in the user's message and provide your feedback as a concise, bulleted list of potential issues or suggestions relevant to Flutter/Dart development.
+"""
+
+# How line-level findings are written, so review_comments can place them inline
+LINE_FINDINGS_INSTRUCTION = """In the diff, every added or context line is prefixed with its line number in the new version of the file.
+When a finding is about a specific line, write its bullet exactly as:
+- [severity] path/to/file.dart:LINE: message
+where severity is one of critical, warning or suggestion, and LINE is the new-file line number shown in the diff.
+Write findings that are not about a single line as plain bullets; when one is about a single file, name that file in it.
+"""
+
+REVIEW_INSTRUCTION = REVIEW_FOCUS + LINE_FINDINGS_INSTRUCTION + """If no significant issues are found, state 'No major Flutter/Dart issues identified in this analysis.'
+Be constructive and specific in your feedback. Start your response with "AI Flutter/Dart Code Review Analysis:".
+"""
+# --- END MODIFIED INSTRUCTION ---
+
+# Model used for reviews (REVIEW_MODEL overrides it). Also part of the review cache key,
+# so changing it invalidates cached findings; token limits come from token_budget.MODEL_LIMITS.
+REVIEW_MODEL_NAME = os.environ.get('REVIEW_MODEL', "gemini-2.5-flash-preview-04-17") # Keep using the preview model for now
+
+def profile_instruction(focus: str) -> str:
     """
-    # --- END MODIFIED INSTRUCTION ---
+    Full instruction for a repo profile's own review focus (see repo_profiles):
+    the focus text, then the same line-level finding format and reply shape the
+    default instruction uses, so inline comments and merging keep working.
+    """
+    return focus.strip() + "\n" + LINE_FINDINGS_INSTRUCTION + """If no significant issues are found, state 'No major issues identified in this analysis.'
+Be constructive and specific in your feedback. Start your response with "AI Code Review Analysis:".
+"""
+
+def create_review_agent(model_name: str = REVIEW_MODEL_NAME, instruction: str = REVIEW_INSTRUCTION):
+    """Creates the Gitea PR Review Agent (Flutter/Dart unless a profile supplies its own instruction)."""
+    is_default = instruction == REVIEW_INSTRUCTION
+    logging.info(f"Creating {'Flutter' if is_default else 'profile'} review agent instance...")
+    from google.adk.agents import LlmAgent  # Imported on first use; google.adk is slow to import
 
     try:
-        model_name = "gemini-2.5-flash-preview-04-17" # Keep using the preview model for now
         logging.info(f"Configuring agent with model: {model_name}")
 
         reviewer_agent = LlmAgent(
-            name="FlutterCodeReviewer",
+            name="FlutterCodeReviewer" if is_default else "CodeReviewer",
             model=model_name,
-            instruction=review_instruction, # Use the modified instruction
-            description="Analyzes Gitea PR diffs for Flutter/Dart code provided in the user message.",
+            instruction=instruction,
+            description="Analyzes Gitea PR diffs provided in the user message.",
         )
-        logging.info("Flutter review agent instance created successfully.")
+        logging.info("Review agent instance created successfully.")
         return reviewer_agent
     except Exception as e:
         logging.error(f"Failed to create ADK LlmAgent: {e}", exc_info=True)
-        raise
\ No newline at end of file
+        raise
@@ -3,109 +3,348 @@
 import logging
 import time
 import os
+import uuid
+import hashlib
+import threading
+from collections import deque, OrderedDict
 
-# --- Configuration ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# --- Import AdkApp (lazily) ---
+# vertexai takes seconds to import, so it is loaded when the first agent is built
+# (first review or background pre-warm), not while the receiver is starting up.
+_AdkApp = None
 
-# --- Import AdkApp ---
-try:
-    from vertexai.preview.reasoning_engines import AdkApp
-    logging.info("Successfully imported AdkApp from vertexai.preview.reasoning_engines")
-except ImportError:
-    logging.critical(
-        "Could not import AdkApp from vertexai.preview.reasoning_engines. "
-        "Ensure 'google-cloud-aiplatform' is installed correctly.",
-        exc_info=True
-    )
-    raise SystemExit("AdkApp import failed.")
+def _load_adk_app():
+    global _AdkApp
+    if _AdkApp is None:
+        start_time = time.monotonic()
+        try:
+            from vertexai.preview.reasoning_engines import AdkApp
+        except ImportError:
+            logging.critical(
+                "Could not import AdkApp from vertexai.preview.reasoning_engines. "
+                "Ensure 'google-cloud-aiplatform' is installed correctly.",
+                exc_info=True
+            )
+            raise
+        logging.info(f"Imported AdkApp from vertexai.preview.reasoning_engines in {time.monotonic() - start_time:.2f} seconds.")
+        _AdkApp = AdkApp
+    return _AdkApp
 
 # --- Import Agent Creation Function ---
 try:
-    from agent import create_review_agent
+    from agent import create_review_agent, REVIEW_MODEL_NAME, REVIEW_INSTRUCTION
+    import metrics
+    import tracing
 except ImportError as e:
     logging.critical(f"Failed to import create_review_agent from agent: {e}", exc_info=True)
     raise SystemExit(f"ImportError: {e}")
 
 
-# --- Core Analysis Function ---
-def run_analysis(diff_content: str) -> str:
+# Returned when the stream finished without any text from the agent
+NO_RESPONSE_MESSAGE = "AI agent finished but did not produce a parsable text response."
+# Returned when the model endpoint rejected the call for quota/rate reasons (retryable)
+RATE_LIMITED_MESSAGE = "Error: AI model rate limit exceeded."
+
+def _is_rate_limit_error(error: Exception) -> bool:
+    """Recognizes 429 / RESOURCE_EXHAUSTED failures from the Vertex and google-genai clients."""
+    if type(error).__name__ in ('ResourceExhausted', 'TooManyRequests'):
+        return True
+    if getattr(error, 'code', None) == 429 or getattr(error, 'status_code', None) == 429:
+        return True
+    text = str(error)
+    return '429' in text or 'RESOURCE_EXHAUSTED' in text
+
+# Stream events kept for diagnostics when a run produces no text
+ANALYSIS_EVENT_TAIL = int(os.environ.get('ANALYSIS_EVENT_TAIL', '20'))
+
+def is_failed_analysis(result: str | None) -> bool:
+    """True for None or one of the placeholder messages run_analysis returns on failure."""
+    return not result or result.startswith("Error:") or result == NO_RESPONSE_MESSAGE
+
+
+# --- Agent/App Pool ---
+AGENT_POOL_SIZE = int(os.environ.get('AGENT_POOL_SIZE', '1'))  # AdkApp instances per process and profile
+AGENT_POOL_MAX_PROFILES = int(os.environ.get('AGENT_POOL_MAX_PROFILES', '8'))  # Distinct (model, instruction) pools kept
+
+class AgentAppPool:
     """
-    Creates the ADK agent, wraps it in AdkApp, invokes it using the streaming API,
-    aggregates the final response by checking the correct event author,
-    and returns the analysis result or an error message.
+    Long-lived (agent, AdkApp) pairs shared by every review in this process.
+    Building the agent and setting up the AdkApp (clients, auth, session service)
+    happens once per slot instead of once per review; reviews stay isolated by
+    using their own user/session on the shared app. A slot whose app fails is
+    dropped and rebuilt on next use. Each pool serves one model and instruction.
     """
-    logging.info("Attempting to create ADK agent instance...")
-    try:
-        agent = create_review_agent()
+
+    def __init__(self, size: int = AGENT_POOL_SIZE, factory=None,
+                 model: str = REVIEW_MODEL_NAME, instruction: str = REVIEW_INSTRUCTION):
+        self.size = max(1, size)
+        self.model = model
+        self.instruction = instruction
+        # Returns an (agent, app) pair; replaceable so benchmarks can run against a stand-in model
+        self.factory = factory or self._build
+        self._slots = [None] * self.size
+        self._next = 0
+        self._lock = threading.Lock()
+        self._slot_locks = [threading.Lock() for _ in range(self.size)]
+        self.rebuilds = 0
+
+    def _build(self):
+        agent = create_review_agent(self.model, self.instruction)
         if not agent:
-             raise ValueError("create_review_agent returned None")
-        logging.info("ADK agent instance created.")
-    except Exception as e:
-         logging.error(f"Failed during agent creation: {e}", exc_info=True)
-         return "Error: Failed to initialize AI code review agent."
+            raise ValueError("create_review_agent returned None")
+        app = _load_adk_app()(agent=agent)
+        app.set_up()  # Eagerly create the runner/session service instead of on first query
+        return agent, app
+
+    def _ensure(self, index: int):
+        # Per-slot lock so concurrent first uses build each slot only once
+        with self._slot_locks[index]:
+            if self._slots[index] is None:
+                start_time = time.monotonic()
+                self._slots[index] = self.factory()
+                self.rebuilds += 1
+                logging.info(f"Built agent pool slot {index} in {time.monotonic() - start_time:.2f} seconds.")
+            return self._slots[index]
+
+    def acquire(self):
+        """Returns (slot_index, agent, app), building the slot if needed. Slots are shared round-robin."""
+        with self._lock:
+            index = self._next
+            self._next = (self._next + 1) % self.size
+        agent, app = self._ensure(index)
+        return index, agent, app
+
+    def discard(self, index: int, app):
+        """Marks a slot unhealthy so it is rebuilt on next use (unless it was already replaced)."""
+        with self._slot_locks[index]:
+            if self._slots[index] is not None and self._slots[index][1] is app:
+                logging.warning(f"Discarding agent pool slot {index} after failure; it will be rebuilt.")
+                self._slots[index] = None
+
+    def set_factory(self, factory):
+        """Swaps the (agent, app) factory and drops every built slot."""
+        with self._lock:
+            self.factory = factory
+            self._slots = [None] * self.size
+
+    def warm(self) -> int:
+        """Builds every slot up front (called at worker startup). Returns how many slots failed to build."""
+        failed = 0
+        for index in range(self.size):
+            try:
+                self._ensure(index)
+            except Exception as e:
+                failed += 1
+                logging.error(f"Failed to warm agent pool slot {index}: {e}", exc_info=True)
+        return failed
+
+    def health(self) -> dict:
+        return {
+            'size': self.size,
+            'ready': sum(1 for slot in self._slots if slot is not None),
+            'rebuilds': self.rebuilds,
+        }
+
+
+def profile_label(model: str, instruction: str) -> str:
+    return f"{model}/{hashlib.sha256(instruction.encode('utf-8')).hexdigest()[:8]}"
+
+
+class AgentPoolRegistry:
+    """
+    One AgentAppPool per (model, instruction) pair, so every review profile keeps
+    its own pre-built agents. At most `max_profiles` pools are kept; the least
+    recently used one is dropped (and rebuilt if its profile is used again).
+    """
+
+    def __init__(self, size: int = AGENT_POOL_SIZE, max_profiles: int = AGENT_POOL_MAX_PROFILES):
+        self.size = size
+        self.max_profiles = max(1, max_profiles)
+        self.factory = None  # Overrides every pool's factory (benchmarks)
+        self._pools: OrderedDict[tuple[str, str], AgentAppPool] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, model: str = REVIEW_MODEL_NAME, instruction: str = REVIEW_INSTRUCTION) -> AgentAppPool:
+        key = (model, instruction)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = AgentAppPool(self.size, factory=self.factory, model=model, instruction=instruction)
+                self._pools[key] = pool
+                if len(self._pools) > self.max_profiles:
+                    (old_model, old_instruction), _ = self._pools.popitem(last=False)
+                    logging.info(f"Dropping agent pool for profile {profile_label(old_model, old_instruction)} (least recently used).")
+            else:
+                self._pools.move_to_end(key)
+            return pool
 
-    # Prepare Input message
-    agent_input_message = f"Perform code review on the following diff content:\n\n```diff\n{diff_content}\n```"
-    user_id_for_run = "gitea-pr-agent-user"
+    def set_factory(self, factory):
+        """Swaps the (agent, app) factory of every pool, present and future."""
+        with self._lock:
+            self.factory = factory
+            for pool in self._pools.values():
+                pool.set_factory(factory)
 
-    logging.info(f"Invoking ADK agent '{agent.name}' via AdkApp stream_query for user '{user_id_for_run}' with combined message...")
+    def health(self) -> dict:
+        with self._lock:
+            pools = list(self._pools.values())
+        return {profile_label(pool.model, pool.instruction): pool.health() for pool in pools}
+
+
+agent_pools = AgentPoolRegistry()
+
+def warm_agent_pool(profiles=()) -> tuple[int, int]:
+    """
+    Pre-builds the agent pools for the default profile and each (model, instruction)
+    in `profiles`, so the first review of a repo doesn't pay for it.
+    Returns (failed, total) slot counts; failed slots are rebuilt on first use.
+    """
     start_time = time.monotonic()
-    final_response_parts = []
-    full_result_events = [] # Store events for debugging if needed
+    keys = list(dict.fromkeys([(REVIEW_MODEL_NAME, REVIEW_INSTRUCTION), *profiles]))
+    failed = total = 0
+    for model, instruction in keys[:agent_pools.max_profiles]:
+        pool = agent_pools.get(model, instruction)
+        failed += pool.warm()
+        total += pool.size
+    if failed:
+        logging.warning(f"Agent pools warmed in {time.monotonic() - start_time:.2f} seconds with {failed}/{total} "
+                        f"slots failed: {agent_pools.health()}")
+    else:
+        logging.info(f"Agent pools warmed in {time.monotonic() - start_time:.2f} seconds: {agent_pools.health()}")
+    return failed, total
 
-    try:
-        # Wrap the agent in AdkApp
-        app = AdkApp(agent=agent)
-
-        # Execute the agent using app.stream_query
-        for event in app.stream_query(
-            message=agent_input_message,
-            user_id=user_id_for_run
-        ):
-            full_result_events.append(event)
-
-            # --- CORRECTED CHECK FOR RESPONSE EVENT ---
-            # Check if the author matches the AGENT'S NAME for the final response
-            if isinstance(event, dict) and event.get('author') == agent.name:
-                content = event.get('content', {})
-                parts = content.get('parts', [])
-                logging.info(f"Found potential final response event from author '{agent.name}'. Extracting text...") # Add log
-                for part in parts:
-                    if 'text' in part and part['text']: # Ensure text exists and is not empty
-                        logging.info(f"Appending text part: {part['text'][:100]}...") # Log beginning of part
-                        final_response_parts.append(part['text'])
-                    else:
-                        logging.warning(f"Found part without text in final response event: {part}")
-            # --- END CORRECTION ---
-            # You could add logging for other event types here if needed for debugging
-            # elif isinstance(event, dict):
-            #    logging.debug(f"Received non-model event: Author='{event.get('author')}', Keys={list(event.keys())}")
-
-
-        run_duration = time.monotonic() - start_time
-
-        # Combine the collected parts
-        final_response = "".join(final_response_parts)
-
-        if final_response:
-            logging.info(f"Agent analysis successful via AdkApp stream_query in {run_duration:.2f} seconds. Final Response Length: {len(final_response)}")
-        else:
-            logging.warning(f"AdkApp stream_query finished in {run_duration:.2f} seconds, but no response parts found or extracted matching author '{agent.name}'.")
-            if full_result_events:
-                 logging.warning(f"Last few events from stream: {full_result_events[-5:]}")
-            final_response = "AI agent finished but did not produce a parsable text response." # Keep this message
-
-        return final_response
 
+def _delete_session(app, user_id: str, session_id: str):
+    try:
+        app.delete_session(user_id=user_id, session_id=session_id)
     except Exception as e:
-        run_duration = time.monotonic() - start_time
-        logging.error(f"AdkApp stream_query execution failed after {run_duration:.2f} seconds: {e}", exc_info=True)
-        # Keep returning the generic error for the comment
-        return "Error: Failed to perform AI code review due to an internal error during AdkApp execution."
+        logging.warning(f"Could not delete session {session_id} for user '{user_id}': {e}")
+
+
+# --- Core Analysis Function ---
+def run_analysis(diff_content: str, should_cancel=None, on_text=None, usage=None,
+                 model: str = REVIEW_MODEL_NAME, instruction: str = REVIEW_INSTRUCTION) -> str | None:
+    """
+    Takes an ADK agent/AdkApp for `model` and `instruction` from the per-process
+    pools, invokes it using the streaming API in a fresh session, aggregates the
+    final response by checking the correct event author, and returns the analysis
+    result or an error message.
+    If `should_cancel` returns True between stream events the run is abandoned
+    and None is returned. `on_text` is called with the response text so far each
+    time a new part arrives, so callers can show partial results. Reported token
+    counts are added to `usage` (a token_budget.TokenUsage) when given.
+    """
+    with tracing.span('model.call', model=model, diff_chars=len(diff_content)) as span:
+        try:
+            agent_pool = agent_pools.get(model, instruction)
+            with tracing.span('agent_pool.acquire'):
+                slot_index, agent, app = agent_pool.acquire()
+        except Exception as e:
+             logging.error(f"Failed during agent creation: {e}", exc_info=True)
+             return "Error: Failed to initialize AI code review agent."
+
+        # Prepare Input message
+        agent_input_message = f"Perform code review on the following diff content:\n\n```diff\n{diff_content}\n```"
+        # Each review gets its own user/session on the shared app
+        user_id_for_run = f"gitea-pr-agent-{uuid.uuid4().hex}"
+        session_id = None
+
+        logging.info(f"Invoking ADK agent '{agent.name}' via AdkApp stream_query for user '{user_id_for_run}' with combined message...")
+        start_time = time.monotonic()
+        final_response_parts = []
+        recent_events = deque(maxlen=ANALYSIS_EVENT_TAIL) # Bounded tail of events for debugging
+        tokens_in = tokens_out = 0
+
+        try:
+            session = app.create_session(user_id=user_id_for_run)
+            session_id = session['id'] if isinstance(session, dict) else session.id
+
+            # Execute the agent using app.stream_query
+            for event in app.stream_query(
+                message=agent_input_message,
+                user_id=user_id_for_run,
+                session_id=session_id
+            ):
+                recent_events.append(event)
+                span.event('stream_event', author=event.get('author') if isinstance(event, dict) else None)
+
+                usage_metadata = event.get('usage_metadata') if isinstance(event, dict) else None
+                if usage_metadata:
+                    tokens_in += usage_metadata.get('prompt_token_count') or 0
+                    tokens_out += usage_metadata.get('candidates_token_count') or 0
+
+                if should_cancel and should_cancel():
+                    logging.info(f"AdkApp stream_query cancelled after {time.monotonic() - start_time:.2f} seconds (superseded).")
+                    span.set(outcome='cancelled')
+                    return None
+
+                # --- CORRECTED CHECK FOR RESPONSE EVENT ---
+                # Check if the author matches the AGENT'S NAME for the final response
+                if isinstance(event, dict) and event.get('author') == agent.name:
+                    content = event.get('content', {})
+                    parts = content.get('parts', [])
+                    logging.info(f"Found potential final response event from author '{agent.name}'. Extracting text...") # Add log
+                    appended = False
+                    for part in parts:
+                        if 'text' in part and part['text']: # Ensure text exists and is not empty
+                            logging.debug(f"Appending text part: {part['text'][:100]}...") # Log beginning of part
+                            final_response_parts.append(part['text'])
+                            appended = True
+                        else:
+                            logging.warning(f"Found part without text in final response event: {part}")
+                    if appended and len(final_response_parts) == 1:
+                        span.event('first_text')
+                    if appended and on_text:
+                        try:
+                            on_text("".join(final_response_parts))
+                        except Exception as e:
+                            logging.warning(f"Progress callback failed: {e}")
+                # --- END CORRECTION ---
+                # You could add logging for other event types here if needed for debugging
+                # elif isinstance(event, dict):
+                #    logging.debug(f"Received non-model event: Author='{event.get('author')}', Keys={list(event.keys())}")
+
+
+            run_duration = time.monotonic() - start_time
+            span.set(tokens_in=tokens_in, tokens_out=tokens_out, response_chars=len("".join(final_response_parts)))
+            metrics.MODEL_CALL_DURATION.labels(model=agent.model).observe(run_duration)
+            metrics.MODEL_TOKENS.labels(model=agent.model, direction='in').inc(tokens_in)
+            metrics.MODEL_TOKENS.labels(model=agent.model, direction='out').inc(tokens_out)
+            if usage is not None:
+                usage.add_actual(tokens_in, tokens_out)
+
+            # Combine the collected parts
+            final_response = "".join(final_response_parts)
+
+            if final_response:
+                logging.info(f"Agent analysis successful via AdkApp stream_query in {run_duration:.2f} seconds. Final Response Length: {len(final_response)}")
+            else:
+                logging.warning(f"AdkApp stream_query finished in {run_duration:.2f} seconds, but no response parts found or extracted matching author '{agent.name}'.")
+                if recent_events:
+                     logging.warning(f"Last few events from stream: {list(recent_events)[-5:]}")
+                final_response = NO_RESPONSE_MESSAGE # Keep this message
+
+            return final_response
+
+        except Exception as e:
+            run_duration = time.monotonic() - start_time
+            if _is_rate_limit_error(e):
+                logging.warning(f"AdkApp stream_query rate limited after {run_duration:.2f} seconds: {e}")
+                span.set(outcome='rate_limited')
+                return RATE_LIMITED_MESSAGE
+            logging.error(f"AdkApp stream_query execution failed after {run_duration:.2f} seconds: {e}", exc_info=True)
+            span.set(outcome='error', error_type=type(e).__name__)
+            agent_pool.discard(slot_index, app)
+            # Keep returning the generic error for the comment
+            return "Error: Failed to perform AI code review due to an internal error during AdkApp execution."
+        finally:
+            if session_id is not None:
+                _delete_session(app, user_id_for_run, session_id)
 
 
 # --- Local Testing Block ---
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
     logging.info("Running local test for agent_runner...")
 
     os.environ.setdefault('GOOGLE_CLOUD_PROJECT', 'pr-review-agent')
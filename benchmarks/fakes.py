@@ -0,0 +1,239 @@
+# benchmarks/fakes.py
+"""
+In-process stand-ins for Gitea and the Vertex AdkApp, used by the benchmarks
+to exercise receiver.app end to end without network access or model spend.
+"""
+import re
+import json
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# --- Synthetic Diffs ---
+def synthetic_diff(seed: int, files: int = 5, lines_per_file: int = 40) -> str:
+    """A deterministic Dart-looking diff; different seeds give different hunks."""
+    rng = random.Random(seed)
+    out = []
+    for i in range(files):
+        path = f"lib/feature_{seed % 7}/widget_{i}.dart"
+        out.append(f"diff --git a/{path} b/{path}")
+        out.append("index 1111111..2222222 100644")
+        out.append(f"--- a/{path}")
+        out.append(f"+++ b/{path}")
+        out.append(f"@@ -1,{lines_per_file // 2} +1,{lines_per_file} @@ class Widget{i} extends StatelessWidget {{")
+        for j in range(lines_per_file):
+            if j % 2:
+                out.append(f"+  final value{j} = compute{rng.randint(0, 10**6)}(context); // seed {seed}")
+            else:
+                out.append(f"   Widget build{j}(BuildContext context) => const SizedBox();")
+    return '\n'.join(out) + '\n'
+
+
+# --- Fake Gitea ---
+class FakeGitea:
+    """
+    Threaded HTTP server implementing the Gitea endpoints the bot calls:
+    PR/compare diffs, the compare API, issue comments (POST/PATCH) and pull reviews.
+    Every write is recorded with its arrival time so callers can measure
+    end-to-end latency.
+    """
+
+    def __init__(self, latency: float = 0.0, files: int = 5, lines_per_file: int = 40, diffs: dict | None = None):
+        self.latency = latency
+        self.files = files
+        self.lines_per_file = lines_per_file
+        self.diffs = diffs or {}          # (repo, pr) -> recorded diff text
+        self.writes = []                  # (monotonic time, kind, repo, pr, body)
+        self._comment_prs = {}            # comment id -> (repo, pr), to attribute PATCHes
+        self._cond = threading.Condition()
+        self._next_id = 1
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name='fake-gitea', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+
+    def diff_for(self, repo: str, pr: int) -> str:
+        return self.diffs.get((repo, pr)) or synthetic_diff(hash((repo, pr)) & 0xFFFFFF, self.files, self.lines_per_file)
+
+    def record(self, kind: str, repo: str, pr: int | None, body: dict, comment_id: int | None = None) -> int:
+        """Records a write; kind is 'comment', 'edit', 'delete' or 'review'. Returns the new/edited comment id."""
+        with self._cond:
+            if comment_id is None:
+                comment_id = self._next_id
+                self._next_id += 1
+                self._comment_prs[comment_id] = (repo, pr)
+            else:
+                repo, pr = self._comment_prs.get(comment_id, (repo, pr))
+            self.writes.append((time.monotonic(), kind, repo, pr, body))
+            self._cond.notify_all()
+        return comment_id
+
+    @staticmethod
+    def is_final(kind: str, body: dict) -> bool:
+        """The finished review: a pull review, or a comment that is not a progress placeholder."""
+        return kind == 'review' or (kind in ('comment', 'edit') and not body.get('body', '').startswith('⏳'))
+
+    def _first(self, repo: str, pr: int, predicate) -> float | None:
+        for ts, kind, w_repo, w_pr, body in self.writes:
+            if w_repo == repo and w_pr == pr and predicate(kind, body):
+                return ts
+        return None
+
+    def final_write(self, repo: str, pr: int) -> float | None:
+        return self._first(repo, pr, self.is_final)
+
+    def first_feedback(self, repo: str, pr: int) -> float | None:
+        """First time the PR showed review content: a progress edit or the final review."""
+        return self._first(repo, pr, lambda kind, body: kind == 'edit' or self.is_final(kind, body))
+
+    def wait_for_reviews(self, keys: set, timeout: float) -> set:
+        """Blocks until every (repo, pr) in `keys` has its final review, or timeout. Returns the missing keys."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                missing = keys - {(repo, pr) for _, kind, repo, pr, body in self.writes if self.is_final(kind, body)}
+                remaining = deadline - time.monotonic()
+                if not missing or remaining <= 0:
+                    return missing
+                self._cond.wait(remaining)
+
+    def _handler(self):
+        gitea = self
+        pr_diff = re.compile(r'^/api/v1/repos/([^/]+/[^/]+)/pulls/(\d+)\.diff$')
+        compare_api = re.compile(r'^/api/v1/repos/([^/]+/[^/]+)/compare/')
+        web_compare = re.compile(r'^/([^/]+/[^/]+)/compare/.*\.diff$')
+        raw_file = re.compile(r'^/api/v1/repos/([^/]+/[^/]+)/raw/')
+        issue_comment = re.compile(r'^/api/v1/repos/([^/]+/[^/]+)/issues/(\d+)/comments$')
+        edit_comment = re.compile(r'^/api/v1/repos/([^/]+/[^/]+)/issues/comments/(\d+)$')
+        pull_review = re.compile(r'^/api/v1/repos/([^/]+/[^/]+)/pulls/(\d+)/reviews$')
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, code: int, body: bytes = b'', content_type: str = 'application/json'):
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _body(self) -> dict:
+                length = int(self.headers.get('Content-Length') or 0)
+                return json.loads(self.rfile.read(length) or b'{}')
+
+            def do_GET(self):
+                time.sleep(gitea.latency)
+                path = self.path.split('?', 1)[0]
+                if m := pr_diff.match(path):
+                    return self._send(200, gitea.diff_for(m.group(1), int(m.group(2))).encode(), 'text/plain')
+                if compare_api.match(path):
+                    return self._send(200, b'{"total_commits": 0, "commits": []}')
+                if m := web_compare.match(path):
+                    return self._send(200, synthetic_diff(hash(path) & 0xFFFF, 1, 10).encode(), 'text/plain')
+                if raw_file.match(path):
+                    return self._send(404, b'{"message": "not found"}')
+                self._send(404, b'{}')
+
+            def do_POST(self):
+                time.sleep(gitea.latency)
+                path = self.path.split('?', 1)[0]
+                body = self._body()
+                for kind, pattern in (('comment', issue_comment), ('review', pull_review)):
+                    if m := pattern.match(path):
+                        comment_id = gitea.record(kind, m.group(1), int(m.group(2)), body)
+                        return self._send(201, json.dumps({'id': comment_id}).encode())
+                self._send(404, b'{}')
+
+            def do_PATCH(self):
+                time.sleep(gitea.latency)
+                path = self.path.split('?', 1)[0]
+                body = self._body()
+                if m := edit_comment.match(path):
+                    gitea.record('edit', m.group(1), None, body, comment_id=int(m.group(2)))
+                    return self._send(200, json.dumps({'id': int(m.group(2))}).encode())
+                self._send(404, b'{}')
+
+            def do_DELETE(self):
+                path = self.path.split('?', 1)[0]
+                if m := edit_comment.match(path):
+                    gitea.record('delete', m.group(1), None, {}, comment_id=int(m.group(2)))
+                self._send(204)
+
+        return Handler
+
+
+# --- Fake Model ---
+class FakeAgent:
+    def __init__(self, name: str = 'FlutterCodeReviewer', model: str = 'fake-model'):
+        self.name = name
+        self.model = model
+
+
+class FakeAdkApp:
+    """
+    Mimics the AdkApp calls used by agent_runner. Each query sleeps for
+    `latency` (+/- `jitter`) seconds, spread over `parts` streamed response
+    events, with usage_metadata derived from the prompt size on the last one.
+    """
+
+    def __init__(self, agent: FakeAgent, latency: float = 2.0, jitter: float = 0.5,
+                 tokens_out: int = 300, chars_per_token: int = 4, parts: int = 3):
+        self.agent = agent
+        self.latency = latency
+        self.jitter = jitter
+        self.tokens_out = tokens_out
+        self.chars_per_token = chars_per_token
+        self.parts = max(1, parts)
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def set_up(self):
+        pass
+
+    def create_session(self, user_id: str, **kwargs):
+        return {'id': f"session-{user_id}"}
+
+    def delete_session(self, user_id: str, session_id: str, **kwargs):
+        pass
+
+    def stream_query(self, message: str, user_id: str, session_id: str | None = None, **kwargs):
+        with self._lock:
+            self.calls += 1
+        latency = max(0.0, random.uniform(self.latency - self.jitter, self.latency + self.jitter))
+        # One line-level finding on the first added line of each file, plus a general remark
+        findings = []
+        for path, first_added in re.findall(r'^\+\+\+ b/(.+)\n(?:.*\n)*?\s*(\d+) \+', message, flags=re.MULTILINE):
+            findings.append(f"- [suggestion] {path}:{first_added}: consider marking this value `final`.")
+        lines = ["AI Flutter/Dart Code Review Analysis:"] + findings + [
+            "- Consider extracting the repeated build methods into a shared widget."
+        ]
+        per_part = -(-len(lines) // self.parts)
+        for index in range(self.parts):
+            time.sleep(latency / self.parts)
+            text = '\n'.join(lines[index * per_part:(index + 1) * per_part])
+            event = {'author': self.agent.name, 'content': {'parts': [{'text': text + '\n'}] if text else []}}
+            if index == self.parts - 1:
+                event['usage_metadata'] = {
+                    'prompt_token_count': len(message) // self.chars_per_token,
+                    'candidates_token_count': self.tokens_out,
+                }
+            yield event
+
+
+def fake_app_factory(latency: float = 2.0, jitter: float = 0.5, tokens_out: int = 300, parts: int = 3):
+    """Returns an AgentAppPool factory that builds FakeAgent/FakeAdkApp pairs."""
+    def factory():
+        agent = FakeAgent()
+        return agent, FakeAdkApp(agent, latency=latency, jitter=jitter, tokens_out=tokens_out, parts=parts)
+    return factory
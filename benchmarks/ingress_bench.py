@@ -0,0 +1,207 @@
+# benchmarks/ingress_bench.py
+"""
+Micro-benchmark for webhook ingress (ack latency of POST /webhook).
+
+Drives receiver.app directly through its ASGI interface, so the numbers cover
+routing, header filtering, body reading, signature checks, JSON parsing and
+enqueueing, without socket or HTTP parsing overhead. Deliveries are a mix of
+relevant pull_request events and ones the bot ignores (pushes, issue comments,
+label changes), plus a share of unsigned and oversized bodies and of redeliveries
+(a few deliveries resent with the same X-Gitea-Delivery id, dropped as duplicates).
+
+Jobs are only enqueued; no worker pool runs, so no reviews happen.
+
+Usage:
+    python benchmarks/ingress_bench.py --requests 20000 --concurrency 64
+    python benchmarks/ingress_bench.py --stdlib-json --queue fakeredis --json
+"""
+import os
+import sys
+import hmac
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+import argparse
+import logging
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WEBHOOK_SECRET = 'ingress-bench-secret'
+
+
+# --- Deliveries ---
+def _padding(kb: int) -> dict:
+    """Bulk resembling the user/repo objects Gitea embeds in every delivery."""
+    user = {'id': 1, 'login': 'octo', 'full_name': 'Octo Cat', 'email': 'octo@example.com',
+            'avatar_url': 'https://gitea.example.com/avatars/1', 'language': 'en-US', 'is_admin': False}
+    return {'sender': user, 'extra': [dict(user, id=i, description='x' * 200) for i in range(max(1, kb * 1024 // 450))]}
+
+
+_oversized_body: bytes | None = None
+
+
+def make_delivery(kind: str, index: int, payload_kb: int, max_body: int) -> tuple[list[tuple[str, str]], bytes]:
+    repo = {'id': 7, 'full_name': f"bench/repo-{index % 16}", 'default_branch': 'main'}
+    headers = [('content-type', 'application/json')]
+    if kind in ('pr', 'redelivery'):
+        # Redeliveries cycle through a few fixed deliveries; only the first of each is enqueued
+        redelivered = index % 8 if kind == 'redelivery' else None
+        delivery = str(uuid.UUID(int=redelivered + 1)) if kind == 'redelivery' else str(uuid.uuid4())
+        head_sha = f"{redelivered:040x}" if kind == 'redelivery' else uuid.uuid4().hex + uuid.uuid4().hex[:8]
+        number = 100000 + redelivered if kind == 'redelivery' else index
+        headers += [('x-gitea-event', 'pull_request'), ('x-gitea-event-type', 'pull_request_sync'),
+                    ('x-gitea-delivery', delivery)]
+        payload = {'action': 'synchronized', 'number': number, 'repository': repo,
+                   'pull_request': {'number': number, 'title': 'Bench PR', 'body': 'b' * 2000,
+                                    'head': {'sha': head_sha, 'ref': 'feature'}}}
+    elif kind == 'push':
+        headers += [('x-gitea-event', 'push'), ('x-gitea-event-type', 'push')]
+        payload = {'ref': 'refs/heads/main', 'commits': [{'id': uuid.uuid4().hex, 'message': 'm' * 200}] * 20,
+                   'repository': repo}
+    elif kind == 'comment':
+        headers += [('x-gitea-event', 'issue_comment'), ('x-gitea-event-type', 'pull_request_comment')]
+        payload = {'action': 'created', 'comment': {'body': 'c' * 500}, 'repository': repo}
+    elif kind == 'label':
+        headers += [('x-gitea-event', 'pull_request'), ('x-gitea-event-type', 'pull_request_label')]
+        payload = {'action': 'label_updated', 'number': index, 'repository': repo, 'pull_request': {'number': index}}
+    elif kind in ('unsigned', 'oversized'):
+        headers += [('x-gitea-event', 'pull_request'), ('x-gitea-event-type', 'pull_request')]
+        payload = {'action': 'opened', 'number': index, 'repository': repo, 'pull_request': {'number': index}}
+    else:
+        raise ValueError(kind)
+    payload.update(_padding(payload_kb))
+    if kind == 'oversized':
+        global _oversized_body
+        if _oversized_body is None:  # one shared body; these are rejected on Content-Length anyway
+            _oversized_body = json.dumps(dict(payload, blob='z' * (max_body + 1))).encode('utf-8')
+        body = _oversized_body
+    else:
+        body = json.dumps(payload).encode('utf-8')
+    if kind != 'unsigned':
+        headers.append(('x-gitea-signature', hmac.new(WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()))
+    headers.append(('content-length', str(len(body))))
+    return headers, body
+
+
+# --- ASGI Driver ---
+async def call_app(app, headers: list[tuple[str, str]], body: bytes) -> int:
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'POST',
+        'scheme': 'http', 'path': '/webhook', 'raw_path': b'/webhook', 'query_string': b'', 'root_path': '',
+        'headers': [(k.encode('latin-1'), v.encode('latin-1')) for k, v in headers],
+        'client': ('127.0.0.1', 40000), 'server': ('127.0.0.1', 8080),
+    }
+    delivered = False
+    result = {}
+
+    async def receive():
+        nonlocal delivered
+        if delivered:
+            return {'type': 'http.disconnect'}
+        delivered = True
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            result['status'] = message['status']
+
+    await app(scope, receive, send)
+    return result.get('status', 0)
+
+
+def percentile(values: list[float], pct: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered) + 0.5) - 1))]
+
+
+async def run(app, deliveries: list[tuple[str, list, bytes]], concurrency: int) -> dict:
+    latencies: dict[str, list[float]] = {}
+    statuses: dict[str, dict[int, int]] = {}
+    position = 0
+
+    async def worker():
+        nonlocal position
+        while position < len(deliveries):
+            kind, headers, body = deliveries[position]
+            position += 1
+            start = time.perf_counter()
+            code = await call_app(app, headers, body)
+            latencies.setdefault(kind, []).append(time.perf_counter() - start)
+            by_kind = statuses.setdefault(kind, {})
+            by_kind[code] = by_kind.get(code, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    everything = [v for values in latencies.values() for v in values]
+    return {
+        'requests': len(deliveries),
+        'requests_per_second': len(deliveries) / elapsed,
+        'latency_ms': {f"p{p}": percentile(everything, p) * 1000 for p in (50, 95, 99)},
+        'by_kind': {
+            kind: {'count': len(values), 'statuses': statuses[kind],
+                   **{f"p{p}_ms": percentile(values, p) * 1000 for p in (50, 95, 99)}}
+            for kind, values in sorted(latencies.items())
+        },
+    }
+
+
+# --- Entry Point ---
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=64, help='deliveries in flight at once')
+    parser.add_argument('--mix', default='pr=0.25,redelivery=0.05,push=0.3,comment=0.2,label=0.1,unsigned=0.05,oversized=0.05',
+                        help='share of each delivery kind')
+    parser.add_argument('--payload-kb', type=int, default=20, help='approximate size of each delivery body')
+    parser.add_argument('--queue', choices=('sqlite', 'fakeredis'), default='sqlite', help='job queue backend')
+    parser.add_argument('--stdlib-json', action='store_true', help='parse with json instead of orjson')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    state_dir = tempfile.mkdtemp(prefix='prreviewbot-ingress-')
+    os.environ['GITEA_WEBHOOK_SECRET'] = WEBHOOK_SECRET
+    os.environ['JOB_QUEUE_BACKEND'] = args.queue
+    os.environ['JOB_QUEUE_PATH'] = os.path.join(state_dir, 'jobs.sqlite3')
+    os.environ['JOB_QUEUE_MAX_DEPTH'] = str(args.requests + 1)
+    os.environ['REVIEW_STORE_PATH'] = os.path.join(state_dir, 'state.sqlite3')
+    os.environ.pop('PROMETHEUS_MULTIPROC_DIR', None)
+
+    import receiver
+    from job_queue import create_job_queue, WorkerPool
+    logging.getLogger().setLevel(logging.ERROR)  # rejections are logged as warnings
+    if args.stdlib_json:
+        receiver._loads = json.loads
+    receiver.job_queue = create_job_queue()
+    receiver.worker_pool = WorkerPool(receiver.job_queue, lambda job: None)  # never started: enqueue only
+
+    mix = [(kind, float(share)) for kind, share in (item.split('=') for item in args.mix.split(','))]
+    total_share = sum(share for _, share in mix)
+    deliveries = []
+    for kind, share in mix:
+        for _ in range(round(args.requests * share / total_share)):
+            deliveries.append((kind, *make_delivery(kind, len(deliveries) + 1, args.payload_kb, receiver.WEBHOOK_MAX_BODY_BYTES)))
+    deliveries.sort(key=lambda d: hash(d[2]))  # interleave kinds deterministically per run
+
+    asyncio.run(run(receiver.app, deliveries[:min(len(deliveries), 200)], args.concurrency))  # warm-up
+    report = asyncio.run(run(receiver.app, deliveries, args.concurrency))
+    report['json_decoder'] = 'json' if receiver._loads is json.loads else receiver._loads.__module__
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    latency = report['latency_ms']
+    print(f"{report['requests']} deliveries at {report['requests_per_second']:.0f} req/s "
+          f"(decoder {report['json_decoder']}): p50={latency['p50']:.2f}ms p95={latency['p95']:.2f}ms p99={latency['p99']:.2f}ms")
+    for kind, stats in report['by_kind'].items():
+        print(f"  {kind:<10} n={stats['count']:<6} p50={stats['p50_ms']:.2f}ms p95={stats['p95_ms']:.2f}ms "
+              f"p99={stats['p99_ms']:.2f}ms statuses={stats['statuses']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+# benchmarks/replay_bench.py
+"""
+Offline replay benchmark for receiver.app.
+
+Runs the real app (webhook handler, job queue, worker pool, diff streaming,
+map-reduce review, comment posting) under uvicorn in this process, against a
+local fake Gitea server and a fake AdkApp with configurable latency and token
+usage. Webhooks are replayed at a fixed arrival rate, either synthetic or from
+a recorded JSONL file (one webhook body per line).
+
+Reports webhook ack latency, end-to-end review latency (webhook sent until the
+review reaches Gitea) and time to first feedback (first progress edit) as
+p50/p95/p99, plus throughput and peak RSS. With --sweep, doubles the arrival
+rate until the app falls behind, and reports the highest sustainable PRs/minute.
+
+Usage:
+    python benchmarks/replay_bench.py --rate 2 --count 60
+    python benchmarks/replay_bench.py --sweep --slo 30 --json
+    python benchmarks/replay_bench.py --payloads recorded_webhooks.jsonl --rate 5
+    python benchmarks/replay_bench.py --trace /tmp/traces.jsonl   # per-stage span breakdown
+"""
+import os
+import sys
+import hmac
+import json
+import time
+import uuid
+import socket
+import hashlib
+import argparse
+import logging
+import resource
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeGitea, fake_app_factory
+from trace_report import print_report
+
+WEBHOOK_SECRET = 'replay-bench-secret'
+
+
+# --- Environment ---
+def configure_environment(gitea_url: str, state_dir: str, trace_file: str | None = None):
+    """Points the app at the fake Gitea and throwaway state. Must run before receiver is imported."""
+    os.environ['GITEA_URL'] = gitea_url
+    os.environ['GITEA_API_TOKEN'] = 'replay-bench-token'
+    os.environ['GITEA_WEBHOOK_SECRET'] = WEBHOOK_SECRET
+    os.environ['JOB_QUEUE_BACKEND'] = 'sqlite'
+    os.environ['JOB_QUEUE_PATH'] = os.path.join(state_dir, 'jobs.sqlite3')
+    os.environ['REVIEW_STORE_PATH'] = os.path.join(state_dir, 'state.sqlite3')
+    os.environ['REVIEW_DEBOUNCE_SECONDS'] = '0'
+    os.environ.setdefault('REVIEW_CACHE_BACKEND', 'memory')
+    os.environ.setdefault('REVIEW_MAX_CALLS_PER_MINUTE', '0')  # the fake model is not rate limited
+    os.environ.pop('PROMETHEUS_MULTIPROC_DIR', None)
+    if trace_file:
+        os.environ['TRACE_EXPORTER'] = 'file'
+        os.environ['TRACE_FILE'] = trace_file
+
+
+# --- App Server ---
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_app(factory):
+    """Imports receiver with the fake model factory installed and serves it on a free port."""
+    import uvicorn
+    import agent_runner
+    agent_runner.agent_pools.set_factory(factory)
+    import receiver
+
+    class Server(uvicorn.Server):
+        def install_signal_handlers(self):
+            pass  # Not on the main thread
+
+    port = _free_port()
+    server = Server(uvicorn.Config(receiver.app, host='127.0.0.1', port=port, log_level='warning'))
+    threading.Thread(target=server.run, name='replay-bench-app', daemon=True).start()
+    deadline = time.monotonic() + 30
+    while not server.started:
+        if time.monotonic() > deadline:
+            raise RuntimeError("App server did not start within 30 seconds.")
+        time.sleep(0.05)
+    return server, f"http://127.0.0.1:{port}"
+
+
+# --- Payloads ---
+def synthetic_payload(repo: str, pr_number: int) -> dict:
+    return {
+        'action': 'opened',
+        'number': pr_number,
+        'pull_request': {'number': pr_number, 'head': {'sha': uuid.uuid4().hex + uuid.uuid4().hex[:8]}},
+        'repository': {'full_name': repo},
+    }
+
+
+def load_payloads(path: str) -> list[dict]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def make_payloads(count: int, first_pr: int, recorded: list[dict] | None, repos: int) -> list[dict]:
+    """
+    Builds `count` webhook bodies with unique PR numbers starting at `first_pr`, so every
+    delivery is an independent review (recorded payloads are cycled and renumbered).
+    """
+    payloads = []
+    for i in range(count):
+        pr_number = first_pr + i
+        if recorded:
+            payload = json.loads(json.dumps(recorded[i % len(recorded)]))
+            payload['number'] = pr_number
+            payload.setdefault('pull_request', {})['number'] = pr_number
+            payload['pull_request'].setdefault('head', {})['sha'] = uuid.uuid4().hex + uuid.uuid4().hex[:8]
+            payload['action'] = 'opened'
+        else:
+            payload = synthetic_payload(f"bench/repo-{i % repos}", pr_number)
+        payloads.append(payload)
+    return payloads
+
+
+# --- Measurement ---
+def percentile(values: list[float], pct: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def summarize(values: list[float]) -> dict:
+    return {f"p{p}": percentile(values, p) for p in (50, 95, 99)}
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def run_trial(app_url: str, gitea: FakeGitea, rate: float, count: int, first_pr: int,
+              recorded: list[dict] | None, repos: int, timeout: float) -> dict:
+    """Sends `count` webhooks at `rate` per second and waits for their review comments."""
+    import httpx
+
+    payloads = make_payloads(count, first_pr, recorded, repos)
+    sent_at = {}
+    acks = []
+    statuses = {}
+    lock = threading.Lock()
+    client = httpx.Client(base_url=app_url, timeout=30)
+
+    def send(payload: dict):
+        body = json.dumps(payload).encode('utf-8')
+        signature = hmac.new(WEBHOOK_SECRET.encode('utf-8'), body, hashlib.sha256).hexdigest()
+        key = (payload['repository']['full_name'], payload['number'])
+        start = time.monotonic()
+        response = client.post('/webhook', content=body, headers={
+            'Content-Type': 'application/json',
+            'X-Gitea-Signature': signature,
+            'X-Gitea-Event': 'pull_request',
+            'X-Gitea-Delivery': str(uuid.uuid4()),
+        })
+        ack = time.monotonic() - start
+        with lock:
+            sent_at[key] = start
+            acks.append(ack)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    trial_start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=64, thread_name_prefix='replay-send') as senders:
+        for i, payload in enumerate(payloads):
+            delay = trial_start + i / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            senders.submit(send, payload)
+    client.close()
+
+    accepted = {key for key in sent_at}
+    missing = gitea.wait_for_reviews(accepted, timeout)
+    latencies = []
+    first_feedback = []
+    last_write = trial_start
+    for key in accepted - missing:
+        written = gitea.final_write(*key)
+        latencies.append(written - sent_at[key])
+        first_feedback.append(gitea.first_feedback(*key) - sent_at[key])
+        last_write = max(last_write, written)
+    elapsed = last_write - trial_start
+
+    completed = len(latencies)
+    return {
+        'arrival_rate_per_min': rate * 60,
+        'sent': count,
+        'statuses': statuses,
+        'completed': completed,
+        'timed_out': len(missing),
+        'ack_latency_s': summarize(acks),
+        'e2e_latency_s': summarize(latencies),
+        'first_feedback_s': summarize(first_feedback),
+        'throughput_per_min': completed / elapsed * 60 if elapsed > 0 else None,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def is_sustainable(result: dict, slo: float) -> bool:
+    """The app keeps up if every review finished, none were shed, and p95 stayed within the SLO."""
+    p95 = result['e2e_latency_s']['p95']
+    return (result['timed_out'] == 0 and result['completed'] == result['sent']
+            and p95 is not None and p95 <= slo)
+
+
+def format_result(result: dict) -> str:
+    def fmt(stats):
+        return ' '.join(f"{k}={v:.3f}s" if v is not None else f"{k}=n/a" for k, v in stats.items())
+    throughput = result['throughput_per_min']
+    return (
+        f"arrival {result['arrival_rate_per_min']:.1f}/min: {result['completed']}/{result['sent']} reviewed "
+        f"(timed out {result['timed_out']}, statuses {result['statuses']})\n"
+        f"  ack  {fmt(result['ack_latency_s'])}\n"
+        f"  e2e  {fmt(result['e2e_latency_s'])}\n"
+        f"  first feedback {fmt(result['first_feedback_s'])}\n"
+        f"  throughput {throughput:.1f} PRs/min, peak RSS {result['peak_rss_mb']:.1f} MB"
+        if throughput is not None else
+        f"arrival {result['arrival_rate_per_min']:.1f}/min: no reviews completed (statuses {result['statuses']})"
+    )
+
+
+# --- Entry Point ---
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rate', type=float, default=1.0, help='webhook arrivals per second')
+    parser.add_argument('--count', type=int, default=30, help='webhooks per trial')
+    parser.add_argument('--payloads', help='JSONL file of recorded webhook bodies to replay')
+    parser.add_argument('--repos', type=int, default=4, help='distinct repos for synthetic payloads')
+    parser.add_argument('--files', type=int, default=5, help='files per synthetic diff')
+    parser.add_argument('--lines-per-file', type=int, default=40, help='changed lines per synthetic file')
+    parser.add_argument('--model-latency', type=float, default=2.0, help='fake model call latency (seconds)')
+    parser.add_argument('--model-jitter', type=float, default=0.5, help='+/- jitter on model latency (seconds)')
+    parser.add_argument('--tokens-out', type=int, default=300, help='output tokens reported per model call')
+    parser.add_argument('--model-parts', type=int, default=3, help='streamed response events per model call')
+    parser.add_argument('--gitea-latency', type=float, default=0.01, help='fake Gitea latency per request (seconds)')
+    parser.add_argument('--timeout', type=float, default=300.0, help='seconds to wait for reviews after the last webhook')
+    parser.add_argument('--sweep', action='store_true', help='double the rate until the app falls behind')
+    parser.add_argument('--slo', type=float, default=60.0, help='p95 end-to-end latency (seconds) considered sustainable')
+    parser.add_argument('--max-rate', type=float, default=64.0, help='highest arrival rate (per second) tried by --sweep')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    parser.add_argument('--verbose', action='store_true', help='keep the app\'s INFO logging')
+    parser.add_argument('--trace', metavar='FILE', help='write spans to FILE and print a per-stage breakdown')
+    args = parser.parse_args()
+
+    gitea = FakeGitea(latency=args.gitea_latency, files=args.files, lines_per_file=args.lines_per_file).start()
+    state_dir = tempfile.mkdtemp(prefix='prreviewbot-bench-')
+    if args.trace and os.path.exists(args.trace):
+        os.remove(args.trace)
+    configure_environment(gitea.url, state_dir, args.trace)
+    factory = fake_app_factory(latency=args.model_latency, jitter=args.model_jitter, tokens_out=args.tokens_out,
+                               parts=args.model_parts)
+    server, app_url = start_app(factory)
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    recorded = load_payloads(args.payloads) if args.payloads else None
+    results = []
+    first_pr = 1
+    rate = args.rate
+    try:
+        while True:
+            result = run_trial(app_url, gitea, rate, args.count, first_pr, recorded, args.repos, args.timeout)
+            results.append(result)
+            first_pr += args.count
+            if not args.json:
+                print(format_result(result), flush=True)
+            if not args.sweep or not is_sustainable(result, args.slo) or rate * 2 > args.max_rate:
+                break
+            rate *= 2
+    finally:
+        server.should_exit = True
+        gitea.stop()
+
+    report = {'trials': results}
+    if args.sweep:
+        sustainable = [r for r in results if is_sustainable(r, args.slo)]
+        report['max_sustainable_prs_per_min'] = max(
+            (r['throughput_per_min'] for r in sustainable), default=None
+        )
+    report['peak_rss_mb'] = peak_rss_mb()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    elif args.trace:
+        print_report(args.trace)
+    elif args.sweep:
+        best = report['max_sustainable_prs_per_min']
+        print(f"Max sustainable throughput: {best:.1f} PRs/min (p95 <= {args.slo:.0f}s)" if best
+              else "No sustainable rate found; lower --rate or raise --slo.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+# benchmarks/startup_bench.py
+"""
+Cold-start benchmark for the receiver.
+
+1. Import profile: `python -X importtime -c "import receiver"` in a fresh
+   interpreter, with the slowest top-level imports, plus the import time of the
+   model SDKs (vertexai, google.adk) that are deferred until the first agent is built.
+2. Cold starts: launches `uvicorn receiver:app` once per trial and AGENT_WARMUP
+   mode and polls /health, reporting the time until it first answers (when a
+   Gitea delivery could be acknowledged) and until the agent pools are built.
+
+Gitea gives up on a webhook delivery after [webhook] DELIVER_TIMEOUT (5s by
+default); `--deadline` flags modes whose time to first response exceeds it.
+
+Usage:
+    python benchmarks/startup_bench.py --trials 5
+    python benchmarks/startup_bench.py --modes startup,background --json
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+import httpx
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SDK_MODULES = ('vertexai.preview.reasoning_engines', 'google.adk.agents')
+
+
+def bench_environment(state_dir: str, mode: str | None = None) -> dict:
+    """Throwaway state so trials don't share a queue or review store."""
+    env = dict(os.environ)
+    env.setdefault('GITEA_URL', 'http://127.0.0.1:9')  # never contacted: no webhooks are sent
+    env.setdefault('GITEA_API_TOKEN', 'startup-bench-token')
+    env['JOB_QUEUE_BACKEND'] = 'sqlite'
+    env['JOB_QUEUE_PATH'] = os.path.join(state_dir, 'jobs.sqlite3')
+    env['REVIEW_STORE_PATH'] = os.path.join(state_dir, 'state.sqlite3')
+    env.pop('PROMETHEUS_MULTIPROC_DIR', None)
+    if mode:
+        env['AGENT_WARMUP'] = mode
+    return env
+
+
+# --- Import Profile ---
+def import_profile(modules: tuple[str, ...], env: dict) -> tuple[float, list[tuple[str, float]]] | None:
+    """
+    Seconds to import `modules` in a fresh interpreter, and (module, cumulative
+    seconds) for each import they make directly. None if the import fails.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', '; '.join(f"import {m}" for m in modules)],
+                            cwd=REPO_DIR, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    # Importing a.b.c also imports a and a.b, each reported at the top level
+    wanted = {module.rsplit('.', cut)[0] for module in modules for cut in range(module.count('.') + 1)}
+    total, direct, pending = 0.0, [], []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        seconds = int(cumulative) / 1e6
+        # Nested imports are indented by depth and printed before the module that made them
+        if depth == 0:
+            if name.strip() in wanted:
+                total += seconds
+                direct += pending
+            pending = []
+        elif depth == 1:
+            pending.append((name.strip(), seconds))
+    return total, direct
+
+
+# --- Cold Starts ---
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def cold_start(mode: str, timeout: float) -> dict:
+    """Seconds from process spawn until /health answers and until agent warm-up finished."""
+    state_dir = tempfile.mkdtemp(prefix='prreviewbot-startup-')
+    port = _free_port()
+    start = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'receiver:app', '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning'],
+        cwd=REPO_DIR, env=bench_environment(state_dir, mode), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    result = {'mode': mode, 'first_response_s': None, 'agents_ready_s': None, 'warmup': None}
+    try:
+        with httpx.Client(timeout=1) as client:
+            while time.monotonic() - start < timeout and process.poll() is None:
+                try:
+                    health = client.get(f"http://127.0.0.1:{port}/health").json()
+                except httpx.HTTPError:
+                    time.sleep(0.01)
+                    continue
+                elapsed = time.monotonic() - start
+                if result['first_response_s'] is None:
+                    result['first_response_s'] = elapsed
+                result['warmup'] = health.get('agent_warmup')
+                if result['warmup'] in ('done', 'partial', 'failed', 'lazy'):
+                    if result['warmup'] == 'done':
+                        result['agents_ready_s'] = elapsed
+                    break
+                time.sleep(0.01)
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+    return result
+
+
+def summarize(trials: list[dict], deadline: float) -> dict:
+    def stats(key):
+        values = [t[key] for t in trials if t[key] is not None]
+        return {'median': statistics.median(values), 'max': max(values)} if values else None
+    first_response = stats('first_response_s')
+    return {
+        'trials': len(trials),
+        'first_response_s': first_response,
+        'agents_ready_s': stats('agents_ready_s'),
+        'warmup': sorted({t['warmup'] for t in trials if t['warmup']}),
+        'within_deadline': bool(first_response) and first_response['max'] <= deadline,
+    }
+
+
+# --- Entry Point ---
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trials', type=int, default=3, help='cold starts per mode')
+    parser.add_argument('--modes', default='startup,background,lazy', help='AGENT_WARMUP modes to compare')
+    parser.add_argument('--deadline', type=float, default=5.0, help="Gitea's webhook delivery timeout, seconds")
+    parser.add_argument('--timeout', type=float, default=120.0, help='give up on a cold start after this long')
+    parser.add_argument('--top', type=int, default=8, help='slowest top-level imports to list')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    env = bench_environment(tempfile.mkdtemp(prefix='prreviewbot-startup-'))
+    receiver_imports = import_profile(('receiver',), env)
+    sdk_imports = import_profile(SDK_MODULES, env)
+    report = {
+        'import_receiver_s': receiver_imports[0] if receiver_imports else None,
+        'slowest_imports': sorted(receiver_imports[1], key=lambda i: i[1], reverse=True)[:args.top] if receiver_imports else [],
+        'deferred_sdk_import_s': sdk_imports[0] if sdk_imports else None,
+        'modes': {},
+    }
+    for mode in (m.strip() for m in args.modes.split(',') if m.strip()):
+        report['modes'][mode] = summarize([cold_start(mode, args.timeout) for _ in range(args.trials)], args.deadline)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    if report['import_receiver_s'] is None:
+        print("import receiver failed; run it directly to see the error")
+    else:
+        print(f"import receiver: {report['import_receiver_s']:.3f}s; slowest top-level imports:")
+        for name, seconds in report['slowest_imports']:
+            print(f"  {name:<32}{seconds:>8.3f}s")
+    deferred = report['deferred_sdk_import_s']
+    print(f"deferred SDK import ({', '.join(SDK_MODULES)}): "
+          + (f"{deferred:.3f}s" if deferred is not None else "not importable here"))
+    print(f"  {'AGENT_WARMUP':<14}{'first response (median/max)':>30}{'agents ready (median/max)':>30}")
+    for mode, summary in report['modes'].items():
+        cells = []
+        for key in ('first_response_s', 'agents_ready_s'):
+            value = summary[key]
+            cells.append(f"{value['median']:.2f}s / {value['max']:.2f}s" if value else '-')
+        flag = '' if summary['within_deadline'] else f"  exceeds {args.deadline:g}s deadline"
+        print(f"  {mode:<14}{cells[0]:>30}{cells[1]:>30}{flag}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# benchmarks/trace_report.py
+"""
+Summarizes spans written by the file trace exporter (TRACE_EXPORTER=file).
+
+Prints p50/p95/p99/max duration per span name, then the slowest traces
+(webhook receipt until the last span ended) with the time spent in each
+stage, to show which stage the tail latency comes from.
+
+Usage:
+    TRACE_EXPORTER=file TRACE_FILE=/tmp/traces.jsonl gunicorn ... receiver:app
+    python benchmarks/trace_report.py /tmp/traces.jsonl --slowest 5
+    python benchmarks/replay_bench.py --trace /tmp/traces.jsonl   # runs this at the end
+"""
+import json
+import argparse
+
+# Direct children of a review job, in pipeline order
+STAGES = ('diff.fetch', 'prefilter', 'token_plan', 'analysis', 'comment.post')
+
+
+def load_spans(path: str) -> list[dict]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered) + 0.5) - 1))]
+
+
+def by_name(spans: list[dict]) -> dict[str, dict]:
+    durations = {}
+    for span in spans:
+        if span.get('duration_s') is not None:
+            durations.setdefault(span['name'], []).append(span['duration_s'])
+    return {
+        name: {'count': len(values), **{f"p{p}": percentile(values, p) for p in (50, 95, 99)}, 'max': max(values)}
+        for name, values in sorted(durations.items())
+    }
+
+
+def slowest_traces(spans: list[dict], limit: int) -> list[dict]:
+    """Traces that reached a review job, slowest first, with per-stage durations."""
+    traces = {}
+    for span in spans:
+        traces.setdefault(span['trace_id'], []).append(span)
+    reports = []
+    for trace_id, members in traces.items():
+        jobs = [s for s in members if s['name'] == 'review.job']
+        if not jobs:
+            continue
+        job_ids = {s['span_id'] for s in jobs}
+        stages = {}
+        for span in members:
+            if span['parent_id'] in job_ids and span['name'] in STAGES:
+                stages[span['name']] = stages.get(span['name'], 0.0) + span['duration_s']
+        stages['queue.wait'] = sum(s['duration_s'] for s in members if s['name'] == 'queue.wait')
+        model_calls = [s for s in members if s['name'] == 'model.call']
+        reports.append({
+            'trace_id': trace_id,
+            'repo': jobs[-1]['attributes'].get('repo'), 'pr': jobs[-1]['attributes'].get('pr'),
+            'total_s': (max(s['end_ns'] for s in members) - min(s['start_ns'] for s in members)) / 1e9,
+            'stages_s': stages,
+            'model_calls': len(model_calls),
+            'slowest_model_call_s': max((s['duration_s'] for s in model_calls), default=None),
+        })
+    return sorted(reports, key=lambda r: r['total_s'], reverse=True)[:limit]
+
+
+def print_report(path: str, slowest: int = 5):
+    spans = load_spans(path)
+    print(f"{len(spans)} spans from {path}")
+    print(f"  {'span':<26}{'count':>7}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for name, stats in by_name(spans).items():
+        print(f"  {name:<26}{stats['count']:>7}" + ''.join(f"{stats[k]:>9.3f}s" for k in ('p50', 'p95', 'p99', 'max')))
+    traces = slowest_traces(spans, slowest)
+    if traces:
+        print(f"Slowest {len(traces)} traces:")
+    for report in traces:
+        stages = ' '.join(f"{name}={seconds:.3f}s" for name, seconds in report['stages_s'].items())
+        slowest_call = report['slowest_model_call_s']
+        print(f"  {report['trace_id']} {report['repo']}#{report['pr']} total={report['total_s']:.3f}s {stages} "
+              f"model_calls={report['model_calls']}"
+              + (f" slowest_call={slowest_call:.3f}s" if slowest_call is not None else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help='JSONL file written by the file trace exporter')
+    parser.add_argument('--slowest', type=int, default=5, help='how many of the slowest traces to break down')
+    args = parser.parse_args()
+    print_report(args.path, args.slowest)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+# diff_parser.py
+import os
+import re
+import hashlib
+from fnmatch import fnmatch
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, Iterator
+
+# --- Configuration ---
+# Files matching these globs are not sent to the model; only their line counts are kept.
+DEFAULT_SKIP_GLOBS = (
+    '*.lock', 'pubspec.lock', 'package-lock.json', 'yarn.lock', 'pnpm-lock.yaml', 'Podfile.lock',
+    '*.g.dart', '*.freezed.dart', '*.mocks.dart', '*.pb.dart', '*.min.js', '*.min.css', '*.map',
+    '*.png', '*.jpg', '*.jpeg', '*.gif', '*.webp', '*.ico', '*.ttf', '*.otf', '*.woff', '*.woff2', '*.pdf',
+)
+DIFF_SKIP_GLOBS = tuple(
+    g.strip() for g in os.environ.get('DIFF_SKIP_GLOBS', ','.join(DEFAULT_SKIP_GLOBS)).split(',') if g.strip()
+)
+# Rough budget per model call; files larger than this are split by hunk
+DIFF_CHUNK_TOKEN_BUDGET = int(os.environ.get('DIFF_CHUNK_TOKEN_BUDGET', '24000'))
+
+# --- Unified Diff Model ---
+HUNK_HEADER_RE = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@(.*)$')
+
+
+@dataclass
+class Hunk:
+    """One `@@ ... @@` block of a file diff."""
+    header: str
+    lines: list[str] = field(default_factory=list)
+
+    def numbered_lines(self) -> Iterator[tuple[int | None, str]]:
+        """Yields (new-file line number, line); the number is None for removed and marker lines."""
+        match = HUNK_HEADER_RE.match(self.header)
+        new_line = int(match.group(3)) if match else None
+        for line in self.lines:
+            if new_line is None or line.startswith(('-', '\\', '...')):
+                yield None, line
+            else:
+                yield new_line, line
+                new_line += 1
+
+
+@dataclass
+class FileDiff:
+    """All hunks touching a single file, plus the `diff --git` header lines."""
+    path: str
+    old_path: str
+    header: list[str] = field(default_factory=list)
+    hunks: list[Hunk] = field(default_factory=list)
+    additions: int = 0
+    deletions: int = 0
+    is_binary: bool = False
+    skipped_reason: str | None = None   # Set when hunk bodies were dropped by the skip rules
+    skipped_chars: int = 0               # Size of those dropped hunk bodies
+    part: tuple[int, int] | None = None  # (index, total) when a large file was split into chunks
+    truncated: bool = False              # Hunks past the diff size limit were not read (for files after the cut, none were)
+
+    def render(self, numbered: bool = False) -> str:
+        """
+        Reassembles the file's unified diff text. With `numbered`, added and context
+        lines are prefixed with their line number in the new file (so review findings
+        can point at exact lines).
+        """
+        out = list(self.header)
+        for hunk in self.hunks:
+            out.append(hunk.header)
+            if numbered:
+                out.extend(f"{'' if n is None else n:>5} {line}" for n, line in hunk.numbered_lines())
+            else:
+                out.extend(hunk.lines)
+        return '\n'.join(out) + '\n'
+
+    def new_lines(self) -> list[int]:
+        """New-file line numbers that appear in the diff (added or context), i.e. the lines a review can comment on."""
+        return sorted({n for hunk in self.hunks for n, _ in hunk.numbered_lines() if n is not None})
+
+
+# --- Parsing ---
+def should_skip(path: str, skip_globs: Iterable[str] = DIFF_SKIP_GLOBS) -> str | None:
+    """Returns the matching skip glob for `path`, or None if the file should be reviewed."""
+    name = path.rsplit('/', 1)[-1]
+    for pattern in skip_globs:
+        if fnmatch(path, pattern) or fnmatch(name, pattern):
+            return pattern
+    return None
+
+
+class DiffParser:
+    """
+    Incremental unified-diff parser. Feed it lines one at a time; each call
+    returns the previous FileDiff once the next `diff --git` line starts a new file.
+    Call `close()` at the end to flush the last one.
+    Files for which `skip(path)` returns a reason (and binary files) keep their
+    line counts but not their hunk bodies, so lockfiles and generated code never
+    accumulate in memory. After `truncate()`, no more hunk bodies are kept at all:
+    the file being read and every later one are marked `truncated`.
+    """
+
+    def __init__(self, skip: Callable[[str], str | None] | None = should_skip):
+        self._current: FileDiff | None = None
+        self._skip = skip
+        self._in_body = False
+        self._truncated = False
+
+    def truncate(self):
+        """Stops keeping hunk bodies; the remaining files are only listed (path and line counts)."""
+        self._truncated = True
+        if self._current is not None:
+            self._current.truncated = True
+
+    def feed(self, line: str) -> FileDiff | None:
+        line = line.rstrip('\r\n')
+        if line.startswith('diff --git '):
+            finished = self._current
+            self._current = self._start_file(line)
+            self._current.truncated = self._truncated
+            self._in_body = False
+            return finished
+        if self._current is None:
+            return None  # Preamble before the first file header
+        current = self._current
+        in_body = self._in_body or current.skipped_reason is not None
+        if line.startswith('@@'):
+            if not in_body and self._skip:
+                current.skipped_reason = self._skip(current.path)
+            self._in_body = True
+            if current.skipped_reason is None:
+                if not current.truncated:
+                    current.hunks.append(Hunk(header=line))
+            else:
+                current.skipped_chars += len(line) + 1
+            return None
+        if in_body:
+            if line.startswith('+'):
+                current.additions += 1
+            elif line.startswith('-'):
+                current.deletions += 1
+            if current.skipped_reason is None:
+                if not current.truncated:
+                    current.hunks[-1].lines.append(line)
+            else:
+                current.skipped_chars += len(line) + 1
+            return None
+        current.header.append(line)
+        if line.startswith('Binary files ') or line == 'GIT binary patch':
+            current.is_binary = True
+            current.skipped_reason = 'binary'
+        elif line.startswith('+++ ') and line[4:] != '/dev/null':
+            current.path = _strip_prefix(line[4:])
+        elif line.startswith('--- ') and line[4:] != '/dev/null':
+            current.old_path = _strip_prefix(line[4:])
+        return None
+
+    def close(self) -> FileDiff | None:
+        finished, self._current = self._current, None
+        return finished
+
+    @staticmethod
+    def _start_file(line: str) -> FileDiff:
+        # "diff --git a/old b/new"; the ---/+++ lines refine this when present
+        parts = line[len('diff --git '):].split(' b/', 1)
+        old_path = _strip_prefix(parts[0])
+        new_path = parts[1] if len(parts) == 2 else old_path
+        return FileDiff(path=new_path, old_path=old_path, header=[line])
+
+
+def _strip_prefix(path: str) -> str:
+    path = path.split('\t', 1)[0]
+    return path[2:] if path[:2] in ('a/', 'b/') else path
+
+
+def parse_unified_diff(lines: Iterable[str], skip=should_skip) -> Iterator[FileDiff]:
+    """Yields one FileDiff per file in a unified diff."""
+    parser = DiffParser(skip=skip)
+    for line in lines:
+        finished = parser.feed(line)
+        if finished is not None:
+            yield finished
+    last = parser.close()
+    if last is not None:
+        yield last
+
+
+# --- Chunking ---
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token for code)."""
+    return len(text) // 4 + 1
+
+
+def chunk_file_diff(file_diff: FileDiff, token_budget: int = DIFF_CHUNK_TOKEN_BUDGET) -> list[FileDiff]:
+    """
+    Splits a file diff into parts that each fit `token_budget`, cutting only
+    between hunks. A single hunk larger than the budget is truncated with a marker.
+    Returns `[file_diff]` unchanged when it already fits.
+    """
+    if estimate_tokens(file_diff.render()) <= token_budget:
+        return [file_diff]
+
+    header_tokens = estimate_tokens('\n'.join(file_diff.header))
+    parts: list[list[Hunk]] = [[]]
+    used = header_tokens
+    for hunk in file_diff.hunks:
+        hunk_tokens = estimate_tokens(hunk.header + '\n' + '\n'.join(hunk.lines))
+        if hunk_tokens + header_tokens > token_budget:
+            hunk = _truncate_hunk(hunk, token_budget - header_tokens)
+            hunk_tokens = estimate_tokens(hunk.header + '\n' + '\n'.join(hunk.lines))
+        if parts[-1] and used + hunk_tokens > token_budget:
+            parts.append([])
+            used = header_tokens
+        parts[-1].append(hunk)
+        used += hunk_tokens
+
+    total = len(parts)
+    return [
+        FileDiff(path=file_diff.path, old_path=file_diff.old_path, header=list(file_diff.header), hunks=hunks,
+                 additions=file_diff.additions, deletions=file_diff.deletions, part=(i + 1, total))
+        for i, hunks in enumerate(parts)
+    ]
+
+
+def _truncate_hunk(hunk: Hunk, token_budget: int) -> Hunk:
+    kept, used = [], estimate_tokens(hunk.header)
+    for line in hunk.lines:
+        used += estimate_tokens(line)
+        if used > token_budget:
+            kept.append(f"... [{len(hunk.lines) - len(kept)} more lines truncated to fit the review budget]")
+            break
+        kept.append(line)
+    return Hunk(header=hunk.header, lines=kept)
+
+
+# --- Normalization ---
+def normalized_hunks(file_diff: FileDiff) -> str:
+    """
+    Canonical text of a file's changes, independent of where they sit in the file.
+    Drops `index` lines and hunk line numbers and trailing whitespace, so a rebase
+    that only shifts hunks yields the same text. Findings cached under it carry
+    line numbers, so they are stored with `hunk_starts` and re-based on reuse.
+    """
+    out = [f"path {file_diff.path}"]
+    for hunk in file_diff.hunks:
+        match = HUNK_HEADER_RE.match(hunk.header)
+        out.append('@@' + (match.group(5) if match else ''))
+        out.extend(line.rstrip() for line in hunk.lines)
+    return '\n'.join(out)
+
+
+def hunk_hash(file_diff: FileDiff) -> str:
+    return hashlib.sha256(normalized_hunks(file_diff).encode('utf-8')).hexdigest()
+
+
+def hunk_starts(file_diff: FileDiff) -> list[int]:
+    """New-file line number at which each hunk starts (0 for a malformed header)."""
+    return [int(m.group(3)) if (m := HUNK_HEADER_RE.match(hunk.header)) else 0 for hunk in file_diff.hunks]
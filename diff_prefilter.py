@@ -0,0 +1,137 @@
+# diff_prefilter.py
+import os
+import re
+from dataclasses import dataclass, field, replace
+
+from diff_parser import FileDiff, Hunk, estimate_tokens, should_skip
+
+# --- Configuration ---
+DIFF_PREFILTER_ENABLED = os.environ.get('DIFF_PREFILTER', '1').lower() not in ('0', 'false', 'no')
+# Languages where leading indentation is syntax: a re-indented line there is a code change
+INDENT_SENSITIVE_GLOBS = ('*.py', '*.pyi', '*.pyx', '*.yaml', '*.yml', '*.coffee', '*.haml', '*.pug',
+                          '*.sass', '*.nim', '*.mk', 'Makefile')
+
+# Hunk classes
+WHITESPACE_ONLY = 'whitespace'   # Same token sequence before and after (reformatting, blank lines)
+CODE = 'code'
+
+# One token each: a string or char literal (whitespace included), a word, a bracket or separator,
+# a run of other operator characters (so `i++ + j` and `i + ++j` differ), or a stray quote
+_TOKEN_RE = re.compile(
+    r'''"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|`(?:\\.|[^`\\])*`|\w+|[()\[\]{},;]|[^\s\w"'`()\[\]{},;]+|["'`]'''
+)
+
+
+@dataclass
+class PrefilterResult:
+    """What is left to review after the static pre-filter, and what was set aside."""
+    files: list[FileDiff]
+    summary: list[str] = field(default_factory=list)  # One line per file not (fully) sent to the model
+    tokens_before: int = 0
+    tokens_after: int = 0
+    dropped_hunks: int = 0
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_before - self.tokens_after
+
+    @property
+    def has_reviewable_changes(self) -> bool:
+        return any(f.hunks for f in self.files)
+
+    def render_summary(self) -> str:
+        """Collapsed Markdown list of what the model did not see (empty if nothing was set aside)."""
+        if not self.summary:
+            return ""
+        return (
+            f"<details><summary>Set aside before the AI review: {len(self.summary)} "
+            f"file{'s' if len(self.summary) != 1 else ''} (~{self.tokens_saved:,} tokens)</summary>\n\n"
+            + '\n'.join(self.summary) + "\n</details>"
+        )
+
+
+def _tokens(text: str) -> list[str]:
+    return _TOKEN_RE.findall(text)
+
+
+def _normalized(lines: list[str], indent_sensitive: bool) -> list:
+    if not indent_sensitive:
+        return _tokens('\n'.join(line[1:] for line in lines))
+    # One entry per non-blank line, so re-indenting or re-wrapping a line is not whitespace-only
+    return [(code[:len(code) - len(code.lstrip())], _tokens(code))
+            for code in (line[1:] for line in lines) if code.strip()]
+
+
+def classify_hunk(hunk: Hunk, path: str = '') -> str:
+    """
+    WHITESPACE_ONLY when the removed and added lines contain the same token sequence,
+    i.e. only whitespace between tokens changed (indentation, reflowed arguments, blank
+    lines); CODE otherwise. Whitespace that separates two tokens is never dropped.
+    Whitespace inside string and char literals always counts, and so does each line's
+    indentation in indentation-sensitive languages (`path` matches INDENT_SENSITIVE_GLOBS).
+    """
+    removed = [line for line in hunk.lines if line.startswith('-')]
+    added = [line for line in hunk.lines if line.startswith('+')]
+    indent_sensitive = bool(path) and should_skip(path, INDENT_SENSITIVE_GLOBS) is not None
+    if (removed or added) and _normalized(removed, indent_sensitive) == _normalized(added, indent_sensitive):
+        return WHITESPACE_ONLY
+    return CODE
+
+
+def _is_deleted_file(file_diff: FileDiff) -> bool:
+    return any(line.startswith('deleted file mode') or line == '+++ /dev/null' for line in file_diff.header)
+
+
+def _file_tokens(file_diff: FileDiff) -> int:
+    if file_diff.hunks:
+        return estimate_tokens(file_diff.render())
+    return file_diff.skipped_chars // 4 if file_diff.skipped_chars else 0
+
+
+def prefilter_diff(files: list[FileDiff], enabled: bool = DIFF_PREFILTER_ENABLED,
+                   keep_globs: tuple[str, ...] = ()) -> PrefilterResult:
+    """
+    Cheap local pass over a PR before any model call:
+      - files dropped by the skip rules (lockfiles, generated Dart, assets, binaries) become summary lines,
+      - deleted files become summary lines (there is no new code to review),
+      - whitespace-only hunks are dropped, except in files matching `keep_globs`;
+        a file left without hunks becomes a summary line.
+    Everything else is passed through unchanged. Token counts are estimates of the
+    full diff versus what is left for the model. `enabled=False` (DIFF_PREFILTER=0
+    or a profile's `prefilter: false`) passes every file through.
+    """
+    if not enabled:
+        return PrefilterResult(files=list(files))
+    result = PrefilterResult(files=[])
+    for file_diff in files:
+        tokens = _file_tokens(file_diff)
+        result.tokens_before += tokens
+        counts = f"+{file_diff.additions}/-{file_diff.deletions}"
+
+        if file_diff.skipped_reason:
+            reason = 'binary file' if file_diff.skipped_reason == 'binary' else f"matches `{file_diff.skipped_reason}`"
+            result.summary.append(f"- `{file_diff.path}` ({counts}): {reason}")
+            continue
+        if not file_diff.hunks:
+            continue  # Renames and mode changes without content
+        if _is_deleted_file(file_diff):
+            result.summary.append(f"- `{file_diff.old_path}` (-{file_diff.deletions}): file deleted")
+            continue
+
+        if keep_globs and should_skip(file_diff.path, keep_globs):
+            kept = file_diff.hunks
+        else:
+            kept = [hunk for hunk in file_diff.hunks if classify_hunk(hunk, file_diff.path) != WHITESPACE_ONLY]
+        dropped = len(file_diff.hunks) - len(kept)
+        result.dropped_hunks += dropped
+        if not kept:
+            result.summary.append(f"- `{file_diff.path}` ({counts}): formatting/whitespace-only changes")
+            continue
+        if dropped:
+            file_diff = replace(file_diff, hunks=kept)
+            result.summary.append(
+                f"- `{file_diff.path}`: {dropped} formatting/whitespace-only hunk{'s' if dropped != 1 else ''} skipped"
+            )
+        result.files.append(file_diff)
+        result.tokens_after += estimate_tokens(file_diff.render())
+    return result
@@ -1,11 +1,20 @@
 # gitea_tools.py
 import os
-import requests
+import time
+import codecs
+import random
+import asyncio
 import logging # Import logging
+import threading
+from functools import partial
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit, quote
 
-# --- Configuration ---
-# Set up basic logging if not already done elsewhere
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+import httpx
+
+import metrics
+import tracing
+from diff_parser import FileDiff, DiffParser, should_skip, DIFF_SKIP_GLOBS
 
 # --- Define Secret Paths ---
 GITEA_API_TOKEN_PATH = "/etc/gitea-api-token/secret"
@@ -36,6 +45,26 @@ GITEA_API_TOKEN = read_secret_from_file(GITEA_API_TOKEN_PATH) or os.environ.get(
 # Gitea URL still comes directly from environment variable (not a secret)
 GITEA_URL = os.environ.get('GITEA_URL') # e.g., https://gitea.yourdomain.com
 
+# Stop keeping a PR diff's hunks beyond this many bytes; the files parsed so far are still
+# reviewed and the rest are listed in the review as not reviewed
+DIFF_MAX_BYTES = int(os.environ.get('DIFF_MAX_BYTES', str(20 * 1024 * 1024)))
+DIFF_STREAM_CHUNK_BYTES = 64 * 1024
+
+# HTTP client tuning: connections are pooled and kept alive across all reviews in the process
+GITEA_MAX_CONNECTIONS = int(os.environ.get('GITEA_MAX_CONNECTIONS', '20'))
+GITEA_MAX_CONCURRENCY_PER_HOST = int(os.environ.get('GITEA_MAX_CONCURRENCY_PER_HOST', '8'))
+GITEA_MAX_RETRIES = int(os.environ.get('GITEA_MAX_RETRIES', '4'))
+GITEA_BACKOFF_BASE_SECONDS = float(os.environ.get('GITEA_BACKOFF_BASE_SECONDS', '0.5'))
+GITEA_BACKOFF_MAX_SECONDS = float(os.environ.get('GITEA_BACKOFF_MAX_SECONDS', '30'))
+GITEA_TIMEOUT_SECONDS = float(os.environ.get('GITEA_TIMEOUT_SECONDS', '30'))
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# Methods whose requests can be resent blindly; a PATCH here only ever rewrites a comment body
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PATCH', 'DELETE'}
+# A POST may already have been applied when it fails, so it is only resent when the
+# request never reached Gitea, or when Gitea turned it away and said when to retry
+UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+POST_RETRY_STATUS_CODES = {429, 503}
+
 # --- Validate Configuration ---
 if not GITEA_API_TOKEN:
     logging.error("CRITICAL: GITEA_API_TOKEN is not configured (checked file path and environment variable).")
@@ -46,60 +75,384 @@ if not GITEA_URL:
     # raise ValueError("GITEA_URL must be set")
 
 
-# --- Gitea API Functions ---
-def get_gitea_pr_diff(repo_full_name: str, pr_index: int) -> str | None:
-    """Fetches the diff content for a Gitea Pull Request."""
+# --- Gitea Client ---
+class GiteaClient:
+    """
+    Async Gitea API client on one pooled, keep-alive httpx.AsyncClient.
+    All requests to a host share at most `per_host_limit` concurrent slots.
+    Transport errors and 429/5xx responses are retried with exponential backoff
+    and full jitter, honoring Retry-After when Gitea sends it. Non-idempotent
+    requests (POST) are only retried when they were never sent (connection
+    errors) or were rejected with 429/503 and a Retry-After header, so a comment
+    or review is never posted twice.
+    """
+
+    def __init__(self, base_url: str | None = GITEA_URL, token: str | None = GITEA_API_TOKEN,
+                 max_connections: int = GITEA_MAX_CONNECTIONS,
+                 per_host_limit: int = GITEA_MAX_CONCURRENCY_PER_HOST,
+                 max_retries: int = GITEA_MAX_RETRIES):
+        self.base_url = (base_url or '').rstrip('/')
+        self.token = token
+        self.max_connections = max_connections
+        self.per_host_limit = per_host_limit
+        self.max_retries = max_retries
+        self._http: httpx.AsyncClient | None = None
+        self._host_slots: dict[str, asyncio.Semaphore] = {}
+
+    def _client(self) -> httpx.AsyncClient:
+        # Created lazily so it binds to the event loop it is used from
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                headers={'Authorization': f'token {self.token}'},
+                timeout=GITEA_TIMEOUT_SECONDS,
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections,
+                                    keepalive_expiry=60),
+            )
+        return self._http
+
+    def _slot(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        if host not in self._host_slots:
+            self._host_slots[host] = asyncio.Semaphore(self.per_host_limit)
+        return self._host_slots[host]
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}/api/v1/{path.lstrip('/')}"
+
+    def _retry_delay(self, attempt: int, response: httpx.Response | None = None) -> float:
+        if response is not None and 'Retry-After' in response.headers:
+            retry_after = response.headers['Retry-After']
+            try:
+                return min(GITEA_BACKOFF_MAX_SECONDS, max(0.0, float(retry_after)))
+            except ValueError:
+                try:
+                    return min(GITEA_BACKOFF_MAX_SECONDS,
+                               max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time()))
+                except (TypeError, ValueError):
+                    pass
+        # Full jitter: uniform in [0, min(cap, base * 2^attempt)]
+        return random.uniform(0, min(GITEA_BACKOFF_MAX_SECONDS, GITEA_BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+    @staticmethod
+    def _should_retry(method: str, error: httpx.HTTPError) -> bool:
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        if isinstance(error, httpx.HTTPStatusError):
+            if idempotent:
+                return error.response.status_code in RETRY_STATUS_CODES
+            return error.response.status_code in POST_RETRY_STATUS_CODES and 'Retry-After' in error.response.headers
+        return idempotent or isinstance(error, UNSENT_ERRORS)
+
+    async def _retrying(self, method: str, url: str, attempt_fn):
+        """Runs `attempt_fn()` (one request, under the host slot) until it succeeds or retries run out."""
+        with tracing.span('gitea.request', method=method, path=urlsplit(url).path) as span:
+            for attempt in range(self.max_retries + 1):
+                response = None
+                try:
+                    async with self._slot(url):
+                        return await attempt_fn()
+                except httpx.HTTPStatusError as e:
+                    span.set(status_code=e.response.status_code)
+                    if not self._should_retry(method, e) or attempt == self.max_retries:
+                        raise
+                    response = e.response
+                    reason = f"HTTP {e.response.status_code}"
+                except httpx.TransportError as e:
+                    if not self._should_retry(method, e) or attempt == self.max_retries:
+                        raise
+                    reason = type(e).__name__
+                delay = self._retry_delay(attempt, response)
+                span.event('retry', attempt=attempt + 1, reason=reason, delay_s=delay)
+                logging.warning(f"Gitea {method} {url} failed ({reason}); retry {attempt + 1}/{self.max_retries} in {delay:.2f}s.")
+                await asyncio.sleep(delay)
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """Sends a request with retries. Raises httpx.HTTPStatusError / httpx.TransportError on failure."""
+        async def attempt():
+            response = await self._client().request(method, url, **kwargs)
+            response.raise_for_status()
+            return response
+        return await self._retrying(method, url, attempt)
+
+    async def get_pr_diff(self, repo_full_name: str, pr_index: int) -> str:
+        response = await self.request('GET', self.url(f"repos/{repo_full_name}/pulls/{pr_index}.diff"))
+        return response.text
+
+    async def get_pr_diff_files(self, repo_full_name: str, pr_index: int, max_bytes: int = DIFF_MAX_BYTES,
+                                skip_globs: tuple[str, ...] = DIFF_SKIP_GLOBS) -> list[FileDiff]:
+        diff_url = self.url(f"repos/{repo_full_name}/pulls/{pr_index}.diff")
+        return await self._stream_diff_files(diff_url, repo_full_name, f"{repo_full_name} PR #{pr_index}", max_bytes, skip_globs)
+
+    async def is_ancestor(self, repo_full_name: str, ancestor_sha: str, head_sha: str) -> bool:
+        """
+        True if `ancestor_sha` is reachable from `head_sha`, i.e. the push only added commits.
+        Compares head...ancestor: from their merge base, the ancestor side has no
+        commits of its own exactly when it is an ancestor. An unknown SHA (e.g. one
+        dropped by a force-push) counts as not an ancestor.
+        """
+        try:
+            response = await self.request('GET', self.url(f"repos/{repo_full_name}/compare/{head_sha}...{ancestor_sha}"))
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code in (404, 422):
+                return False
+            raise
+        return response.json().get('total_commits', -1) == 0
+
+    async def get_compare_diff_files(self, repo_full_name: str, base_sha: str, head_sha: str, max_bytes: int = DIFF_MAX_BYTES,
+                                     skip_globs: tuple[str, ...] = DIFF_SKIP_GLOBS) -> list[FileDiff]:
+        """Streams the diff of `base_sha...head_sha` (the commits added on top of base)."""
+        # The v1 API has no raw compare diff; the web route accepts the same token
+        diff_url = f"{self.base_url}/{repo_full_name}/compare/{base_sha}...{head_sha}.diff"
+        return await self._stream_diff_files(diff_url, repo_full_name, f"{repo_full_name} {base_sha[:12]}...{head_sha[:12]}", max_bytes, skip_globs)
+
+    async def get_raw_file(self, repo_full_name: str, path: str, etag: str | None = None) -> httpx.Response:
+        """
+        Fetches a file from the default branch. With `etag`, Gitea answers 304 when
+        the file is unchanged; 304 and 404 responses are returned, not raised.
+        """
+        headers = {'If-None-Match': etag} if etag else {}
+        try:
+            return await self.request('GET', self.url(f"repos/{repo_full_name}/raw/{quote(path)}"), headers=headers)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code in (304, 404):
+                return e.response
+            raise
+
+    async def _stream_diff_files(self, diff_url: str, repo_full_name: str, label: str, max_bytes: int,
+                                 skip_globs: tuple[str, ...] = DIFF_SKIP_GLOBS) -> list[FileDiff]:
+        """
+        Streams a `.diff` into per-file hunk objects without holding the body in
+        memory: it is read in chunks and parsed incrementally, and skip-listed files
+        (`skip_globs`: lockfiles, generated code, binaries) keep only their line counts.
+        Once `max_bytes` have been received, no more hunks are kept: the file being
+        read and all later ones come back with `truncated` set (later ones without
+        hunks), so the review can name what it did not see. Gitea's own diff limits
+        bound how much is read after that. A failed stream is retried whole.
+        """
+        async def attempt():
+            files = []
+            parser = DiffParser(skip=partial(should_skip, skip_globs=skip_globs))
+            received = 0
+            truncated = False
+            pending = ''
+            async with self._client().stream('GET', diff_url) as response:
+                response.raise_for_status()
+                decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+                async for raw in response.aiter_bytes(DIFF_STREAM_CHUNK_BYTES):
+                    received += len(raw)
+                    *lines, pending = (pending + decoder.decode(raw)).split('\n')
+                    for line in lines:
+                        finished = parser.feed(line)
+                        if finished is not None:
+                            files.append(finished)
+                    if not truncated and received >= max_bytes:
+                        logging.warning(f"Diff for {label} exceeds {max_bytes} bytes. Listing the remaining files without their hunks.")
+                        parser.truncate()
+                        truncated = True
+                pending += decoder.decode(b'', final=True)
+            if pending:
+                finished = parser.feed(pending)
+                if finished is not None:
+                    files.append(finished)
+            last = parser.close()
+            if last is not None:
+                files.append(last)
+            logging.info(f"Diff streamed successfully ({received} bytes, {len(files)} files)")
+            metrics.DIFF_BYTES.labels(repo=repo_full_name).observe(received)
+            return files
+
+        logging.info(f"Streaming diff from {diff_url}")
+        return await self._retrying('GET', diff_url, attempt)
+
+    async def post_comment(self, repo_full_name: str, pr_index: int, body: str) -> dict:
+        # Note: PRs are often treated as issues for commenting
+        response = await self.request('POST', self.url(f"repos/{repo_full_name}/issues/{pr_index}/comments"),
+                                      json={'body': body})
+        return response.json()
+
+    async def edit_comment(self, repo_full_name: str, comment_id: int, body: str) -> dict:
+        response = await self.request('PATCH', self.url(f"repos/{repo_full_name}/issues/comments/{comment_id}"),
+                                      json={'body': body})
+        return response.json()
+
+    async def delete_comment(self, repo_full_name: str, comment_id: int):
+        await self.request('DELETE', self.url(f"repos/{repo_full_name}/issues/comments/{comment_id}"))
+
+    async def post_review(self, repo_full_name: str, pr_index: int, body: str, comments: list[dict],
+                          commit_id: str | None = None) -> dict:
+        """Submits a pull review with all inline comments in a single request."""
+        payload = {'body': body, 'event': 'COMMENT', 'comments': comments}
+        if commit_id:
+            payload['commit_id'] = commit_id
+        response = await self.request('POST', self.url(f"repos/{repo_full_name}/pulls/{pr_index}/reviews"),
+                                      json=payload)
+        return response.json()
+
+    async def aclose(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+
+# --- Shared Client Loop ---
+# The review workers are plain threads, so the shared client lives on one
+# background event loop and the functions below submit coroutines to it.
+# All worker threads therefore share the same warm connection pool.
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_lock = threading.Lock()
+gitea_client = GiteaClient()
+
+def _run(coro):
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='gitea-client-loop', daemon=True).start()
+    # Tasks on the loop don't inherit the caller's context; carry its span over explicitly
+    return asyncio.run_coroutine_threadsafe(tracing.bind(coro, tracing.current()), _loop).result()
+
+
+def _log_http_error(action: str, repo_full_name: str, pr_index: int, e: httpx.HTTPError):
+    logging.error(f"Failed to {action} for {repo_full_name} PR #{pr_index}: {e}")
+    response = getattr(e, 'response', None) if isinstance(e, httpx.HTTPStatusError) else None
+    if response is not None:
+        logging.error(f"Gitea API Response: {response.status_code} - {response.text[:500]}...") # Log part of response
+
+
+def _check_config(function_name: str, repo_full_name: str) -> bool:
     # Check again inside function in case loading failed silently
     if not GITEA_URL or not GITEA_API_TOKEN:
-        logging.error("GITEA_URL or GITEA_API_TOKEN not available in get_gitea_pr_diff.")
-        return None
-
+        logging.error(f"GITEA_URL or GITEA_API_TOKEN not available in {function_name}.")
+        return False
     # Ensure repo_full_name is owner/repo format
     if '/' not in repo_full_name:
          logging.error(f"Invalid repo_full_name format: {repo_full_name}")
-         return None
+         return False
+    return True
 
-    diff_url = f"{GITEA_URL}/api/v1/repos/{repo_full_name}/pulls/{pr_index}.diff"
-    headers = {'Authorization': f'token {GITEA_API_TOKEN}'} # Use the loaded token
 
+# --- Gitea API Functions ---
+def get_gitea_pr_diff(repo_full_name: str, pr_index: int) -> str | None:
+    """Fetches the diff content for a Gitea Pull Request."""
+    if not _check_config('get_gitea_pr_diff', repo_full_name):
+        return None
     try:
-        logging.info(f"Fetching diff from {diff_url}")
-        response = requests.get(diff_url, headers=headers, timeout=30)
-        response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
-        logging.info(f"Diff fetched successfully (Status: {response.status_code})")
-        return response.text
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Failed to fetch Gitea PR diff for {repo_full_name} PR #{pr_index}: {e}")
+        return _run(gitea_client.get_pr_diff(repo_full_name, pr_index))
+    except httpx.HTTPError as e:
+        _log_http_error('fetch Gitea PR diff', repo_full_name, pr_index, e)
         return None
 
+
+def get_gitea_pr_diff_files(repo_full_name: str, pr_index: int,
+                            skip_globs: tuple[str, ...] = DIFF_SKIP_GLOBS) -> list[FileDiff] | None:
+    """Fetches a PR diff as parsed per-file hunks. Returns None on failure."""
+    if not _check_config('get_gitea_pr_diff_files', repo_full_name):
+        return None
+    try:
+        return _run(gitea_client.get_pr_diff_files(repo_full_name, pr_index, skip_globs=skip_globs))
+    except httpx.HTTPError as e:
+        _log_http_error('fetch Gitea PR diff', repo_full_name, pr_index, e)
+        return None
+
+
 def post_gitea_comment(repo_full_name: str, pr_index: int, comment_body: str) -> bool:
     """Posts a comment to a Gitea Pull Request."""
-    # Check again inside function
-    if not GITEA_URL or not GITEA_API_TOKEN:
-        logging.error("GITEA_URL or GITEA_API_TOKEN not available in post_gitea_comment.")
+    if not _check_config('post_gitea_comment', repo_full_name):
+        return False
+    try:
+        logging.info(f"Posting comment to PR #{pr_index} in {repo_full_name}")
+        _run(gitea_client.post_comment(repo_full_name, pr_index, comment_body))
+        logging.info("Comment posted successfully")
+        return True
+    except httpx.HTTPError as e:
+        _log_http_error('post Gitea comment', repo_full_name, pr_index, e)
         return False
 
-    # Ensure repo_full_name is owner/repo format
-    if '/' not in repo_full_name:
-         logging.error(f"Invalid repo_full_name format: {repo_full_name}")
-         return False
 
-    # Note: PRs are often treated as issues for commenting
-    comment_url = f"{GITEA_URL}/api/v1/repos/{repo_full_name}/issues/{pr_index}/comments"
-    headers = {
-        'Authorization': f'token {GITEA_API_TOKEN}', # Use the loaded token
-        'Content-Type': 'application/json'
-    }
-    payload = {'body': comment_body}
+def create_gitea_comment(repo_full_name: str, pr_index: int, comment_body: str) -> int | None:
+    """Posts a comment to a Gitea Pull Request and returns its id (for later edits), or None on failure."""
+    if not _check_config('create_gitea_comment', repo_full_name):
+        return None
+    try:
+        return _run(gitea_client.post_comment(repo_full_name, pr_index, comment_body)).get('id')
+    except httpx.HTTPError as e:
+        _log_http_error('post Gitea comment', repo_full_name, pr_index, e)
+        return None
 
+
+def edit_gitea_comment(repo_full_name: str, comment_id: int, comment_body: str) -> bool:
+    """Replaces the body of an existing comment."""
+    if not _check_config('edit_gitea_comment', repo_full_name):
+        return False
     try:
-        logging.info(f"Posting comment to PR #{pr_index} in {repo_full_name}")
-        response = requests.post(comment_url, headers=headers, json=payload, timeout=30)
-        response.raise_for_status()
-        logging.info(f"Comment posted successfully (Status: {response.status_code})")
+        _run(gitea_client.edit_comment(repo_full_name, comment_id, comment_body))
         return True
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Failed to post Gitea comment for {repo_full_name} PR #{pr_index}: {e}")
-        if hasattr(e, 'response') and e.response is not None:
-             logging.error(f"Gitea API Response: {e.response.status_code} - {e.response.text[:500]}...") # Log part of response
-        return False
\ No newline at end of file
+    except httpx.HTTPError as e:
+        logging.error(f"Failed to edit comment {comment_id} in {repo_full_name}: {e}")
+        return False
+
+
+def delete_gitea_comment(repo_full_name: str, comment_id: int) -> bool:
+    if not _check_config('delete_gitea_comment', repo_full_name):
+        return False
+    try:
+        _run(gitea_client.delete_comment(repo_full_name, comment_id))
+        return True
+    except httpx.HTTPError as e:
+        logging.error(f"Failed to delete comment {comment_id} in {repo_full_name}: {e}")
+        return False
+
+
+def post_gitea_review(repo_full_name: str, pr_index: int, body: str, comments: list[dict],
+                      commit_id: str | None = None) -> bool:
+    """Posts a review (summary body plus inline comments) to a Gitea Pull Request in one request."""
+    if not _check_config('post_gitea_review', repo_full_name):
+        return False
+    try:
+        logging.info(f"Posting review with {len(comments)} inline comments to PR #{pr_index} in {repo_full_name}")
+        _run(gitea_client.post_review(repo_full_name, pr_index, body, comments, commit_id))
+        logging.info("Review posted successfully")
+        return True
+    except httpx.HTTPError as e:
+        _log_http_error('post Gitea review', repo_full_name, pr_index, e)
+        return False
+
+
+def get_gitea_incremental_diff_files(repo_full_name: str, pr_index: int, base_sha: str, head_sha: str,
+                                     skip_globs: tuple[str, ...] = DIFF_SKIP_GLOBS) -> list[FileDiff] | None:
+    """
+    Fetches only the changes pushed on top of `base_sha` (a previously reviewed head).
+    Returns None when history was rewritten (base is no longer an ancestor of head)
+    or the range diff can't be fetched; callers then fall back to the full PR diff.
+    """
+    if not _check_config('get_gitea_incremental_diff_files', repo_full_name):
+        return None
+    try:
+        if not _run(gitea_client.is_ancestor(repo_full_name, base_sha, head_sha)):
+            logging.info(f"{base_sha[:12]} is not an ancestor of {head_sha[:12]} in {repo_full_name} (history rewritten).")
+            return None
+        return _run(gitea_client.get_compare_diff_files(repo_full_name, base_sha, head_sha, skip_globs=skip_globs))
+    except httpx.HTTPError as e:
+        _log_http_error('fetch incremental diff', repo_full_name, pr_index, e)
+        return None
+
+
+def get_gitea_repo_file(repo_full_name: str, path: str, etag: str | None = None) -> tuple[int, str | None, str | None] | None:
+    """
+    Conditionally fetches `path` from the repository's default branch.
+    Returns (status, text, etag): (200, text, etag) for the current content,
+    (304, None, etag) when it still matches `etag`, (404, None, None) when the
+    file does not exist, or None when Gitea could not be reached.
+    """
+    if not _check_config('get_gitea_repo_file', repo_full_name):
+        return None
+    try:
+        response = _run(gitea_client.get_raw_file(repo_full_name, path, etag))
+    except httpx.HTTPError as e:
+        logging.error(f"Failed to fetch '{path}' from {repo_full_name}: {e}")
+        return None
+    if response.status_code == 404:
+        return 404, None, None
+    if response.status_code == 304:
+        return 304, None, etag
+    return response.status_code, response.text, response.headers.get('ETag')
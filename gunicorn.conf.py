@@ -0,0 +1,20 @@
+# gunicorn.conf.py
+# Loaded automatically by gunicorn from the working directory.
+import os
+import glob
+
+
+def on_starting(server):
+    """Clears stale per-process metric files left by a previous container run."""
+    multiproc_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if multiproc_dir:
+        os.makedirs(multiproc_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(multiproc_dir, '*.db')):
+            os.remove(path)
+
+
+def child_exit(server, worker):
+    """Drops a dead worker's live gauges from the aggregated /metrics output."""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,540 @@
+# job_queue.py
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from typing import Callable
+from dataclasses import dataclass, field
+
+# --- Configuration ---
+# Backend selection: 'sqlite' (default, durable on local disk), 'redis' (needs the
+# optional `redis` package and JOB_QUEUE_REDIS_URL) or 'fakeredis' (in-process stand-in).
+JOB_QUEUE_BACKEND = os.environ.get('JOB_QUEUE_BACKEND', 'sqlite').lower()
+JOB_QUEUE_PATH = os.environ.get('JOB_QUEUE_PATH', '/tmp/prreviewbot-jobs.sqlite3')
+JOB_QUEUE_REDIS_URL = os.environ.get('JOB_QUEUE_REDIS_URL', 'redis://localhost:6379/0')
+JOB_QUEUE_MAX_DEPTH = int(os.environ.get('JOB_QUEUE_MAX_DEPTH', '100'))   # 429 beyond this
+JOB_QUEUE_RETRY_AFTER = int(os.environ.get('JOB_QUEUE_RETRY_AFTER', '60'))  # Retry-After sent with the 429
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '4'))                     # worker threads per process
+JOB_PER_REPO_CONCURRENCY = int(os.environ.get('JOB_PER_REPO_CONCURRENCY', '2'))
+JOB_LEASE_SECONDS = float(os.environ.get('JOB_LEASE_SECONDS', '900'))     # running jobs not renewed for this long are resumed
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '3'))
+JOB_RETRY_DELAY_SECONDS = float(os.environ.get('JOB_RETRY_DELAY_SECONDS', '30'))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', '1.0'))
+
+
+@dataclass
+class Job:
+    """A unit of work claimed from the queue."""
+    id: str
+    repo: str
+    payload: dict = field(default_factory=dict)
+    attempts: int = 0
+    enqueued_at: float = 0.0
+
+
+# --- SQLite Backend ---
+class SQLiteJobQueue:
+    """
+    Durable job queue stored in a SQLite file.
+    Jobs are leased rather than deleted on claim: if a worker dies mid-review its
+    lease expires and the job is picked up again, so a restart never drops a review.
+    Workers renew the lease while the job runs; a job whose lease expired on its
+    last attempt is parked as 'failed' instead of being resumed forever.
+    The file can be shared by all gunicorn workers on the same host.
+    """
+
+    def __init__(self, path: str = JOB_QUEUE_PATH, lease_seconds: float = JOB_LEASE_SECONDS,
+                 max_attempts: int = JOB_MAX_ATTEMPTS, per_repo_limit: int = JOB_PER_REPO_CONCURRENCY):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.per_repo_limit = per_repo_limit
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                repo TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available_at REAL NOT NULL,
+                lease_expires_at REAL,
+                enqueued_at REAL NOT NULL,
+                last_error TEXT,
+                coalesce_key TEXT
+            )
+            """
+        )
+        # Queue files created before coalescing was added lack the column
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+        if 'coalesce_key' not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN coalesce_key TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_state_available ON jobs (state, available_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_coalesce_key ON jobs (coalesce_key, state)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS heads (coalesce_key TEXT PRIMARY KEY, head_sha TEXT, updated_at REAL NOT NULL)"
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 connections must not be shared across threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def enqueue(self, repo: str, payload: dict, coalesce_key: str | None = None,
+                head_sha: str | None = None, delay: float = 0.0) -> str:
+        """
+        Adds a job that becomes runnable after `delay` seconds.
+        With a `coalesce_key`, a job still waiting under the same key is replaced
+        in place (new payload, delay restarted) instead of queueing another one,
+        and `head_sha` is recorded as the newest revision for that key.
+        """
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if coalesce_key:
+                conn.execute(
+                    "INSERT INTO heads (coalesce_key, head_sha, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(coalesce_key) DO UPDATE SET head_sha = excluded.head_sha, updated_at = excluded.updated_at",
+                    (coalesce_key, head_sha, now)
+                )
+                row = conn.execute(
+                    "SELECT id FROM jobs WHERE coalesce_key = ? AND state = 'queued' LIMIT 1", (coalesce_key,)
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE jobs SET payload = ?, available_at = ? WHERE id = ?",
+                        (json.dumps(payload), now + delay, row[0])
+                    )
+                    conn.execute("COMMIT")
+                    return row[0]
+            job_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO jobs (id, repo, payload, state, attempts, available_at, enqueued_at, coalesce_key) "
+                "VALUES (?, ?, ?, 'queued', 0, ?, ?, ?)",
+                (job_id, repo, json.dumps(payload), now + delay, now, coalesce_key)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return job_id
+
+    def is_superseded(self, coalesce_key: str, head_sha: str | None) -> bool:
+        """True once a newer revision than `head_sha` has been enqueued under `coalesce_key`."""
+        row = self._conn().execute(
+            "SELECT head_sha FROM heads WHERE coalesce_key = ?", (coalesce_key,)
+        ).fetchone()
+        return row is not None and row[0] != head_sha
+
+    def claim(self, exclude_repos: set[str] | None = None,
+              repo_limit: Callable[[str], int] | None = None) -> Job | None:
+        """
+        Atomically leases the oldest runnable job, honoring the per-repo cap across
+        processes: `repo_limit(repo)` when given (the worker pool passes its own,
+        e.g. from review profiles), else `per_repo_limit`.
+        """
+        now = time.time()
+        limit = repo_limit or (lambda repo: self.per_repo_limit)
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # A job whose worker died on every attempt (e.g. OOM on a huge diff) is not resumed again
+            exhausted = conn.execute(
+                "UPDATE jobs SET state = 'failed', last_error = 'lease expired (worker lost) on the last attempt' "
+                "WHERE state = 'running' AND lease_expires_at < ? AND attempts >= ?",
+                (now, self.max_attempts)
+            ).rowcount
+            running = conn.execute(
+                "SELECT repo, COUNT(*) FROM jobs WHERE state = 'running' AND lease_expires_at >= ? GROUP BY repo",
+                (now,)
+            ).fetchall()
+            exclude = sorted(set(exclude_repos or ()) | {repo for repo, count in running if count >= limit(repo)})
+            exclude_sql = f"AND repo NOT IN ({','.join('?' * len(exclude))})" if exclude else ""
+            row = conn.execute(
+                f"""
+                SELECT id, repo, payload, attempts, enqueued_at FROM jobs
+                WHERE ((state = 'queued' AND available_at <= ?)
+                       OR (state = 'running' AND lease_expires_at < ?))
+                  {exclude_sql}
+                ORDER BY available_at
+                LIMIT 1
+                """,
+                (now, now, *exclude)
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET state = 'running', attempts = attempts + 1, lease_expires_at = ? WHERE id = ?",
+                    (now + self.lease_seconds, row[0])
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if exhausted:
+            logging.error(f"Parked {exhausted} job(s) as failed: their worker was lost on attempt {self.max_attempts}.")
+        if row is None:
+            return None
+        job_id, repo, payload, attempts, enqueued_at = row
+        return Job(id=job_id, repo=repo, payload=json.loads(payload), attempts=attempts + 1, enqueued_at=enqueued_at)
+
+    def renew(self, job_id: str) -> bool:
+        """Extends the lease of a job that is still running. False if it is no longer running."""
+        return self._conn().execute(
+            "UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND state = 'running'",
+            (time.time() + self.lease_seconds, job_id)
+        ).rowcount > 0
+
+    def complete(self, job_id: str):
+        self._conn().execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def fail(self, job_id: str, error: str):
+        """Re-queues the job after a delay, or parks it as 'failed' once attempts are exhausted."""
+        conn = self._conn()
+        row = conn.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return
+        if row[0] >= self.max_attempts:
+            conn.execute("UPDATE jobs SET state = 'failed', last_error = ? WHERE id = ?", (error, job_id))
+        else:
+            conn.execute(
+                "UPDATE jobs SET state = 'queued', available_at = ?, last_error = ? WHERE id = ?",
+                (time.time() + JOB_RETRY_DELAY_SECONDS * row[0], error, job_id)
+            )
+
+    def depth(self) -> int:
+        """Number of jobs waiting or in flight."""
+        return self._conn().execute(
+            "SELECT COUNT(*) FROM jobs WHERE state IN ('queued', 'running')"
+        ).fetchone()[0]
+
+
+# --- Redis Backend ---
+class RedisJobQueue:
+    """
+    Job queue on top of a Redis-style client (`redis.Redis(decode_responses=True)`
+    or `FakeRedis`). Layout under `prefix`:
+      <prefix>:queue          list of job ids, newest on the left
+      <prefix>:running        sorted set of job id -> lease expiry
+      <prefix>:job:<id>       hash with repo, payload, attempts, enqueued_at, available_at
+      <prefix>:pending        hash of coalesce key -> id of the job still waiting for it
+      <prefix>:heads          hash of coalesce key -> newest head SHA
+    The per-repo cap is enforced per process by the worker pool.
+    """
+
+    def __init__(self, client, prefix: str = 'prreviewbot:jobs', lease_seconds: float = JOB_LEASE_SECONDS,
+                 max_attempts: int = JOB_MAX_ATTEMPTS, scan_window: int = 50):
+        self.client = client
+        self.prefix = prefix
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.scan_window = scan_window
+
+    def _key(self, *parts) -> str:
+        return ':'.join((self.prefix,) + tuple(str(p) for p in parts))
+
+    def enqueue(self, repo: str, payload: dict, coalesce_key: str | None = None,
+                head_sha: str | None = None, delay: float = 0.0) -> str:
+        now = time.time()
+        if coalesce_key:
+            self.client.hset(self._key('heads'), mapping={coalesce_key: head_sha or ''})
+            pending_id = self.client.hget(self._key('pending'), coalesce_key)
+            if pending_id and self.client.hget(self._key('job', pending_id), 'state') == 'queued':
+                self.client.hset(self._key('job', pending_id), mapping={
+                    'payload': json.dumps(payload), 'available_at': now + delay,
+                })
+                return pending_id
+        job_id = uuid.uuid4().hex
+        self.client.hset(self._key('job', job_id), mapping={
+            'repo': repo, 'payload': json.dumps(payload), 'attempts': 0, 'enqueued_at': now,
+            'available_at': now + delay, 'state': 'queued', 'coalesce_key': coalesce_key or '',
+        })
+        if coalesce_key:
+            self.client.hset(self._key('pending'), mapping={coalesce_key: job_id})
+        self.client.lpush(self._key('queue'), job_id)
+        return job_id
+
+    def is_superseded(self, coalesce_key: str, head_sha: str | None) -> bool:
+        latest = self.client.hget(self._key('heads'), coalesce_key)
+        return latest is not None and latest != (head_sha or '')
+
+    def _resume_expired(self, now: float):
+        # LREM/ZREM return the number of removed items, so only one process wins each job
+        for job_id in self.client.zrangebyscore(self._key('running'), 0, now):
+            if not self.client.zrem(self._key('running'), job_id):
+                continue
+            attempts = int(self.client.hget(self._key('job', job_id), 'attempts') or 0)
+            if attempts >= self.max_attempts:
+                logging.error(f"Job {job_id} failed permanently: its worker was lost on attempt {attempts}.")
+                self.client.delete(self._key('job', job_id))
+            else:
+                self.client.rpush(self._key('queue'), job_id)
+
+    def claim(self, exclude_repos: set[str] | None = None,
+              repo_limit: Callable[[str], int] | None = None) -> Job | None:
+        # `repo_limit` is not used: the worker pool enforces the per-repo cap per process
+        now = time.time()
+        self._resume_expired(now)
+        exclude = exclude_repos or set()
+        # Oldest jobs are at the right-hand end of the list
+        candidates = self.client.lrange(self._key('queue'), -self.scan_window, -1)
+        for job_id in reversed(candidates):
+            data = self.client.hgetall(self._key('job', job_id))
+            if not data:
+                self.client.lrem(self._key('queue'), 1, job_id)
+                continue
+            if data['repo'] in exclude or float(data.get('available_at', 0)) > now:
+                continue
+            if not self.client.lrem(self._key('queue'), 1, job_id):
+                continue  # Claimed by another worker in the meantime
+            self.client.zadd(self._key('running'), {job_id: now + self.lease_seconds})
+            self.client.hset(self._key('job', job_id), mapping={'state': 'running'})
+            if data.get('coalesce_key') and self.client.hget(self._key('pending'), data['coalesce_key']) == job_id:
+                self.client.hdel(self._key('pending'), data['coalesce_key'])
+            attempts = self.client.hincrby(self._key('job', job_id), 'attempts', 1)
+            return Job(id=job_id, repo=data['repo'], payload=json.loads(data['payload']),
+                       attempts=int(attempts), enqueued_at=float(data['enqueued_at']))
+        return None
+
+    def renew(self, job_id: str) -> bool:
+        # XX only updates a job that is still leased; CH makes ZADD count the update
+        return bool(self.client.zadd(self._key('running'), {job_id: time.time() + self.lease_seconds}, xx=True, ch=True))
+
+    def complete(self, job_id: str):
+        self.client.zrem(self._key('running'), job_id)
+        self.client.delete(self._key('job', job_id))
+
+    def fail(self, job_id: str, error: str):
+        self.client.zrem(self._key('running'), job_id)
+        attempts = int(self.client.hget(self._key('job', job_id), 'attempts') or 0)
+        if attempts >= self.max_attempts:
+            logging.error(f"Job {job_id} failed permanently after {attempts} attempts: {error}")
+            self.client.delete(self._key('job', job_id))
+        else:
+            self.client.hset(self._key('job', job_id), mapping={
+                'last_error': error, 'state': 'retrying',
+                'available_at': time.time() + JOB_RETRY_DELAY_SECONDS * attempts,
+            })
+            self.client.lpush(self._key('queue'), job_id)
+
+    def depth(self) -> int:
+        return int(self.client.llen(self._key('queue'))) + int(self.client.zcard(self._key('running')))
+
+
+class FakeRedis:
+    """In-process stand-in implementing the subset of the redis-py API used by RedisJobQueue."""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.RLock()
+
+    def lpush(self, key, *values):
+        with self._lock:
+            lst = self._data.setdefault(key, [])
+            for value in values:
+                lst.insert(0, str(value))
+            return len(lst)
+
+    def rpush(self, key, *values):
+        with self._lock:
+            lst = self._data.setdefault(key, [])
+            lst.extend(str(v) for v in values)
+            return len(lst)
+
+    def lrange(self, key, start, end):
+        with self._lock:
+            lst = self._data.get(key, [])
+            end = len(lst) if end == -1 else end + 1
+            return list(lst[start:end])
+
+    def lrem(self, key, count, value):
+        with self._lock:
+            lst = self._data.get(key, [])
+            if value in lst:
+                lst.remove(value)
+                return 1
+            return 0
+
+    def llen(self, key):
+        with self._lock:
+            return len(self._data.get(key, []))
+
+    def hset(self, key, mapping):
+        with self._lock:
+            self._data.setdefault(key, {}).update({k: str(v) for k, v in mapping.items()})
+            return len(mapping)
+
+    def hget(self, key, field_name):
+        with self._lock:
+            return self._data.get(key, {}).get(field_name)
+
+    def hdel(self, key, *fields):
+        with self._lock:
+            h = self._data.get(key, {})
+            return sum(1 for f in fields if h.pop(f, None) is not None)
+
+    def hgetall(self, key):
+        with self._lock:
+            return dict(self._data.get(key, {}))
+
+    def hincrby(self, key, field_name, amount=1):
+        with self._lock:
+            h = self._data.setdefault(key, {})
+            h[field_name] = str(int(h.get(field_name, 0)) + amount)
+            return int(h[field_name])
+
+    def delete(self, *keys):
+        with self._lock:
+            return sum(1 for k in keys if self._data.pop(k, None) is not None)
+
+    def zadd(self, key, mapping, xx=False, ch=False):
+        with self._lock:
+            z = self._data.setdefault(key, {})
+            if xx:
+                mapping = {k: v for k, v in mapping.items() if str(k) in z}
+            added = sum(1 for k in mapping if str(k) not in z)
+            changed = sum(1 for k, v in mapping.items() if z.get(str(k)) != float(v))
+            z.update({str(k): float(v) for k, v in mapping.items()})
+            return changed if ch else added
+
+    def zrem(self, key, *members):
+        with self._lock:
+            z = self._data.get(key, {})
+            return sum(1 for m in members if z.pop(m, None) is not None)
+
+    def zrangebyscore(self, key, low, high):
+        with self._lock:
+            z = self._data.get(key, {})
+            return [m for m, s in sorted(z.items(), key=lambda kv: kv[1]) if low <= s <= high]
+
+    def zcard(self, key):
+        with self._lock:
+            return len(self._data.get(key, {}))
+
+
+def create_job_queue():
+    """Builds the queue backend selected by JOB_QUEUE_BACKEND."""
+    if JOB_QUEUE_BACKEND == 'redis':
+        try:
+            import redis
+        except ImportError:
+            logging.critical("JOB_QUEUE_BACKEND=redis requires the 'redis' package to be installed.")
+            raise
+        logging.info(f"Using Redis job queue at {JOB_QUEUE_REDIS_URL}")
+        return RedisJobQueue(redis.Redis.from_url(JOB_QUEUE_REDIS_URL, decode_responses=True))
+    if JOB_QUEUE_BACKEND == 'fakeredis':
+        logging.info("Using in-process FakeRedis job queue (not durable).")
+        return RedisJobQueue(FakeRedis())
+    logging.info(f"Using SQLite job queue at {JOB_QUEUE_PATH}")
+    return SQLiteJobQueue(JOB_QUEUE_PATH)
+
+
+# --- Worker Pool ---
+class WorkerPool:
+    """
+    Fixed-size pool of worker threads draining a job queue.
+    Each worker claims one job at a time and calls `handler(job)`; an exception
+    marks the job failed (and retried up to JOB_MAX_ATTEMPTS). A heartbeat thread
+    renews the leases of running jobs every third of the lease, so a long review is
+    not resumed by another worker while this one is still on it. At most
+    `per_repo_limit` jobs for the same repository run at once; it is either a
+    number or a function of the repository name (the receiver uses the repo's
+    profile `repo_concurrency`, falling back to JOB_PER_REPO_CONCURRENCY). It is
+    enforced in this process and passed to `queue.claim`, so the SQLite queue
+    applies the same limit across every process sharing the file.
+    """
+
+    def __init__(self, queue, handler, workers: int = JOB_WORKERS,
+                 per_repo_limit: int | Callable[[str], int] = JOB_PER_REPO_CONCURRENCY,
+                 poll_interval: float = JOB_POLL_INTERVAL):
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self.per_repo_limit = per_repo_limit
+        self.poll_interval = poll_interval
+        self._running = {}
+        self._active: dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"review-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        heartbeat = threading.Thread(target=self._heartbeat, name='review-heartbeat', daemon=True)
+        heartbeat.start()
+        self._threads.append(heartbeat)
+        limit = 'per profile' if callable(self.per_repo_limit) else self.per_repo_limit
+        logging.info(f"Started {self.workers} review workers (per-repo limit {limit}).")
+
+    def stop(self, timeout: float = 10.0):
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads.clear()
+
+    def notify(self):
+        """Wakes idle workers immediately after an enqueue instead of waiting for the next poll."""
+        self._wakeup.set()
+
+    def _repo_limit(self, repo: str) -> int:
+        return self.per_repo_limit(repo) if callable(self.per_repo_limit) else self.per_repo_limit
+
+    def _busy_repos(self) -> set[str]:
+        with self._lock:
+            running = list(self._running.items())
+        return {repo for repo, count in running if count >= self._repo_limit(repo)}
+
+    def _heartbeat(self):
+        interval = max(1.0, self.queue.lease_seconds / 3)
+        while not self._stopping.wait(interval):
+            with self._lock:
+                job_ids = list(self._active)
+            for job_id in job_ids:
+                try:
+                    # A job that just finished is gone from the queue; only warn while it still runs here
+                    if not self.queue.renew(job_id) and job_id in self._active:
+                        logging.warning(f"Job {job_id} is no longer leased by this worker; it may be resumed elsewhere.")
+                except Exception as e:
+                    logging.error(f"Failed to renew the lease of job {job_id}: {e}")
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                job = self.queue.claim(self._busy_repos(), self._repo_limit)
+            except Exception as e:
+                logging.error(f"Failed to claim job from queue: {e}", exc_info=True)
+                job = None
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            with self._lock:
+                self._running[job.repo] = self._running.get(job.repo, 0) + 1
+                self._active[job.id] = job
+            try:
+                self.handler(job)
+                self.queue.complete(job.id)
+            except Exception as e:
+                logging.error(f"Job {job.id} for '{job.repo}' failed (attempt {job.attempts}): {e}", exc_info=True)
+                self.queue.fail(job.id, str(e))
+            finally:
+                with self._lock:
+                    self._active.pop(job.id, None)
+                    self._running[job.repo] -= 1
+                    if not self._running[job.repo]:
+                        del self._running[job.repo]
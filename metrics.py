@@ -0,0 +1,81 @@
+# metrics.py
+import os
+
+from prometheus_client import (
+    CollectorRegistry, Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST, REGISTRY,
+)
+
+# --- Configuration ---
+# When set (see gunicorn.conf.py), every worker process writes its samples here
+# and /metrics aggregates them, whichever worker serves the scrape.
+PROMETHEUS_MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+# Review stages run from seconds (diff fetch) to minutes (model calls on big PRs)
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+SIZE_BUCKETS = (1_000, 10_000, 50_000, 100_000, 500_000, 1_000_000, 5_000_000, 20_000_000)
+COUNT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+TOKEN_BUCKETS = (0, 100, 500, 1_000, 5_000, 10_000, 50_000, 100_000, 500_000)
+
+# --- Metric Definitions ---
+STAGE_DURATION = Histogram(
+    'prreviewbot_stage_duration_seconds', 'Duration of each review stage.',
+    ['stage', 'repo'], buckets=STAGE_BUCKETS
+)
+QUEUE_WAIT = Histogram(
+    'prreviewbot_queue_wait_seconds', 'Time a review job waited in the queue before a worker claimed it.',
+    ['repo'], buckets=STAGE_BUCKETS
+)
+DIFF_BYTES = Histogram(
+    'prreviewbot_diff_bytes', 'Size of PR diffs streamed from Gitea.',
+    ['repo'], buckets=SIZE_BUCKETS
+)
+REVIEW_CHUNKS = Histogram(
+    'prreviewbot_review_chunks', 'Model-call chunks per review.',
+    ['repo'], buckets=COUNT_BUCKETS
+)
+PREFILTER_TOKENS_SAVED = Histogram(
+    'prreviewbot_prefilter_tokens_saved', 'Estimated tokens per review kept away from the model by the static pre-filter.',
+    ['repo'], buckets=TOKEN_BUCKETS
+)
+MODEL_CALL_DURATION = Histogram(
+    'prreviewbot_model_call_duration_seconds', 'Duration of a single AdkApp stream_query call.',
+    ['model'], buckets=STAGE_BUCKETS
+)
+MODEL_TOKENS = Counter(
+    'prreviewbot_model_tokens_total', 'Tokens reported by the model, by direction (in/out).',
+    ['model', 'direction']
+)
+MODEL_TOKENS_ESTIMATED = Counter(
+    'prreviewbot_model_tokens_estimated_total', 'Prompt tokens estimated locally before each model call.',
+    ['model']
+)
+TOKEN_ESTIMATE_RATIO = Histogram(
+    'prreviewbot_token_estimate_ratio', 'Reported / estimated prompt tokens per review.',
+    ['model'], buckets=(0.25, 0.5, 0.75, 0.9, 1.0, 1.1, 1.25, 1.5, 2.0, 4.0)
+)
+CACHE_REQUESTS = Counter(
+    'prreviewbot_review_cache_requests_total', 'Review cache lookups by result (hit/miss).',
+    ['result']
+)
+REVIEWS = Counter(
+    'prreviewbot_reviews_total', 'Finished review jobs by outcome.',
+    ['repo', 'outcome']
+)
+ERRORS = Counter(
+    'prreviewbot_errors_total', 'Errors by stage.',
+    ['stage', 'repo']
+)
+WEBHOOKS = Counter(
+    'prreviewbot_webhooks_total', 'Webhook deliveries by outcome.',
+    ['outcome']
+)
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """Returns the exposition payload and content type for /metrics."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
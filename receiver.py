@@ -5,19 +5,33 @@ import hashlib
 import json
 import logging
 import time # Added for timing logs
+import asyncio
+from functools import partial
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, Request, Header, HTTPException, Response, status, BackgroundTasks # Added BackgroundTasks
+from fastapi import FastAPI, Request, Header, HTTPException, Response, status
 
 # --- Configuration ---
-# Set up basic logging
+# Set up basic logging (only here, in the entry point; the other modules just log)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # --- Import Application Logic ---
 # Assuming agent_runner.py and gitea_tools.py are in the same directory
 # or accessible via PYTHONPATH. Handle potential import errors.
 try:
-    from agent_runner import run_analysis
-    from gitea_tools import get_gitea_pr_diff, post_gitea_comment # Gitea API token loaded here
+    from review_pipeline import review_files
+    from review_cache import review_cache
+    from agent_runner import agent_pools, warm_agent_pool, is_failed_analysis
+    from repo_profiles import profile_store, normalize_action, REVIEW_EVENTS
+    from diff_prefilter import prefilter_diff
+    from token_budget import plan_review, TokenUsage
+    from review_comments import build_pull_review
+    from review_progress import ProgressComment, REVIEW_PROGRESS_COMMENTS
+    from gitea_tools import get_gitea_pr_diff_files, get_gitea_incremental_diff_files, post_gitea_comment, post_gitea_review, delete_gitea_comment, DIFF_MAX_BYTES # Gitea API token loaded here
+    from review_store import review_store, QUEUED, RUNNING, POSTED, DONE, SUPERSEDED, FAILED
+    from job_queue import create_job_queue, WorkerPool, JOB_QUEUE_MAX_DEPTH, JOB_QUEUE_RETRY_AFTER, JOB_PER_REPO_CONCURRENCY
+    import metrics
+    import tracing
 except ImportError as e:
     logging.error(f"Failed to import required modules: {e}. Ensure agent_runner.py and gitea_tools.py are accessible.")
     # In a real scenario, proper error handling or exiting might be needed
@@ -54,60 +68,429 @@ if not GITEA_WEBHOOK_SECRET:
     # If verification MUST happen, you might want to raise an error here instead
     # raise ValueError("GITEA_WEBHOOK_SECRET must be set for signature verification")
 
+# --- Review Coalescing ---
+# Pushes to the same PR within this window collapse into a single review of the newest head.
+REVIEW_DEBOUNCE_SECONDS = float(os.environ.get('REVIEW_DEBOUNCE_SECONDS', '15'))
+
+# --- Job Queue & Worker Pool ---
+# Created per process in the lifespan handler below. Reviews are persisted to the
+# queue before the webhook is acknowledged, so a worker restart does not drop them.
+job_queue = None
+worker_pool = None
+
+# --- Agent Warm-up ---
+# The model SDKs (vertexai, google.adk) are imported when the first agent is built.
+#   background (default): build this worker's agent pools on a thread once startup is
+#                         done, so the port is served while the SDKs load
+#   startup:              build them before taking traffic (slow cold start, warm first review)
+#   lazy:                 build nothing up front; the first review of each profile pays for it
+# /health reports pending, running, done, partial (some slots failed), failed (none built) or lazy.
+AGENT_WARMUP = os.environ.get('AGENT_WARMUP', 'background').lower()
+agent_warmup_state = 'pending'
+
+def _warm_agents():
+    """Builds the agent/AdkApp pools of the default profile and every profile in the central file."""
+    global agent_warmup_state
+    agent_warmup_state = 'running'
+    try:
+        profiles = profile_store.central_profiles()
+        failed, total = warm_agent_pool([(profile.model, profile.instruction) for profile in profiles])
+        agent_warmup_state = 'done' if not failed else 'failed' if failed >= total else 'partial'
+    except Exception as e:
+        agent_warmup_state = 'failed'
+        logging.error(f"Agent warm-up failed; agents will be built on first use: {e}", exc_info=True)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global job_queue, worker_pool, agent_warmup_state
+    if AGENT_WARMUP == 'startup':
+        await asyncio.to_thread(_warm_agents)
+    elif AGENT_WARMUP == 'background':
+        # Not awaited: the worker starts serving /webhook and /health while the agents are built
+        asyncio.get_running_loop().run_in_executor(None, _warm_agents)
+    else:
+        agent_warmup_state = 'lazy'
+    job_queue = create_job_queue()
+    worker_pool = WorkerPool(job_queue, run_review_job, per_repo_limit=_repo_concurrency)
+    worker_pool.start()
+    try:
+        yield
+    finally:
+        worker_pool.stop()
+
+def _repo_concurrency(repo_full_name: str) -> int:
+    """Per-repo job limit from the repo's profile (already resolved by the job that is running)."""
+    profile = profile_store.cached(repo_full_name)
+    return (profile.repo_concurrency if profile else None) or JOB_PER_REPO_CONCURRENCY
+
 # --- FastAPI Application Setup ---
 app = FastAPI(
     title="Gitea PR Review Agent Receiver (Async)",
-    description="Receives Gitea webhooks, triggers ADK agent analysis in the background, and posts results.",
-    version="1.1.0" # Bump version for change
+    description="Receives Gitea webhooks, queues ADK agent analysis on a worker pool, and posts results.",
+    version="1.3.0", # Bump version for change
+    lifespan=lifespan
 )
 
 # --- Background Task Function ---
-def process_pr_review(repo_full_name: str, pr_number: int):
+def _post_review(repo_full_name: str, pr_number: int, body: str, comments: list[dict], fallback_body: str,
+                 head_sha: str | None, progress=None) -> bool:
+    """
+    Submits the review as one pull review; if Gitea rejects it, posts `fallback_body`
+    as a plain comment instead (into the progress comment when there is one).
+    """
+    with tracing.span('comment.post', inline_comments=len(comments)) as span:
+        if post_gitea_review(repo_full_name, pr_number, body, comments, commit_id=head_sha):
+            if progress:
+                progress.discard()  # The review supersedes the progress comment
+            return True
+        logging.warning(f"[BackgroundTask] PR #{pr_number}: Pull review rejected. Falling back to a plain comment.")
+        span.set(fallback_comment=True)
+        return (progress is not None and progress.finish(fallback_body)) \
+            or post_gitea_comment(repo_full_name, pr_number, fallback_body)
+
+
+def _render_truncated(files: list) -> str:
+    """Collapsed Markdown list of the files cut off at DIFF_MAX_BYTES (empty if none were)."""
+    if not files:
+        return ""
+    lines = [f"- `{f.path}` (+{f.additions}/-{f.deletions}){': partly reviewed' if f.hunks else ''}" for f in files]
+    return (
+        f"<details><summary>Not reviewed: {len(files)} file{'s' if len(files) != 1 else ''} past the "
+        f"{DIFF_MAX_BYTES / (1024 * 1024):g} MB diff size limit</summary>\n\n" + '\n'.join(lines) + "\n</details>"
+    )
+
+
+# Outcomes of process_pr_review after which a head is settled: new deliveries for it are duplicates
+SETTLED_OUTCOMES = {'posted', 'reposted', 'already_reviewed', 'empty', 'prefiltered', 'over_budget', 'disabled'}
+
+def process_pr_review(repo_full_name: str, pr_number: int, head_sha: str | None = None, is_superseded=None,
+                      action: str | None = None) -> str:
     """
     Performs the actual PR analysis and commenting in a background task.
     NOTE: This runs synchronously within the background task runner.
           If the underlying calls were async, this function could be async too.
+    `is_superseded` is polled between stages (and during the model stream); once it
+    returns True a newer push has been queued and this review is abandoned.
+    When a previous head of this PR was already reviewed and `head_sha` builds on it,
+    only the commits added since then are reviewed. A review already computed for
+    `head_sha` (e.g. by an attempt whose post failed) is re-posted without a model call.
+    Model, instruction, skipped files and concurrency come from the repo's review
+    profile; PR actions the profile does not enable are dropped here.
+    Returns the outcome (as counted in metrics.REVIEWS). Raises when the diff cannot
+    be fetched or a computed review cannot be posted, so the job queue retries.
     """
+    is_superseded = is_superseded or (lambda: False)
     start_task_time = time.monotonic()
     logging.info(f"[BackgroundTask] Starting processing for PR #{pr_number} in repo '{repo_full_name}'")
 
-    # 1. Get PR diff from Gitea API
+    profile = profile_store.get(repo_full_name)
+    if action is not None and not profile.reviews(action):
+        logging.info(f"[BackgroundTask] Review profile of '{repo_full_name}' does not enable '{action}'. Ending task.")
+        metrics.REVIEWS.labels(repo=repo_full_name, outcome='disabled').inc()
+        return 'disabled'
+
+    last_reviewed_head = review_store.last_reviewed_head(repo_full_name, pr_number) if head_sha else None
+    if head_sha and last_reviewed_head == head_sha:
+        logging.info(f"[BackgroundTask] PR #{pr_number} head {head_sha[:12]} was already reviewed. Ending task.")
+        metrics.REVIEWS.labels(repo=repo_full_name, outcome='already_reviewed').inc()
+        return 'already_reviewed'
+    stored = review_store.get_review(repo_full_name, pr_number, head_sha) if head_sha else None
+    if stored is not None and stored.state == POSTED:
+        logging.info(f"[BackgroundTask] Review of PR #{pr_number} head {head_sha[:12]} was already posted. Ending task.")
+        metrics.REVIEWS.labels(repo=repo_full_name, outcome='already_reviewed').inc()
+        return 'already_reviewed'
+    if stored is not None and stored.body is not None:
+        logging.info(f"[BackgroundTask] Re-posting the stored review of PR #{pr_number} head {head_sha[:12]} (no model call).")
+        if not _post_review(repo_full_name, pr_number, stored.body, stored.comments, stored.fallback_body, head_sha):
+            metrics.ERRORS.labels(stage='comment_post', repo=repo_full_name).inc()
+            raise RuntimeError(f"Failed to re-post the stored review of PR #{pr_number}")
+        if stored.complete:
+            review_store.record_reviewed_head(repo_full_name, pr_number, head_sha)
+        review_store.set_state(repo_full_name, pr_number, head_sha, POSTED)
+        metrics.REVIEWS.labels(repo=repo_full_name, outcome='reposted').inc()
+        return 'reposted'
+
+    # 1. Get PR diff from Gitea API (streamed and split per file)
     start_diff_time = time.monotonic()
-    diff_content = get_gitea_pr_diff(repo_full_name, pr_number)
+    diff_files = None
+    with tracing.span('diff.fetch') as span:
+        if last_reviewed_head:
+            diff_files = get_gitea_incremental_diff_files(repo_full_name, pr_number, last_reviewed_head, head_sha,
+                                                          skip_globs=profile.skip_globs)
+            if diff_files is None:
+                logging.info(f"[BackgroundTask] PR #{pr_number}: Incremental diff unavailable. Falling back to full review.")
+        incremental = diff_files is not None
+        if not incremental:
+            diff_files = get_gitea_pr_diff_files(repo_full_name, pr_number, skip_globs=profile.skip_globs)
+        span.set(incremental=incremental, files=len(diff_files) if diff_files is not None else None)
     diff_fetch_duration = time.monotonic() - start_diff_time
-    logging.info(f"[BackgroundTask] PR #{pr_number}: Diff fetch took {diff_fetch_duration:.2f} seconds.")
+    logging.info(f"[BackgroundTask] PR #{pr_number}: {'Incremental' if incremental else 'Full'} diff fetch took {diff_fetch_duration:.2f} seconds.")
+    metrics.STAGE_DURATION.labels(stage='diff_fetch', repo=repo_full_name).observe(diff_fetch_duration)
+
+    if diff_files is None:
+        logging.error(f"[BackgroundTask] Failed to get valid diff for PR #{pr_number}. Leaving it to the job queue to retry.")
+        metrics.ERRORS.labels(stage='diff_fetch', repo=repo_full_name).inc()
+        metrics.REVIEWS.labels(repo=repo_full_name, outcome='failed').inc()
+        # Not settled: the job queue retries, and a redelivery may try again after that
+        raise RuntimeError(f"Failed to fetch the diff of PR #{pr_number}")
+    # Files cut off at DIFF_MAX_BYTES: listed in the review, and the head is not recorded as reviewed,
+    # so the next push is reviewed against the last fully reviewed head instead
+    truncated_files = [f for f in diff_files if f.truncated and not f.skipped_reason]
+    if truncated_files:
+        logging.warning(f"[BackgroundTask] PR #{pr_number}: Diff truncated, {len(truncated_files)} files not (fully) reviewed.")
+    complete = not truncated_files
+    if not any(f.hunks for f in diff_files):
+        logging.info(f"[BackgroundTask] PR #{pr_number} diff is empty or has only skipped files ({len(diff_files)} files). Ending task.")
+        if head_sha and complete:
+            review_store.record_reviewed_head(repo_full_name, pr_number, head_sha)
+        metrics.REVIEWS.labels(repo=repo_full_name, outcome='empty').inc()
+        return 'empty'
+    if is_superseded():
+        logging.info(f"[BackgroundTask] PR #{pr_number} was updated while fetching the diff. Skipping stale review.")
+        metrics.REVIEWS.labels(repo=repo_full_name, outcome='superseded').inc()
+        return 'superseded'
+
+    # 1b. Static pre-filter: set aside generated/lock/asset files, deletions and formatting-only hunks
+    with tracing.span('prefilter') as span:
+        prefilter = prefilter_diff(diff_files, enabled=profile.prefilter, keep_globs=profile.prefilter_keep_globs)
+        span.set(tokens_before=prefilter.tokens_before, tokens_after=prefilter.tokens_after)
+    logging.info(
+        f"[BackgroundTask] PR #{pr_number}: Pre-filter kept {len(prefilter.files)}/{len(diff_files)} files, "
+        f"dropped {prefilter.dropped_hunks} hunks, saved ~{prefilter.tokens_saved} of ~{prefilter.tokens_before} tokens."
+    )
+    metrics.PREFILTER_TOKENS_SAVED.labels(repo=repo_full_name).observe(prefilter.tokens_saved)
+    if not prefilter.has_reviewable_changes:
+        logging.info(f"[BackgroundTask] PR #{pr_number} has nothing left to review after the pre-filter. Skipping model call.")
+        if head_sha and complete:
+            review_store.record_reviewed_head(repo_full_name, pr_number, head_sha)
+        metrics.REVIEWS.labels(repo=repo_full_name, outcome='prefiltered').inc()
+        return 'prefiltered'
 
-    if diff_content is None:
-        logging.error(f"[BackgroundTask] Failed to get valid diff for PR #{pr_number}. Ending task.")
-        return # Exit background task
-    if not diff_content.strip():
-        logging.info(f"[BackgroundTask] PR #{pr_number} diff is empty. Ending task.")
-        return # Exit background task
+    # 1c. Token budget: trim context and rank files so the prompt fits this model's budget
+    with tracing.span('token_plan', model=profile.model) as span:
+        plan = plan_review(prefilter.files, profile.model, profile.instruction)
+        span.set(estimated_tokens=plan.estimated_tokens, budget=plan.budget, omitted_files=len(plan.omitted))
+    logging.info(
+        f"[BackgroundTask] PR #{pr_number}: Token plan for {plan.model}: ~{plan.estimated_tokens} of {plan.budget} tokens "
+        f"(complete diff ~{plan.required_tokens}, context trimmed: {plan.context_trimmed}, {len(plan.omitted)} files omitted)."
+    )
+    if not plan.fits:
+        logging.warning(f"[BackgroundTask] PR #{pr_number} does not fit the token budget. Skipping model call.")
+        post_gitea_comment(
+            repo_full_name, pr_number,
+            f"⚠️ **AI review skipped:** this change needs about {plan.required_tokens:,} prompt tokens, "
+            f"more than the {plan.budget:,}-token review budget for `{plan.model}`, even after trimming "
+            f"context and dropping lower-priority files. Consider splitting the PR into smaller ones."
+        )
+        metrics.REVIEWS.labels(repo=repo_full_name, outcome='over_budget').inc()
+        return 'over_budget'
 
-    # 2. Call ADK agent for analysis
+    # 2. Call ADK agent for analysis, streaming partial findings into a placeholder comment
+    # (the one an earlier attempt at this head left behind, if any, tracked in the review store)
+    progress = None
+    if REVIEW_PROGRESS_COMMENTS:
+        progress = ProgressComment(
+            repo_full_name, pr_number, comment_id=stored.progress_comment_id if stored is not None else None,
+            track=partial(review_store.set_progress_comment, repo_full_name, pr_number, head_sha) if head_sha else None
+        )
+    if progress and not progress.start():
+        progress = None
     start_agent_time = time.monotonic()
-    analysis_result = run_analysis(diff_content)
+    usage = TokenUsage()
+    try:
+        with tracing.span('analysis', model=profile.model):
+            analysis_result = review_files(plan.files, should_cancel=is_superseded, repo=repo_full_name,
+                                           on_progress=progress.update if progress else None, usage=usage,
+                                           model=profile.model, instruction=profile.instruction,
+                                           max_concurrency=profile.review_concurrency)
+    except Exception:
+        if progress:
+            progress.discard()
+        raise
     agent_duration = time.monotonic() - start_agent_time
     logging.info(f"[BackgroundTask] PR #{pr_number}: Agent analysis took {agent_duration:.2f} seconds.")
+    metrics.STAGE_DURATION.labels(stage='analysis', repo=repo_full_name).observe(agent_duration)
+    if usage.calls:
+        logging.info(f"[BackgroundTask] PR #{pr_number}: {usage.calls} model calls, prompt tokens estimated {usage.estimated_in}, "
+                     f"reported {usage.actual_in} (output {usage.actual_out}).")
+        if usage.estimated_in and usage.actual_in:
+            metrics.TOKEN_ESTIMATE_RATIO.labels(model=profile.model).observe(usage.actual_in / usage.estimated_in)
+    if analysis_result is not None and is_failed_analysis(analysis_result):
+        metrics.ERRORS.labels(stage='analysis', repo=repo_full_name).inc()
+
+    if is_superseded():
+        logging.info(f"[BackgroundTask] PR #{pr_number} was updated during analysis. Discarding stale review.")
+        metrics.REVIEWS.labels(repo=repo_full_name, outcome='superseded').inc()
+        if progress:
+            progress.discard()
+        return 'superseded'
 
     # 3. Post comment back to Gitea
     if analysis_result:
         logging.info(f"[BackgroundTask] Agent analysis complete for PR #{pr_number}. Posting comment...")
-        comment_to_post = f"{analysis_result}\n\n---\n*AI analysis powered by Google ADK & Gemini*"
+        scope_note = f"*Incremental review of changes since `{last_reviewed_head[:12]}`.*\n\n" if incremental else ""
+        notes = [note for note in (_render_truncated(truncated_files), plan.render_omitted(), prefilter.render_summary()) if note]
+        footer = ''.join(f"\n\n{note}" for note in notes) + "\n\n---\n*AI analysis powered by Google ADK & Gemini*"
+        # Line-level findings go next to the code; all of it is submitted as one pull review
+        review = build_pull_review(analysis_result, diff_files)
+        review_body = f"{scope_note}{review.body}{footer}"
+        comments = [comment.to_gitea() for comment in review.comments]
+        plain_comment = f"{scope_note}{analysis_result}{footer}"
+        # Stored before posting, so a retry or redelivery after a failed post doesn't call the model again
+        persist_review = head_sha is not None and not is_failed_analysis(analysis_result)
+        if persist_review:
+            review_store.save_review(repo_full_name, pr_number, head_sha, review_body, comments, plain_comment, complete)
         start_comment_time = time.monotonic()
-        success = post_gitea_comment(repo_full_name, pr_number, comment_to_post)
+        success = _post_review(repo_full_name, pr_number, review_body, comments, plain_comment, head_sha, progress)
         comment_duration = time.monotonic() - start_comment_time
         logging.info(f"[BackgroundTask] PR #{pr_number}: Comment post took {comment_duration:.2f} seconds.")
+        metrics.STAGE_DURATION.labels(stage='comment_post', repo=repo_full_name).observe(comment_duration)
 
         if not success:
             logging.error(f"[BackgroundTask] Failed to post analysis comment to Gitea for PR #{pr_number}.")
+            metrics.ERRORS.labels(stage='comment_post', repo=repo_full_name).inc()
+            metrics.REVIEWS.labels(repo=repo_full_name, outcome='failed').inc()
+            if persist_review:
+                # Let the job queue retry; the next attempt re-posts the stored review
+                raise RuntimeError(f"Failed to post the review of PR #{pr_number}")
+            outcome = 'failed'
+        elif is_failed_analysis(analysis_result):
+            # Only the model's error message was posted; the head is left for a redelivery to review
+            logging.info(f"[BackgroundTask] Posted the analysis error for PR #{pr_number}.")
+            metrics.REVIEWS.labels(repo=repo_full_name, outcome='failed').inc()
+            outcome = 'failed'
         else:
             logging.info(f"[BackgroundTask] Successfully posted comment for PR #{pr_number}.")
+            metrics.REVIEWS.labels(repo=repo_full_name, outcome='posted').inc()
+            if persist_review:
+                if complete:
+                    review_store.record_reviewed_head(repo_full_name, pr_number, head_sha)
+                review_store.set_state(repo_full_name, pr_number, head_sha, POSTED)
+            outcome = 'posted'
     else:
         logging.warning(f"[BackgroundTask] Agent did not return an analysis result for PR #{pr_number}.")
+        metrics.REVIEWS.labels(repo=repo_full_name, outcome='no_result').inc()
+        if progress:
+            progress.discard()
+        outcome = 'no_result'
 
     total_task_duration = time.monotonic() - start_task_time
     logging.info(f"[BackgroundTask] Finished processing for PR #{pr_number}. Total task time: {total_task_duration:.2f} seconds.")
+    metrics.STAGE_DURATION.labels(stage='total', repo=repo_full_name).observe(total_task_duration)
+    return outcome
+
+
+def run_review_job(job):
+    """Worker pool handler: unpacks a queued job and runs the review."""
+    repo_full_name = job.payload['repo_full_name']
+    pr_number = job.payload['pr_number']
+    head_sha = job.payload.get('head_sha')
+    action = job.payload.get('action')
+    coalesce_key = f"{repo_full_name}#{pr_number}"
+    trace = job.payload.get('trace')  # Position of the webhook span that queued this job
+    claimed_at = time.time()
+    queue_wait = claimed_at - job.enqueued_at
+    tracing.record('queue.wait', job.enqueued_at, claimed_at, parent=trace, job_id=job.id, attempt=job.attempts)
+    with tracing.span('review.job', parent=trace, repo=repo_full_name, pr=pr_number, head=head_sha,
+                      job_id=job.id, attempt=job.attempts) as span:
+        logging.info(f"[BackgroundTask] Job {job.id} for PR #{pr_number} waited {queue_wait:.2f} seconds in queue "
+                     f"(attempt {job.attempts}, trace {span.trace_id}).")
+        metrics.QUEUE_WAIT.labels(repo=repo_full_name).observe(queue_wait)
+        if head_sha:
+            review_store.set_state(repo_full_name, pr_number, head_sha, RUNNING, job_id=job.id)
+            # Placeholders of earlier heads whose worker died or that were abandoned mid-review
+            _discard_progress_comments(repo_full_name, pr_number,
+                                       review_store.stale_progress_comments(repo_full_name, pr_number, head_sha))
+        try:
+            outcome = process_pr_review(
+                repo_full_name, pr_number, head_sha=head_sha,
+                is_superseded=lambda: job_queue.is_superseded(coalesce_key, head_sha), action=action
+            )
+        except Exception:
+            metrics.ERRORS.labels(stage='job', repo=repo_full_name).inc()
+            if head_sha:
+                review_store.set_state(repo_full_name, pr_number, head_sha, FAILED, only_from=RUNNING)
+            raise
+        span.set(outcome=outcome)
+        if head_sha:
+            # Posted heads are already POSTED. Only a terminal outcome settles a head; a superseded
+            # or failed one stays open for a redelivery (or a force-push back to it).
+            state = DONE if outcome in SETTLED_OUTCOMES else SUPERSEDED if outcome == 'superseded' else FAILED
+            review_store.set_state(repo_full_name, pr_number, head_sha, state, only_from=RUNNING)
+            # A placeholder still tracked for this head belongs to an attempt that never reached step 2
+            leftover = review_store.get_review(repo_full_name, pr_number, head_sha)
+            if leftover is not None and leftover.progress_comment_id is not None:
+                _discard_progress_comments(repo_full_name, pr_number, [(head_sha, leftover.progress_comment_id)])
+
+
+def _discard_progress_comments(repo_full_name: str, pr_number: int, placeholders: list[tuple[str, int]]):
+    """Deletes "review in progress" comments that no running review will finish."""
+    for placeholder_head, comment_id in placeholders:
+        if not delete_gitea_comment(repo_full_name, comment_id):
+            logging.warning(f"[BackgroundTask] Could not delete stale progress comment {comment_id} on PR #{pr_number}.")
+        review_store.set_progress_comment(repo_full_name, pr_number, placeholder_head, None)
+
+
+# --- Webhook Ingress ---
+# Deliveries are filtered on headers before the body is read, bodies are read with a
+# hard size cap, and verified bytes are parsed exactly once.
+WEBHOOK_MAX_BODY_BYTES = int(os.environ.get('WEBHOOK_MAX_BODY_BYTES', str(2 * 1024 * 1024)))
+# X-Gitea-Event values worth reading; X-Gitea-Event-Type narrows pull_request deliveries
+# down to opened/reopened/edited ("pull_request") and pushes ("pull_request_sync"),
+# so label, assignee and milestone changes are dropped without parsing.
+WEBHOOK_EVENTS = {'pull_request'}
+WEBHOOK_EVENT_TYPES = {'pull_request', 'pull_request_sync'}
+# Actions any profile may enable; each repo's profile narrows them (see repo_profiles)
+REVIEW_ACTIONS = set(REVIEW_EVENTS)
+IGNORED_RESPONSE_BODY = b'{"status": "event ignored"}'
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads  # orjson is optional; the stdlib decoder accepts bytes too
+
+
+def _is_relevant_event(event: str | None, event_type: str | None) -> bool:
+    """Header-only filter. Deliveries without the Gitea headers fall through to payload checks."""
+    if event is None:
+        return True
+    return event in WEBHOOK_EVENTS and (event_type is None or event_type in WEBHOOK_EVENT_TYPES)
+
+
+async def _read_body(request: Request, limit: int) -> bytes | None:
+    """Reads the request body, giving up (None) as soon as it exceeds `limit` bytes."""
+    declared = request.headers.get('content-length')
+    if declared and declared.isdigit() and int(declared) > limit:
+        return None
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > limit:
+            return None
+    return bytes(body)
+
+
+def _extract_pr_event(payload) -> tuple[str | None, int | None, str | None, str | None] | None:
+    """
+    Pulls (action, pr_number, repo_full_name, head_sha) out of a parsed delivery; None if it is not a PR event.
+    Action aliases (Gitea's "synchronized") are mapped to the names profiles use.
+    """
+    pr_data = payload.get('pull_request') if isinstance(payload, dict) else None
+    if not isinstance(pr_data, dict):
+        return None
+    repo_data = payload.get('repository') or {}
+    head_data = pr_data.get('head') or {}
+    return normalize_action(payload.get('action')), payload.get('number'), repo_data.get('full_name'), head_data.get('sha')
+
+
+def _ignored(reason: str) -> Response:
+    logging.debug(f"Ignoring webhook delivery ({reason}).")
+    active = tracing.current()
+    if active is not None:
+        active.set(outcome='ignored', reason=reason)
+    metrics.WEBHOOKS.labels(outcome='ignored').inc()
+    return Response(content=IGNORED_RESPONSE_BODY, status_code=status.HTTP_200_OK, media_type='application/json')
 
 
 # --- Webhook Endpoint ---
@@ -119,83 +502,159 @@ def process_pr_review(repo_full_name: str, pr_number: int):
 )
 async def handle_webhook(
     request: Request,
-    background_tasks: BackgroundTasks, # FastAPI injects this
-    x_gitea_signature: str | None = Header(None, alias="X-Gitea-Signature")
+    x_gitea_signature: str | None = Header(None, alias="X-Gitea-Signature"),
+    x_gitea_event: str | None = Header(None, alias="X-Gitea-Event"),
+    x_gitea_event_type: str | None = Header(None, alias="X-Gitea-Event-Type"),
+    x_gitea_delivery: str | None = Header(None, alias="X-Gitea-Delivery")
 ):
     """
     Receives Gitea webhooks, verifies signature (if configured),
     queues the actual processing (diff fetch, analysis, comment)
     to run in the background, and returns an immediate 202 Accepted response.
+    Irrelevant events are acknowledged from their headers alone, and unsigned or
+    oversized deliveries are rejected before the body is fully read.
+    Every delivery starts a trace whose id is derived from X-Gitea-Delivery; the
+    queued job carries it so the review's spans join the same trace.
     """
+    with tracing.span('webhook', trace_id=tracing.trace_id_from_delivery(x_gitea_delivery),
+                      delivery=x_gitea_delivery, event=x_gitea_event, event_type=x_gitea_event_type):
+        return await _receive_webhook(request, x_gitea_signature, x_gitea_event, x_gitea_event_type, x_gitea_delivery)
+
+
+async def _receive_webhook(request: Request, x_gitea_signature: str | None, x_gitea_event: str | None,
+                           x_gitea_event_type: str | None, x_gitea_delivery: str | None):
     webhook_received_time = time.monotonic()
-    logging.info("Webhook received. Verifying signature...")
-    # 1. Verify Signature
-    raw_body = await request.body()
+
+    # 1. Filter on event headers (no body read for pushes, comments, label changes, ...)
+    if not _is_relevant_event(x_gitea_event, x_gitea_event_type):
+        return _ignored(f"event {x_gitea_event}/{x_gitea_event_type}")
+
+    # 2. Cheap rejections: missing signature, oversized body
+    if GITEA_WEBHOOK_SECRET and not x_gitea_signature:
+        logging.warning("Request received without X-Gitea-Signature header.")
+        metrics.WEBHOOKS.labels(outcome='missing_signature').inc()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail='Missing X-Gitea-Signature header'
+        )
+    with tracing.span('webhook.read_body'):
+        raw_body = await _read_body(request, WEBHOOK_MAX_BODY_BYTES)
+    if raw_body is None:
+        logging.warning(f"Webhook body exceeds {WEBHOOK_MAX_BODY_BYTES} bytes. Rejecting with 413.")
+        metrics.WEBHOOKS.labels(outcome='too_large').inc()
+        raise HTTPException(status_code=413, detail='Payload too large')
+
+    # 3. Verify Signature
     if GITEA_WEBHOOK_SECRET:
-        if not x_gitea_signature:
-            logging.warning("Request received without X-Gitea-Signature header.")
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail='Missing X-Gitea-Signature header'
-            )
-        mac = hmac.new(GITEA_WEBHOOK_SECRET.encode('utf-8'), raw_body, hashlib.sha256)
-        expected_signature = mac.hexdigest()
-        if not hmac.compare_digest(expected_signature, x_gitea_signature):
+        with tracing.span('webhook.verify_signature', body_bytes=len(raw_body)):
+            mac = hmac.new(GITEA_WEBHOOK_SECRET.encode('utf-8'), raw_body, hashlib.sha256)
+            expected_signature = mac.hexdigest()
+            valid_signature = hmac.compare_digest(expected_signature, x_gitea_signature)
+        if not valid_signature:
             logging.error("Invalid webhook signature received.")
+            metrics.WEBHOOKS.labels(outcome='invalid_signature').inc()
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Invalid signature')
-        logging.info("Webhook signature verified successfully.")
-    else:
-        logging.warning("Skipping webhook signature verification (no secret configured).")
 
-    # 2. Parse Payload
+    # 4. Parse the verified bytes once and extract only what the review needs
     try:
-        payload = await request.json()
-    except json.JSONDecodeError:
+        payload = _loads(raw_body)
+    except ValueError:  # json.JSONDecodeError and orjson.JSONDecodeError are both ValueErrors
         logging.error("Invalid JSON payload received.")
+        metrics.WEBHOOKS.labels(outcome='invalid_payload').inc()
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid JSON payload')
+    pr_event = _extract_pr_event(payload)
+    if pr_event is None:
+        return _ignored("not a pull request payload")
+    action, pr_number, repo_full_name, head_sha = pr_event
+    tracing.current().set(action=action, repo=repo_full_name, pr=pr_number)
+    logging.debug(f"Webhook event details - Action: {action}, PR: {pr_number}, Repo: {repo_full_name}")
+    if action not in REVIEW_ACTIONS:
+        return _ignored(f"action {action}")
+    # Only an already-resolved profile is consulted here (no I/O); the worker re-checks
+    cached_profile = profile_store.cached(repo_full_name) if repo_full_name else None
+    if cached_profile is not None and not cached_profile.reviews(action):
+        return _ignored(f"action {action} not enabled for {repo_full_name}")
 
-    # 3. Check Event Type and Extract Data
-    action = payload.get('action')
-    is_pull_request = 'pull_request' in payload
-    logging.info(f"Webhook event details - Action: {action}, Is PR: {is_pull_request}")
-
-    if is_pull_request and action in ['opened', 'synchronize']:
-        pr_data = payload.get('pull_request', {})
-        repo_data = payload.get('repository', {})
-        pr_number = payload.get('number')
-        repo_full_name = repo_data.get('full_name')
+    if not pr_number or not repo_full_name:
+        logging.error(f"Missing PR number ({pr_number}) or repository name ({repo_full_name}) in payload.")
+        metrics.WEBHOOKS.labels(outcome='invalid_payload').inc()
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Missing PR number or repository name')
 
-        if not pr_number or not repo_full_name:
-             logging.error(f"Missing PR number ({pr_number}) or repository name ({repo_full_name}) in payload.")
-             # Return 400 Bad Request immediately
-             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Missing PR number or repository name')
+    # --- Backpressure ---
+    # Refuse new work once the queue is too deep; Gitea will redeliver later.
+    # Queue and store calls are blocking SQLite transactions (BEGIN IMMEDIATE waits on the
+    # write lock), so they run in worker threads rather than on the event loop.
+    queue_depth = await asyncio.to_thread(job_queue.depth)
+    if queue_depth >= JOB_QUEUE_MAX_DEPTH:
+        logging.warning(f"Job queue is full ({queue_depth} jobs). Rejecting PR #{pr_number} with 429.")
+        metrics.WEBHOOKS.labels(outcome='queue_full').inc()
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail='Review queue is full, retry later',
+            headers={'Retry-After': str(JOB_QUEUE_RETRY_AFTER)}
+        )
 
-        logging.info(f"Relevant PR event for PR #{pr_number} in repo '{repo_full_name}'. Scheduling background task.")
+    # --- Delivery Dedup ---
+    # Gitea retries on timeout and admins can redeliver: a delivery id seen before, or a
+    # head that is already queued, running or reviewed, is acknowledged without a new job.
+    duplicate = await asyncio.to_thread(review_store.claim_delivery, x_gitea_delivery, repo_full_name, pr_number, head_sha)
+    if duplicate:
+        logging.info(f"Duplicate delivery {x_gitea_delivery} for PR #{pr_number} in '{repo_full_name}' ({duplicate}). Ignoring.")
+        metrics.WEBHOOKS.labels(outcome='duplicate').inc()
+        tracing.current().set(outcome='duplicate', reason=duplicate)
+        return {'status': 'duplicate delivery ignored', 'pr_number': pr_number, 'reason': duplicate}
 
-        # --- Schedule Background Task ---
-        # Add the long-running task to FastAPI's background runner
-        background_tasks.add_task(process_pr_review, repo_full_name, pr_number)
+    # --- Enqueue Review Job ---
+    # Jobs are keyed per (repo, PR): a push that arrives while an earlier one is still
+    # waiting replaces it, and an in-flight review of an older head cancels itself.
+    trace = tracing.context()
+    with tracing.span('webhook.enqueue', repo=repo_full_name, pr=pr_number):
+        try:
+            job_id = await asyncio.to_thread(
+                job_queue.enqueue,
+                repo_full_name,
+                {'repo_full_name': repo_full_name, 'pr_number': pr_number, 'head_sha': head_sha, 'action': action,
+                 'trace': trace},
+                coalesce_key=f"{repo_full_name}#{pr_number}",
+                head_sha=head_sha,
+                delay=REVIEW_DEBOUNCE_SECONDS
+            )
+        except Exception:
+            await asyncio.to_thread(review_store.release_delivery, x_gitea_delivery, repo_full_name, pr_number, head_sha)
+            raise
+    if head_sha:  # Attach the job id, unless a worker already picked the job up
+        await asyncio.to_thread(review_store.set_state, repo_full_name, pr_number, head_sha, QUEUED,
+                                job_id=job_id, only_from=QUEUED)
+        # An older head still waiting was coalesced into this job; a later delivery for it must not be a duplicate
+        await asyncio.to_thread(review_store.supersede_queued, repo_full_name, pr_number, head_sha)
+    worker_pool.notify()
+    tracing.current().set(outcome='accepted', job_id=job_id)
 
-        # --- Return Immediate Response ---
-        response_time = time.monotonic() - webhook_received_time
-        logging.info(f"Returning 202 Accepted for PR #{pr_number} after {response_time:.2f} seconds.")
-        return {'status': 'webhook accepted for background processing', 'pr_number': pr_number}
-
-    else:
-        # Ignore other events peacefully
-        logging.info(f"Ignoring event (action: {action}, is_pr: {is_pull_request})")
-        return Response(
-             content=json.dumps({'status': 'event ignored'}),
-             status_code=status.HTTP_200_OK, # Explicitly 200 OK for ignored events
-             media_type='application/json'
-        )
+    # --- Return Immediate Response ---
+    logging.info(f"Queued review job {job_id} for PR #{pr_number} in '{repo_full_name}' "
+                 f"({(time.monotonic() - webhook_received_time) * 1000:.1f} ms).")
+    metrics.WEBHOOKS.labels(outcome='accepted').inc()
+    return {'status': 'webhook accepted for background processing', 'pr_number': pr_number, 'job_id': job_id}
 
 
 # --- Health Check Endpoint (Optional but Recommended) ---
 @app.get("/health", status_code=status.HTTP_200_OK, tags=["Health"])
 async def health_check():
     """Basic health check endpoint."""
-    return {"status": "ok"}
+    return {
+        "status": "ok",
+        "queue_depth": await asyncio.to_thread(job_queue.depth) if job_queue else None,
+        "review_cache": review_cache.stats(),
+        "agent_warmup": agent_warmup_state,
+        "agent_pools": agent_pools.health(),
+    }
+
+# --- Metrics Endpoint ---
+@app.get("/metrics", tags=["Health"])
+async def metrics_endpoint():
+    """Prometheus metrics, aggregated across gunicorn workers when PROMETHEUS_MULTIPROC_DIR is set."""
+    payload, content_type = metrics.render_metrics()
+    return Response(content=payload, media_type=content_type)
 
 # --- Running the server ---
 # Remove any if __name__ == '__main__': block
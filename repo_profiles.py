@@ -0,0 +1,271 @@
+# repo_profiles.py
+import os
+import json
+import time
+import logging
+import threading
+import itertools
+from fnmatch import fnmatch
+from dataclasses import dataclass, field, replace
+
+from agent import REVIEW_MODEL_NAME, REVIEW_INSTRUCTION, profile_instruction
+from diff_parser import DIFF_SKIP_GLOBS
+from diff_prefilter import DIFF_PREFILTER_ENABLED
+from gitea_tools import get_gitea_repo_file
+
+try:
+    import yaml
+    _PARSE_ERRORS = (ValueError, yaml.YAMLError)
+except ImportError:
+    yaml = None  # PyYAML is optional; profiles can also be written as JSON
+    _PARSE_ERRORS = (ValueError,)
+
+# --- Configuration ---
+# Central profile file (YAML or JSON), re-read when its modification time changes
+REPO_PROFILES_PATH = os.environ.get('REPO_PROFILES_PATH', '')
+# In-repo override, read from the default branch (so a PR cannot change its own review); empty disables it
+REPO_PROFILE_FILE = os.environ.get('REPO_PROFILE_FILE', '.prreviewbot.yml')
+# How long a fetched in-repo file is trusted before it is revalidated with its ETag
+REPO_PROFILE_TTL_SECONDS = float(os.environ.get('REPO_PROFILE_TTL_SECONDS', '300'))
+
+# PR actions a profile can enable
+REVIEW_EVENTS = ('opened', 'reopened', 'synchronize')
+DEFAULT_REVIEW_EVENTS = ('opened', 'synchronize')
+# Gitea sends "synchronized" for pushes to a PR (GitHub and older docs say "synchronize")
+ACTION_ALIASES = {'synchronized': 'synchronize'}
+
+
+def normalize_action(action: str | None) -> str | None:
+    return ACTION_ALIASES.get(action, action)
+
+
+@dataclass(frozen=True)
+class RepoProfile:
+    """How one repository is reviewed. Unset concurrency limits fall back to the process-wide settings."""
+    model: str = REVIEW_MODEL_NAME
+    instruction: str = REVIEW_INSTRUCTION
+    skip_globs: tuple[str, ...] = DIFF_SKIP_GLOBS
+    review_concurrency: int | None = None   # Parallel model calls per review (REVIEW_MAX_CONCURRENCY)
+    repo_concurrency: int | None = None     # Reviews of this repo at once (JOB_PER_REPO_CONCURRENCY)
+    events: tuple[str, ...] = DEFAULT_REVIEW_EVENTS
+    prefilter: bool = DIFF_PREFILTER_ENABLED            # Drop whitespace-only hunks before the model call
+    prefilter_keep_globs: tuple[str, ...] = ()          # Files whose whitespace-only hunks are always sent
+    sources: tuple[str, ...] = field(default=(), compare=False)  # Where the settings came from, for logs
+
+    def reviews(self, action: str | None) -> bool:
+        return action in self.events
+
+
+DEFAULT_PROFILE = RepoProfile()
+
+
+# --- Parsing ---
+def parse_profile_text(text: str, source: str) -> dict | None:
+    """Parses a YAML (or, without PyYAML, JSON) profile document. Returns None if it is malformed."""
+    try:
+        data = yaml.safe_load(text) if yaml is not None else json.loads(text)
+    except _PARSE_ERRORS as e:
+        logging.warning(f"Ignoring malformed review profile {source}: {e}")
+        return None
+    if data is None:
+        return {}
+    if not isinstance(data, dict):
+        logging.warning(f"Ignoring review profile {source}: expected a mapping, got {type(data).__name__}.")
+        return None
+    return data
+
+
+def _string_list(value) -> tuple[str, ...] | None:
+    if isinstance(value, str):
+        value = [value]
+    if isinstance(value, list) and all(isinstance(item, str) for item in value):
+        return tuple(item.strip() for item in value if item.strip())
+    return None
+
+
+def _positive_int(value) -> int | None:
+    return value if isinstance(value, int) and not isinstance(value, bool) and value > 0 else None
+
+
+def apply_profile(profile: RepoProfile, data: dict, source: str) -> RepoProfile:
+    """
+    Layers one profile mapping over `profile`. Recognized keys:
+      model, instruction (the review focus; the finding format is appended),
+      skip_globs (added to the inherited ones), review_concurrency,
+      repo_concurrency, events (PR actions to review), enabled (false = no events),
+      prefilter (false = send whitespace-only hunks too), prefilter_keep_globs
+      (files whose whitespace-only hunks are sent anyway, added to the inherited ones).
+    Invalid values are logged and ignored.
+    """
+    changes = {}
+    for key, value in data.items():
+        if key == 'model' and isinstance(value, str) and value.strip():
+            changes['model'] = value.strip()
+        elif key == 'instruction' and isinstance(value, str) and value.strip():
+            changes['instruction'] = profile_instruction(value)
+        elif key == 'skip_globs' and _string_list(value) is not None:
+            changes['skip_globs'] = tuple(dict.fromkeys(profile.skip_globs + _string_list(value)))
+        elif key in ('review_concurrency', 'repo_concurrency') and _positive_int(value):
+            changes[key] = value
+        elif key == 'events' and _string_list(value) is not None \
+                and {normalize_action(event) for event in _string_list(value)} <= set(REVIEW_EVENTS):
+            changes['events'] = tuple(dict.fromkeys(normalize_action(event) for event in _string_list(value)))
+        elif key == 'prefilter' and isinstance(value, bool):
+            changes['prefilter'] = value
+        elif key == 'prefilter_keep_globs' and _string_list(value) is not None:
+            changes['prefilter_keep_globs'] = tuple(dict.fromkeys(profile.prefilter_keep_globs + _string_list(value)))
+        elif key == 'enabled' and isinstance(value, bool):
+            if not value:
+                changes['events'] = ()
+        else:
+            logging.warning(f"Ignoring invalid review profile setting {key}={value!r} in {source}.")
+    if not changes:
+        return profile
+    return replace(profile, sources=profile.sources + (source,), **changes)
+
+
+# --- Profile Store ---
+@dataclass
+class _RepoFile:
+    data: dict | None       # Parsed in-repo profile, None if the repo has none
+    etag: str | None
+    checked_at: float
+    version: int
+
+
+class ProfileStore:
+    """
+    Resolves the review profile of a repository: built-in defaults, then the
+    central file's `defaults`, then its `repos` entries whose pattern matches the
+    repo name (wildcards first, exact name last), then the repo's own profile file.
+
+    The central file is re-read when its modification time changes. In-repo files
+    are cached for `ttl` seconds and then revalidated with If-None-Match, so an
+    unchanged file costs a 304 and a repo without one a 404, at most once per TTL.
+    Resolved profiles are memoized until either source changes.
+    """
+
+    def __init__(self, central_path: str = REPO_PROFILES_PATH, repo_file: str = REPO_PROFILE_FILE,
+                 ttl: float = REPO_PROFILE_TTL_SECONDS, fetch=get_gitea_repo_file):
+        self.central_path = central_path
+        self.repo_file = repo_file
+        self.ttl = ttl
+        self.fetch = fetch  # fetch(repo, path, etag) -> (status, text, etag) | None
+        self._central: dict = {}
+        self._central_mtime: float | None = None
+        self._central_version = 0
+        self._repo_files: dict[str, _RepoFile] = {}
+        self._resolved: dict[str, tuple[tuple[int, int], RepoProfile]] = {}
+        self._versions = itertools.count(1)
+        self._lock = threading.Lock()
+        self._fetch_locks: dict[str, threading.Lock] = {}
+
+    def _refresh_central(self):
+        if not self.central_path:
+            return
+        try:
+            mtime = os.stat(self.central_path).st_mtime
+        except OSError as e:
+            if self._central_mtime is not None:
+                logging.warning(f"Central review profiles {self.central_path} unavailable ({e}). Keeping last loaded version.")
+                self._central_mtime = None
+            return
+        if mtime == self._central_mtime:
+            return
+        with self._lock:
+            if mtime == self._central_mtime:
+                return
+            try:
+                with open(self.central_path, 'r', encoding='utf-8') as f:
+                    data = parse_profile_text(f.read(), self.central_path)
+            except OSError as e:
+                logging.error(f"Could not read central review profiles {self.central_path}: {e}")
+                return
+            self._central_mtime = mtime
+            if data is None:
+                return  # Keep the last good version until the file is fixed
+            self._central = data
+            self._central_version = next(self._versions)
+            logging.info(f"Loaded central review profiles from {self.central_path} "
+                         f"({len(data.get('repos') or {})} repo entries).")
+
+    def _central_layers(self, repo_full_name: str) -> list[tuple[dict, str]]:
+        layers = []
+        defaults = self._central.get('defaults')
+        if isinstance(defaults, dict):
+            layers.append((defaults, f"{self.central_path}:defaults"))
+        repos = self._central.get('repos')
+        if isinstance(repos, dict):
+            matching = [pattern for pattern in repos if fnmatch(repo_full_name, pattern)]
+            for pattern in sorted(matching, key=lambda p: (p == repo_full_name, len(p))):
+                if isinstance(repos[pattern], dict):
+                    layers.append((repos[pattern], f"{self.central_path}:{pattern}"))
+        return layers
+
+    def _repo_profile_file(self, repo_full_name: str) -> _RepoFile | None:
+        if not self.repo_file:
+            return None
+        entry = self._repo_files.get(repo_full_name)
+        if entry is not None and time.monotonic() - entry.checked_at < self.ttl:
+            return entry
+        with self._lock:
+            fetch_lock = self._fetch_locks.setdefault(repo_full_name, threading.Lock())
+        with fetch_lock:  # One revalidation per repo at a time; the others reuse its result
+            entry = self._repo_files.get(repo_full_name)
+            now = time.monotonic()
+            if entry is not None and now - entry.checked_at < self.ttl:
+                return entry
+            result = self.fetch(repo_full_name, self.repo_file, entry.etag if entry else None)
+            if result is None:
+                # Gitea unreachable: keep what we have (or nothing) and try again after another TTL
+                entry = entry or _RepoFile(data=None, etag=None, checked_at=now, version=next(self._versions))
+                entry.checked_at = now
+            elif result[0] == 304 and entry is not None:
+                entry.checked_at = now
+            elif result[0] == 200:
+                data = parse_profile_text(result[1], f"{repo_full_name}:{self.repo_file}")
+                entry = _RepoFile(data=data, etag=result[2], checked_at=now, version=next(self._versions))
+                logging.info(f"Loaded review profile {self.repo_file} from {repo_full_name}.")
+            else:
+                entry = _RepoFile(data=None, etag=None, checked_at=now, version=next(self._versions))
+            self._repo_files[repo_full_name] = entry
+            return entry
+
+    def _resolve(self, repo_full_name: str, repo_file: _RepoFile | None) -> RepoProfile:
+        profile = DEFAULT_PROFILE
+        for data, source in self._central_layers(repo_full_name):
+            profile = apply_profile(profile, data, source)
+        if repo_file is not None and repo_file.data:
+            profile = apply_profile(profile, repo_file.data, f"{repo_full_name}:{self.repo_file}")
+        return profile
+
+    def get(self, repo_full_name: str) -> RepoProfile:
+        """The current profile for a repository (may revalidate its profile file with Gitea)."""
+        self._refresh_central()
+        repo_file = self._repo_profile_file(repo_full_name)
+        version = (self._central_version, repo_file.version if repo_file else 0)
+        with self._lock:
+            resolved = self._resolved.get(repo_full_name)
+            if resolved is not None and resolved[0] == version:
+                return resolved[1]
+            profile = self._resolve(repo_full_name, repo_file)
+            self._resolved[repo_full_name] = (version, profile)
+        if profile.sources:
+            logging.info(f"Review profile for {repo_full_name}: model {profile.model}, "
+                         f"events {list(profile.events)}, from {', '.join(profile.sources)}.")
+        return profile
+
+    def cached(self, repo_full_name: str) -> RepoProfile | None:
+        """The last resolved profile for a repository without any I/O, or None if it was never resolved."""
+        resolved = self._resolved.get(repo_full_name)
+        return resolved[1] if resolved is not None else None
+
+    def central_profiles(self) -> list[RepoProfile]:
+        """Distinct profiles defined by the central file (its defaults and each repo entry), for warming agents."""
+        self._refresh_central()
+        repos = self._central.get('repos')
+        patterns = list(repos) if isinstance(repos, dict) else []
+        return list(dict.fromkeys(self._resolve(pattern, None) for pattern in [''] + patterns))
+
+
+profile_store = ProfileStore()
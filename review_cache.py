@@ -0,0 +1,178 @@
+# review_cache.py
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import metrics
+
+# --- Configuration ---
+REVIEW_CACHE_BACKEND = os.environ.get('REVIEW_CACHE_BACKEND', 'memory').lower()  # memory | disk | off
+REVIEW_CACHE_DIR = os.environ.get('REVIEW_CACHE_DIR', '/tmp/prreviewbot-review-cache')
+REVIEW_CACHE_MAX_ENTRIES = int(os.environ.get('REVIEW_CACHE_MAX_ENTRIES', '2048'))
+REVIEW_CACHE_TTL_SECONDS = float(os.environ.get('REVIEW_CACHE_TTL_SECONDS', str(7 * 24 * 3600)))
+
+
+# --- Backends ---
+class MemoryCacheBackend:
+    """Per-process LRU with TTL."""
+
+    def __init__(self, max_entries: int = REVIEW_CACHE_MAX_ENTRIES, ttl: float = REVIEW_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.time() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value):
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskCacheBackend:
+    """
+    One JSON file per key under `directory`, shared by every worker process on the host.
+    File mtime doubles as the LRU clock: reads touch it, and the oldest files are
+    removed once `max_entries` is exceeded.
+    """
+
+    def __init__(self, directory: str = REVIEW_CACHE_DIR, max_entries: int = REVIEW_CACHE_MAX_ENTRIES,
+                 ttl: float = REVIEW_CACHE_TTL_SECONDS):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str):
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                value = json.load(f)
+            os.utime(path)
+            return value
+        except (OSError, ValueError):
+            return None
+
+    def set(self, key: str, value):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(value, f)
+            os.replace(tmp_path, path)  # Atomic, so concurrent readers never see a partial file
+        except OSError as e:
+            logging.error(f"Could not write review cache entry {path}: {e}")
+            return
+        self._evict()
+
+    def _evict(self):
+        try:
+            entries = [e for e in os.scandir(self.directory) if e.name.endswith('.json')]
+        except OSError:
+            return
+        excess = len(entries) - self.max_entries
+        if excess <= 0:
+            return
+        for entry in sorted(entries, key=lambda e: e.stat().st_mtime)[:excess]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def __len__(self):
+        try:
+            return sum(1 for name in os.listdir(self.directory) if name.endswith('.json'))
+        except OSError:
+            return 0
+
+
+# --- Cache Front ---
+class ReviewCache:
+    """
+    Content-addressed store of review findings, one entry per reviewed file (or
+    part of a split file). Keys combine the model name, the agent instruction and
+    the file's normalized hunk hash, so identical changes re-pushed or rebased map
+    to the same entry while any prompt or model change starts fresh.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model: str, instruction: str, file_hashes: list[str]) -> str:
+        digest = hashlib.sha256()
+        digest.update(model.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(hashlib.sha256(instruction.encode('utf-8')).digest())
+        for file_hash in sorted(file_hashes):
+            digest.update(b'\0')
+            digest.update(file_hash.encode('ascii'))
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        value = self.backend.get(key) if self.backend is not None else None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        metrics.CACHE_REQUESTS.labels(result='miss' if value is None else 'hit').inc()
+        return value
+
+    def set(self, key: str, value):
+        if self.backend is not None:
+            self.backend.set(key, value)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'backend': REVIEW_CACHE_BACKEND,
+                'entries': len(self.backend) if self.backend is not None else 0,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 3) if total else 0.0,
+            }
+
+
+def create_review_cache() -> ReviewCache:
+    """Builds the cache backend selected by REVIEW_CACHE_BACKEND."""
+    if REVIEW_CACHE_BACKEND == 'off':
+        logging.info("Review cache disabled.")
+        return ReviewCache(None)
+    if REVIEW_CACHE_BACKEND == 'disk':
+        logging.info(f"Using disk review cache at {REVIEW_CACHE_DIR}")
+        return ReviewCache(DiskCacheBackend(REVIEW_CACHE_DIR))
+    return ReviewCache(MemoryCacheBackend())
+
+
+review_cache = create_review_cache()
@@ -0,0 +1,166 @@
+# review_comments.py
+import os
+import re
+import logging
+from bisect import bisect_right
+from dataclasses import dataclass, field
+
+from diff_parser import FileDiff
+
+# --- Configuration ---
+# A finding whose line is not in the diff is moved to the nearest commented-on line
+# within this distance; further away it stays in the review body instead.
+REVIEW_COMMENT_MAX_LINE_DRIFT = int(os.environ.get('REVIEW_COMMENT_MAX_LINE_DRIFT', '3'))
+
+SEVERITIES = ('critical', 'warning', 'suggestion')
+BULLET_RE = re.compile(r'^\s*(?:[-*+]|\d+[.)])\s+')
+# "- [warning] lib/foo.dart:42: message" (backticks/bold around the parts are tolerated)
+FINDING_RE = re.compile(
+    r'^\s*(?:[-*+]|\d+[.)])\s+\**\[(critical|warning|suggestion)\]\**\s+`?([^\s`:]+):(\d+)`?\**\s*[:\-–—]\s*(.+)$',
+    re.IGNORECASE | re.DOTALL
+)
+SEVERITY_LABELS = {'critical': '🔴 **Critical**', 'warning': '🟠 **Warning**', 'suggestion': '🔵 **Suggestion**'}
+
+
+# --- Structured Findings ---
+@dataclass
+class Finding:
+    """One line-level finding parsed from the model's review text."""
+    path: str
+    line: int
+    severity: str
+    message: str
+
+
+@dataclass
+class InlineComment:
+    path: str
+    new_line: int
+    severity: str
+    body: str
+
+    def to_gitea(self) -> dict:
+        # Gitea's review API takes new-file line numbers in `new_position`
+        return {'path': self.path, 'body': self.body, 'new_position': self.new_line, 'old_position': 0}
+
+
+@dataclass
+class PullReview:
+    """A review ready to submit in one request: summary body plus inline comments."""
+    body: str
+    comments: list[InlineComment] = field(default_factory=list)
+
+
+def parse_finding(item: str) -> Finding | None:
+    match = FINDING_RE.match(item)
+    if not match:
+        return None
+    severity, path, line, message = match.groups()
+    return Finding(path=path.removeprefix('./'), line=int(line), severity=severity.lower(), message=message.strip())
+
+
+def split_items(text: str) -> list[str]:
+    """
+    Splits review text into blocks: bullets (with continuation lines), headings and
+    other lines. Blank lines come back as empty blocks.
+    """
+    items = []
+    for line in text.splitlines():
+        if BULLET_RE.match(line) or line.startswith('#') or not items or not items[-1].strip():
+            items.append(line.rstrip())
+        elif line.strip() and BULLET_RE.match(items[-1]):
+            items[-1] += '\n' + line.rstrip()
+        else:
+            items.append(line.rstrip())
+    return items
+
+
+def parse_findings(text: str) -> list[Finding]:
+    """Extracts all line-level findings from a review (single-call or merged)."""
+    return [finding for item in split_items(text) if (finding := parse_finding(item))]
+
+
+def _rebase_line(line: int, old_starts: list[int], new_starts: list[int]) -> int:
+    if not old_starts or len(old_starts) != len(new_starts):
+        return line
+    index = max(0, bisect_right(old_starts, line) - 1)
+    return line + new_starts[index] - old_starts[index]
+
+
+def rebase_findings(text: str, moves: dict[str, tuple[list[int], list[int]]]) -> str:
+    """
+    Rewrites the line numbers of line-level findings written against an earlier
+    position of the same hunks (e.g. cached before a rebase). `moves` maps a path
+    to (hunk start lines then, hunk start lines now); each finding moves with the
+    hunk it falls in (or the nearest hunk above it).
+    """
+    out = []
+    for line in text.splitlines(keepends=True):
+        match = FINDING_RE.match(line.rstrip('\n'))
+        path = _match_path(match.group(2).removeprefix('./'), moves) if match else None
+        if path is not None:
+            new_line = _rebase_line(int(match.group(3)), *moves[path])
+            line = f"{line[:match.start(3)]}{new_line}{line[match.end(3):]}"
+        out.append(line)
+    return ''.join(out)
+
+
+# --- Mapping Onto The Diff ---
+def _snap(lines: list[int], line: int) -> int | None:
+    """Returns `line` if it is in the diff, else the closest diff line within the allowed drift."""
+    if not lines:
+        return None
+    closest = min(lines, key=lambda n: (abs(n - line), n))
+    return closest if abs(closest - line) <= REVIEW_COMMENT_MAX_LINE_DRIFT else None
+
+
+def _match_path(path: str, commentable: dict[str, list[int]]) -> str | None:
+    if path in commentable:
+        return path
+    # The model sometimes shortens paths; accept a unique suffix match
+    candidates = [p for p in commentable if p.endswith('/' + path)]
+    return candidates[0] if len(candidates) == 1 else None
+
+
+def _drop_empty_headings(items: list[str]) -> list[str]:
+    """Removes section headings whose findings all moved inline, and doubled blank lines."""
+    kept = []
+    for index, item in enumerate(items):
+        if item.startswith('#'):
+            following = next((other for other in items[index + 1:] if other.strip()), '')
+            if not following or following.startswith('#'):
+                continue
+        if not item.strip() and (not kept or not kept[-1].strip()):
+            continue
+        kept.append(item)
+    return kept
+
+
+def build_pull_review(text: str, files: list[FileDiff]) -> PullReview:
+    """
+    Turns review text into a PullReview. Line-level findings that map onto lines of
+    the diff become inline comments; everything else (general remarks, findings on
+    lines outside the diff, the "Not reviewed" section) stays in the review body.
+    """
+    commentable = {f.path: f.new_lines() for f in files if f.hunks and not f.skipped_reason}
+    body_items = []
+    comments = []
+    for item in split_items(text):
+        finding = parse_finding(item)
+        path = _match_path(finding.path, commentable) if finding else None
+        line = _snap(commentable[path], finding.line) if path else None
+        if line is None:
+            body_items.append(item)
+            continue
+        comments.append(InlineComment(
+            path=path, new_line=line, severity=finding.severity,
+            body=f"{SEVERITY_LABELS[finding.severity]}: {finding.message}"
+        ))
+
+    body_items = _drop_empty_headings(body_items)
+    if comments:
+        counts = {s: sum(1 for c in comments if c.severity == s) for s in SEVERITIES}
+        summary = ', '.join(f"{n} {s}" for s, n in counts.items() if n)
+        body_items.append(f"\n*{len(comments)} inline comment{'s' if len(comments) != 1 else ''} ({summary}).*")
+    logging.info(f"Built pull review with {len(comments)} inline comments ({len(parse_findings(text))} line-level findings).")
+    return PullReview(body='\n'.join(body_items).strip(), comments=comments)
@@ -0,0 +1,349 @@
+# review_pipeline.py
+import os
+import re
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from agent import REVIEW_MODEL_NAME, REVIEW_INSTRUCTION
+from agent_runner import run_analysis, is_failed_analysis, RATE_LIMITED_MESSAGE
+from diff_parser import FileDiff, chunk_file_diff, estimate_tokens, hunk_hash, hunk_starts, DIFF_CHUNK_TOKEN_BUDGET
+from review_cache import review_cache
+from review_comments import rebase_findings, parse_finding, split_items, BULLET_RE
+from token_budget import call_token_budget
+import metrics
+import tracing
+
+# --- Configuration ---
+REVIEW_MAX_CONCURRENCY = int(os.environ.get('REVIEW_MAX_CONCURRENCY', '4'))         # parallel model calls per review
+REVIEW_MAX_CALLS_PER_MINUTE = int(os.environ.get('REVIEW_MAX_CALLS_PER_MINUTE', '60'))  # per process, 0 = unlimited
+REVIEW_RATE_LIMIT_RETRIES = int(os.environ.get('REVIEW_RATE_LIMIT_RETRIES', '3'))
+
+# The reply shape (heading line, "no issues" sentence) is read from the instruction in use
+HEADING_INSTRUCTION_RE = re.compile(r'Start your response with "([^"\n]+)"')
+NO_ISSUES_INSTRUCTION_RE = re.compile(r"If no significant issues are found, state '([^'\n]+)'")
+NO_ISSUES_RE = re.compile(r'no major .*issues identified', re.IGNORECASE)
+
+
+# --- Rate Limiting ---
+class CallRateLimiter:
+    """
+    Process-wide token bucket for model calls, shared by all reviews in flight.
+    Bursts up to `calls_per_minute` calls, then refills steadily. `backoff()`
+    pauses every caller after the endpoint reports a rate limit.
+    """
+
+    def __init__(self, calls_per_minute: int):
+        self.capacity = float(calls_per_minute)
+        self.refill_per_second = calls_per_minute / 60.0
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.capacity <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.refill_per_second)
+                self._updated = now
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_for = max(self._paused_until - now, (1 - self._tokens) / self.refill_per_second)
+            time.sleep(wait_for)
+
+    def backoff(self, seconds: float):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+rate_limiter = CallRateLimiter(REVIEW_MAX_CALLS_PER_MINUTE)
+
+
+# --- Map: Chunking ---
+def review_units(files: list[FileDiff], token_budget: int = DIFF_CHUNK_TOKEN_BUDGET) -> list[FileDiff]:
+    """Drops skip-listed files and splits oversized ones into budget-sized parts."""
+    units = []
+    for file_diff in files:
+        if file_diff.skipped_reason:
+            logging.info(f"Skipping '{file_diff.path}' ({file_diff.skipped_reason}, +{file_diff.additions}/-{file_diff.deletions}).")
+            continue
+        if not file_diff.hunks:
+            continue  # Renames and mode changes without content
+        units.extend(chunk_file_diff(file_diff, token_budget))
+    return units
+
+
+def group_units(units: list[FileDiff], token_budget: int = DIFF_CHUNK_TOKEN_BUDGET) -> list[list[FileDiff]]:
+    """
+    Packs review units into model-call chunks: small files in the same directory
+    share a chunk up to `token_budget`, split parts of a large file stay alone.
+    """
+    by_directory = {}
+    for unit in units:
+        by_directory.setdefault(unit.path.rsplit('/', 1)[0] if '/' in unit.path else '', []).append(unit)
+
+    chunks = []
+    for directory in sorted(by_directory):
+        current, used = [], 0
+        for unit in sorted(by_directory[directory], key=lambda u: (u.path, u.part or (0, 0))):
+            tokens = estimate_tokens(unit.render())
+            if unit.part or (current and used + tokens > token_budget):
+                if current:
+                    chunks.append(current)
+                current, used = [], 0
+            if unit.part:
+                chunks.append([unit])
+                continue
+            current.append(unit)
+            used += tokens
+        if current:
+            chunks.append(current)
+    return chunks
+
+
+def _unit_order(unit: FileDiff) -> tuple:
+    """Same order as group_units: by directory, then path, then part."""
+    return (unit.path.rsplit('/', 1)[0] if '/' in unit.path else '', unit.path, unit.part or (0, 0))
+
+
+def _chunk_title(chunk: list[FileDiff]) -> str:
+    titles = []
+    for unit in chunk:
+        if unit.part:
+            titles.append(f"`{unit.path}` (part {unit.part[0]}/{unit.part[1]})")
+        else:
+            titles.append(f"`{unit.path}`")
+    return ', '.join(titles)
+
+
+def _review_chunk(chunk: list[FileDiff], should_cancel, on_text=None, usage=None,
+                  model: str = REVIEW_MODEL_NAME, instruction: str = REVIEW_INSTRUCTION) -> str | None:
+    """Runs one model call for a chunk, retrying with jittered backoff when rate limited."""
+    diff_text = ''.join(unit.render(numbered=True) for unit in chunk)
+    estimated = estimate_tokens(diff_text) + estimate_tokens(instruction)
+    with tracing.span('review.chunk', files=', '.join(unit.path for unit in chunk), estimated_tokens=estimated) as span:
+        for attempt in range(REVIEW_RATE_LIMIT_RETRIES + 1):
+            with tracing.span('rate_limiter.acquire'):
+                rate_limiter.acquire()
+            if usage is not None:
+                usage.add_estimate(estimated)
+            metrics.MODEL_TOKENS_ESTIMATED.labels(model=model).inc(estimated)
+            result = run_analysis(diff_text, should_cancel=should_cancel, on_text=on_text, usage=usage,
+                                  model=model, instruction=instruction)
+            if result != RATE_LIMITED_MESSAGE or attempt == REVIEW_RATE_LIMIT_RETRIES:
+                span.set(attempts=attempt + 1)
+                return result
+            delay = min(60.0, 2 ** attempt * 5) * (0.5 + random.random())
+            logging.warning(f"Rate limited reviewing {_chunk_title(chunk)}. Backing off {delay:.1f} seconds.")
+            span.event('rate_limited', attempt=attempt + 1, backoff_s=delay)
+            rate_limiter.backoff(delay)
+        return RATE_LIMITED_MESSAGE
+
+
+# --- Per-File Cache Entries ---
+def _item_owner(item: str, chunk: list[FileDiff]) -> int | None:
+    """The unit of `chunk` an item is about: its finding's file, else the only file it names."""
+    if len(chunk) == 1:
+        return 0
+    finding = parse_finding(item)
+    if finding:
+        for index, unit in enumerate(chunk):
+            if unit.path == finding.path or unit.path.endswith('/' + finding.path):
+                return index
+    named = [
+        index for index, unit in enumerate(chunk)
+        if re.search(rf"(?<![\w.-]){re.escape(unit.path.rsplit('/', 1)[-1])}(?![\w-])", item)
+    ]
+    return named[0] if len(named) == 1 else None
+
+
+def split_chunk_review(chunk: list[FileDiff], result: str) -> tuple[str | None, list[list[str]] | None]:
+    """
+    Splits one chunk's review into the items about each of its units, so every file
+    gets its own cache entry. If any item is about several files or none, the units
+    are None: cached on their own, a later hit would drop that item.
+    """
+    heading, body = _split_heading(result)
+    if len(chunk) == 1:
+        return heading, [[body] if body else []]
+    per_unit = [[] for _ in chunk]
+    for item in filter(str.strip, split_items(body)):
+        if NO_ISSUES_RE.search(item):
+            continue
+        owner = _item_owner(item, chunk)
+        if owner is None:
+            return heading, None
+        per_unit[owner].append(item)
+    return heading, per_unit
+
+
+def _cached_unit_text(unit: FileDiff, entry: dict, heading: str, no_issues: str) -> str:
+    body = '\n'.join(entry['items']) or no_issues
+    text = f"{entry['heading'] or heading}\n\n{body}"
+    # The key ignores where the hunks sit; move the findings to their current lines
+    return rebase_findings(text, {unit.path: (entry['starts'], hunk_starts(unit))})
+
+
+# --- Reduce: Merging ---
+def _reply_shape(instruction: str) -> tuple[str, str]:
+    """The heading line and "no issues" sentence `instruction` asks the model to write."""
+    heading = HEADING_INSTRUCTION_RE.search(instruction)
+    no_issues = NO_ISSUES_INSTRUCTION_RE.search(instruction)
+    return (heading.group(1) if heading else "AI Code Review Analysis:",
+            no_issues.group(1) if no_issues else "No major issues identified in this analysis.")
+
+
+def _split_heading(result: str) -> tuple[str | None, str]:
+    """Separates the agent's leading "... Analysis:" line from the findings."""
+    first_line, _, rest = result.strip().partition('\n')
+    if first_line.rstrip('*').rstrip().endswith('Analysis:'):
+        return first_line.strip('* '), rest.strip()
+    return None, result.strip()
+
+
+def _item_key(item: str) -> str:
+    return re.sub(r'[\W_]+', ' ', BULLET_RE.sub('', item)).strip().lower()
+
+
+def merge_chunk_reviews(chunk_reviews: list[tuple[list[FileDiff], str]], failed: list[list[FileDiff]] = (),
+                        instruction: str = REVIEW_INSTRUCTION) -> str:
+    """
+    Combines per-chunk review texts into a single comment: one heading, one
+    section per chunk, findings repeated across chunks reported once, and
+    "no issues" sections folded away. Missing heading and "no issues" text
+    follow `instruction`.
+    """
+    if len(chunk_reviews) == 1 and not failed:
+        return chunk_reviews[0][1]
+
+    default_heading, no_issues = _reply_shape(instruction)
+    heading = None
+    seen = set()
+    sections = []
+    for chunk, result in chunk_reviews:
+        chunk_heading, body = _split_heading(result)
+        heading = heading or chunk_heading
+        items = []
+        for item in filter(str.strip, split_items(body)):
+            key = _item_key(item)
+            if NO_ISSUES_RE.search(item) or key in seen:
+                continue
+            seen.add(key)
+            items.append(item)
+        if items:
+            sections.append(f"#### {_chunk_title(chunk)}\n" + '\n'.join(items))
+
+    if failed:
+        sections.append("#### Not reviewed\n" + '\n'.join(
+            f"* {_chunk_title(chunk)}: the AI review failed for this part of the diff." for chunk in failed
+        ))
+    if not sections:
+        sections.append(no_issues)
+    return f"{heading or default_heading}\n\n" + "\n\n".join(sections)
+
+
+# --- Map-Reduce Review ---
+def review_files(files: list[FileDiff], should_cancel=None, repo: str = '', on_progress=None,
+                 usage=None, model: str = REVIEW_MODEL_NAME, instruction: str = REVIEW_INSTRUCTION,
+                 max_concurrency: int | None = None) -> str | None:
+    """
+    Reviews a PR by splitting it into per-directory chunks and reviewing the
+    chunks concurrently (at most `max_concurrency`, by default REVIEW_MAX_CONCURRENCY,
+    model calls at once), then merging the partial findings into one comment.
+    Files already reviewed with the same model and instruction come from the
+    review cache and are left out of the chunks, so only changed files are sent.
+    `on_progress(index, total, text, done)` receives each chunk's text as it
+    streams in (and once more when the chunk is finished). Estimated and reported
+    token counts of the model calls are added to `usage` when given.
+    Returns None if there is nothing to review or `should_cancel` fired.
+    """
+    token_budget = call_token_budget(model, estimate_tokens(instruction))
+    units = review_units(files, token_budget)
+    if not units:
+        return None
+    active = tracing.current()
+
+    start_time = time.monotonic()
+    default_heading, no_issues = _reply_shape(instruction)
+    # Each section of the review is either one cached unit or one model-call chunk
+    sections = []
+    keys = {}
+    misses = []
+    for unit in units:
+        key = review_cache.make_key(model, instruction, [hunk_hash(unit)])
+        cached = review_cache.get(key)
+        if isinstance(cached, dict):
+            logging.info(f"Review cache hit for {_chunk_title([unit])}.")
+            sections.append(([unit], _cached_unit_text(unit, cached, default_heading, no_issues)))
+        else:
+            keys[id(unit)] = key
+            misses.append(unit)
+    cached_units = len(sections)
+    model_chunks = group_units(misses, token_budget)
+    sections.extend((chunk, None) for chunk in model_chunks)
+    sections.sort(key=lambda section: _unit_order(section[0][0]))
+    chunks = [chunk for chunk, _ in sections]
+    metrics.REVIEW_CHUNKS.labels(repo=repo).observe(len(model_chunks))
+    if active is not None:
+        active.set(chunks=len(model_chunks), cached_units=cached_units)
+
+    results = {}
+    pending = []
+    for index, (chunk, cached_text) in enumerate(sections):
+        if cached_text is None:
+            pending.append(index)
+            continue
+        results[index] = cached_text
+        if on_progress:
+            on_progress(index, len(chunks), cached_text, True)
+
+    if pending:
+        with ThreadPoolExecutor(max_workers=min(max_concurrency or REVIEW_MAX_CONCURRENCY, len(pending)),
+                                thread_name_prefix='review-chunk') as executor:
+            def stream_to(index):
+                if on_progress:
+                    return lambda text: on_progress(index, len(chunks), text, False)
+                return None
+
+            futures = {
+                executor.submit(tracing.wrap(_review_chunk), chunks[index], should_cancel, stream_to(index), usage, model, instruction): index
+                for index in pending
+            }
+            not_done = set(futures)
+            while not_done:
+                done, not_done = wait(not_done, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = futures[future]
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logging.error(f"Review of {_chunk_title(chunks[index])} raised: {e}", exc_info=True)
+                        result = "Error: Failed to perform AI code review."
+                    if result is None:
+                        for other in not_done:
+                            other.cancel()
+                        return None  # Cancelled
+                    if not is_failed_analysis(result):
+                        heading, per_unit = split_chunk_review(chunks[index], result)
+                        for unit, items in zip(chunks[index], per_unit or ()):
+                            review_cache.set(keys[id(unit)], {'heading': heading, 'items': items, 'starts': hunk_starts(unit)})
+                    if on_progress:
+                        on_progress(index, len(chunks), '' if is_failed_analysis(result) else result, True)
+                    results[index] = result
+
+    chunk_reviews = [(chunks[i], results[i]) for i in sorted(results) if not is_failed_analysis(results[i])]
+    failed = [chunks[i] for i in sorted(results) if is_failed_analysis(results[i])]
+    logging.info(
+        f"Reviewed {len(units)} files/parts: {cached_units} from cache, {len(pending)} model calls ({len(failed)} failed) "
+        f"in {time.monotonic() - start_time:.2f} seconds. Cache stats: {review_cache.stats()}"
+    )
+    if not chunk_reviews:
+        # Surface the first failure as-is, as a single-call review would
+        return results[min(results)]
+    return merge_chunk_reviews(chunk_reviews, failed, instruction)
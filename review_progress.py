@@ -0,0 +1,114 @@
+# review_progress.py
+import os
+import time
+import threading
+from typing import Callable
+
+from gitea_tools import create_gitea_comment, edit_gitea_comment, delete_gitea_comment
+import metrics
+
+# --- Configuration ---
+REVIEW_PROGRESS_COMMENTS = os.environ.get('REVIEW_PROGRESS_COMMENTS', '1').lower() not in ('0', 'false', 'no')
+# Minimum time between PATCHes of the progress comment
+REVIEW_PROGRESS_INTERVAL_SECONDS = float(os.environ.get('REVIEW_PROGRESS_INTERVAL_SECONDS', '5'))
+
+PLACEHOLDER_BODY = "⏳ *AI review in progress. Findings will appear here as they are generated.*"
+
+
+class ProgressComment:
+    """
+    A placeholder PR comment that is edited as the model streams its review.
+    `update()` is called from the review threads with the text so far for one
+    chunk; edits are throttled to one PATCH per REVIEW_PROGRESS_INTERVAL_SECONDS,
+    and a thread never waits for another thread's PATCH (the newer text is sent
+    with the next edit instead).
+    `comment_id` is a placeholder left by an earlier attempt, reused instead of
+    posting another one; `track(comment_id | None)` is told whenever the comment
+    becomes or stops being a placeholder, so a later attempt can find it.
+    """
+
+    def __init__(self, repo_full_name: str, pr_number: int, min_interval: float = REVIEW_PROGRESS_INTERVAL_SECONDS,
+                 comment_id: int | None = None, track: Callable[[int | None], None] | None = None):
+        self.repo_full_name = repo_full_name
+        self.pr_number = pr_number
+        self.min_interval = min_interval
+        self.comment_id = comment_id
+        self._track = track
+        self._parts: dict[int, str] = {}
+        self._done: set[int] = set()
+        self._total = 0
+        self._dirty = False
+        self._started_at = time.monotonic()
+        self._last_flush = 0.0
+        self._first_feedback = False
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def start(self) -> bool:
+        """Posts the placeholder comment, or resets an earlier attempt's. Returns False if it could not be created."""
+        self._started_at = time.monotonic()
+        if self.comment_id is not None and not edit_gitea_comment(self.repo_full_name, self.comment_id, PLACEHOLDER_BODY):
+            self.comment_id = None  # Deleted on the PR in the meantime
+        if self.comment_id is None:
+            self.comment_id = create_gitea_comment(self.repo_full_name, self.pr_number, PLACEHOLDER_BODY)
+            if self.comment_id is not None and self._track:
+                self._track(self.comment_id)
+        self._last_flush = time.monotonic()
+        return self.comment_id is not None
+
+    def update(self, index: int, total: int, text: str, done: bool = False):
+        """Records the text so far for chunk `index` of `total` and edits the comment if the throttle allows."""
+        with self._lock:
+            self._total = total
+            self._parts[index] = text
+            if done:
+                self._done.add(index)
+            self._dirty = True
+        self._flush()
+
+    def _render(self) -> str:
+        texts = [self._parts[i].strip() for i in sorted(self._parts) if self._parts[i].strip()]
+        status_line = f"⏳ *AI review in progress: {len(self._done)}/{self._total} parts reviewed.*"
+        return status_line + ("\n\n" + "\n\n".join(texts) if texts else "")
+
+    def _flush(self):
+        if self.comment_id is None or not self._flush_lock.acquire(blocking=False):
+            return
+        try:
+            with self._lock:
+                if not self._dirty or time.monotonic() - self._last_flush < self.min_interval:
+                    return
+                body = self._render()
+                has_findings = any(text.strip() for text in self._parts.values())
+                self._dirty = False
+            self._last_flush = time.monotonic()
+            if edit_gitea_comment(self.repo_full_name, self.comment_id, body) and has_findings and not self._first_feedback:
+                self._first_feedback = True
+                metrics.STAGE_DURATION.labels(stage='first_feedback', repo=self.repo_full_name).observe(
+                    time.monotonic() - self._started_at
+                )
+        finally:
+            self._flush_lock.release()
+
+    def finish(self, body: str) -> bool:
+        """Replaces the placeholder with the final text, waiting for any in-flight edit first."""
+        if self.comment_id is None:
+            return False
+        with self._flush_lock:
+            self._dirty = False
+            if not edit_gitea_comment(self.repo_full_name, self.comment_id, body):
+                return False
+        if self._track:
+            self._track(None)  # It is the review now, not a placeholder
+        return True
+
+    def discard(self):
+        """Removes the placeholder (the review was posted elsewhere or is no longer wanted)."""
+        if self.comment_id is None:
+            return
+        with self._flush_lock:
+            self._dirty = False
+            if delete_gitea_comment(self.repo_full_name, self.comment_id):
+                self.comment_id = None
+                if self._track:
+                    self._track(None)
@@ -0,0 +1,275 @@
+# review_store.py
+import os
+import json
+import time
+import sqlite3
+import threading
+from dataclasses import dataclass, field
+
+# --- Configuration ---
+REVIEW_STORE_PATH = os.environ.get('REVIEW_STORE_PATH', '/tmp/prreviewbot-state.sqlite3')
+# Delivery ids and stored reviews older than this are pruned
+REVIEW_STORE_RETENTION_DAYS = float(os.environ.get('REVIEW_STORE_RETENTION_DAYS', '30'))
+# A head left QUEUED/RUNNING longer than this (coalesced away, worker died) no longer blocks new deliveries
+REVIEW_STORE_IN_FLIGHT_SECONDS = float(os.environ.get('REVIEW_STORE_IN_FLIGHT_SECONDS', '3600'))
+PRUNE_INTERVAL_SECONDS = 3600
+
+# Review states per (repo, PR, head SHA)
+QUEUED = 'queued'        # A job for this head was enqueued
+RUNNING = 'running'      # A worker is reviewing it
+COMPUTED = 'computed'    # The review text is stored but not (yet) posted
+POSTED = 'posted'        # The review is on the PR
+DONE = 'done'            # Finished without a model review (empty, pre-filtered, over budget, disabled)
+SUPERSEDED = 'superseded'  # Abandoned for a newer head; a later delivery for this head (force-push back) reviews it
+FAILED = 'failed'        # The last attempt failed (diff fetch, model, post); a redelivery tries again
+# A new delivery for a head in one of these states is a duplicate
+SETTLED_STATES = (POSTED, DONE)
+IN_FLIGHT_STATES = (QUEUED, RUNNING)
+
+
+@dataclass
+class StoredReview:
+    state: str
+    job_id: str | None = None
+    body: str | None = None          # Pull review summary as posted
+    comments: list[dict] = field(default_factory=list)  # Inline comments in Gitea's format
+    fallback_body: str | None = None  # Plain comment used when the pull review is rejected
+    complete: bool = True             # False if the diff was truncated: the head is not a base for incremental reviews
+    progress_comment_id: int | None = None  # "Review in progress" placeholder left on the PR by the last attempt
+    updated_at: float = 0.0
+
+
+class ReviewStore:
+    """
+    Persistent per-PR review state in a SQLite file shared by all worker processes.
+    Records the last head SHA that was reviewed for each PR, so later pushes can be
+    reviewed incrementally; the webhook delivery ids already accepted, so redeliveries
+    are dropped; and per head SHA the job state and the final review, so a review that
+    was computed once is re-posted instead of asking the model again.
+    """
+
+    def __init__(self, path: str = REVIEW_STORE_PATH):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS reviewed_heads (
+                repo TEXT NOT NULL,
+                pr_number INTEGER NOT NULL,
+                head_sha TEXT NOT NULL,
+                reviewed_at REAL NOT NULL,
+                PRIMARY KEY (repo, pr_number)
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS deliveries (
+                delivery_id TEXT PRIMARY KEY,
+                repo TEXT NOT NULL,
+                pr_number INTEGER NOT NULL,
+                head_sha TEXT,
+                received_at REAL NOT NULL
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS reviews (
+                repo TEXT NOT NULL,
+                pr_number INTEGER NOT NULL,
+                head_sha TEXT NOT NULL,
+                state TEXT NOT NULL,
+                job_id TEXT,
+                body TEXT,
+                comments TEXT,
+                fallback_body TEXT,
+                complete INTEGER NOT NULL DEFAULT 1,
+                progress_comment_id INTEGER,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (repo, pr_number, head_sha)
+            )
+            """
+        )
+        self._add_missing_columns(conn, 'reviews', {'complete': 'INTEGER NOT NULL DEFAULT 1',
+                                                    'progress_comment_id': 'INTEGER'})
+        self._pruned_at = 0.0
+
+    @staticmethod
+    def _add_missing_columns(conn: sqlite3.Connection, table: str, columns: dict[str, str]):
+        """Upgrades a store file created by an older version in place."""
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        for name, definition in columns.items():
+            if name in existing:
+                continue
+            try:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+            except sqlite3.OperationalError as e:
+                if 'duplicate column' not in str(e):  # Another worker process added it first
+                    raise
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 connections must not be shared across threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def last_reviewed_head(self, repo: str, pr_number: int) -> str | None:
+        row = self._conn().execute(
+            "SELECT head_sha FROM reviewed_heads WHERE repo = ? AND pr_number = ?", (repo, pr_number)
+        ).fetchone()
+        return row[0] if row else None
+
+    def record_reviewed_head(self, repo: str, pr_number: int, head_sha: str):
+        self._conn().execute(
+            "INSERT INTO reviewed_heads (repo, pr_number, head_sha, reviewed_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(repo, pr_number) DO UPDATE SET head_sha = excluded.head_sha, reviewed_at = excluded.reviewed_at",
+            (repo, pr_number, head_sha, time.time())
+        )
+
+
+    # --- Delivery Dedup ---
+    def claim_delivery(self, delivery_id: str | None, repo: str, pr_number: int, head_sha: str | None) -> str | None:
+        """
+        Atomically records a webhook delivery that is about to be enqueued. Returns the
+        reason it is a duplicate instead ("delivery" if the id was seen before, or the
+        state of an earlier job for the same head), in which case nothing is recorded.
+        Otherwise the head is marked QUEUED; call `release_delivery` if enqueueing fails.
+        """
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if delivery_id and conn.execute(
+                "SELECT 1 FROM deliveries WHERE delivery_id = ?", (delivery_id,)
+            ).fetchone():
+                conn.execute("ROLLBACK")
+                return 'delivery'
+            if head_sha:
+                row = conn.execute(
+                    "SELECT state, updated_at FROM reviews WHERE repo = ? AND pr_number = ? AND head_sha = ?",
+                    (repo, pr_number, head_sha)
+                ).fetchone()
+                if row and (row[0] in SETTLED_STATES
+                            or (row[0] in IN_FLIGHT_STATES and now - row[1] < REVIEW_STORE_IN_FLIGHT_SECONDS)):
+                    conn.execute("ROLLBACK")
+                    return row[0]
+                conn.execute(
+                    "INSERT INTO reviews (repo, pr_number, head_sha, state, updated_at) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(repo, pr_number, head_sha) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+                    (repo, pr_number, head_sha, QUEUED, now)
+                )
+            if delivery_id:
+                conn.execute(
+                    "INSERT INTO deliveries (delivery_id, repo, pr_number, head_sha, received_at) VALUES (?, ?, ?, ?, ?)",
+                    (delivery_id, repo, pr_number, head_sha, now)
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._maybe_prune(now)
+        return None
+
+    def release_delivery(self, delivery_id: str | None, repo: str, pr_number: int, head_sha: str | None):
+        """Forgets a claimed delivery that could not be enqueued, so Gitea's redelivery is accepted."""
+        conn = self._conn()
+        if delivery_id:
+            conn.execute("DELETE FROM deliveries WHERE delivery_id = ?", (delivery_id,))
+        if head_sha:
+            conn.execute(
+                "DELETE FROM reviews WHERE repo = ? AND pr_number = ? AND head_sha = ? AND state = ? AND body IS NULL",
+                (repo, pr_number, head_sha, QUEUED)
+            )
+
+    def supersede_queued(self, repo: str, pr_number: int, head_sha: str):
+        """
+        Marks the PR's other QUEUED heads SUPERSEDED once `head_sha` has been enqueued:
+        their waiting job was coalesced into this one, so nothing will review them
+        unless a later delivery (e.g. a force-push back) asks again.
+        """
+        self._conn().execute(
+            "UPDATE reviews SET state = ?, updated_at = ? WHERE repo = ? AND pr_number = ? AND head_sha != ? AND state = ?",
+            (SUPERSEDED, time.time(), repo, pr_number, head_sha, QUEUED)
+        )
+
+    def _maybe_prune(self, now: float):
+        if now - self._pruned_at < PRUNE_INTERVAL_SECONDS:
+            return
+        self._pruned_at = now
+        cutoff = now - REVIEW_STORE_RETENTION_DAYS * 86400
+        conn = self._conn()
+        conn.execute("DELETE FROM deliveries WHERE received_at < ?", (cutoff,))
+        conn.execute("DELETE FROM reviews WHERE updated_at < ?", (cutoff,))
+
+    # --- Review Results ---
+    def set_state(self, repo: str, pr_number: int, head_sha: str, state: str,
+                  job_id: str | None = None, only_from: str | None = None):
+        """
+        Moves a head to `state`. A POSTED head never moves back. With `only_from`,
+        the state only changes if it currently is `only_from`.
+        """
+        now = time.time()
+        if only_from:
+            self._conn().execute(
+                "UPDATE reviews SET state = ?, job_id = COALESCE(?, job_id), updated_at = ? "
+                "WHERE repo = ? AND pr_number = ? AND head_sha = ? AND state = ?",
+                (state, job_id, now, repo, pr_number, head_sha, only_from)
+            )
+            return
+        self._conn().execute(
+            "INSERT INTO reviews (repo, pr_number, head_sha, state, job_id, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(repo, pr_number, head_sha) DO UPDATE SET state = excluded.state, "
+            "job_id = COALESCE(excluded.job_id, reviews.job_id), updated_at = excluded.updated_at "
+            "WHERE reviews.state != ? OR excluded.state = ?",
+            (repo, pr_number, head_sha, state, job_id, now, POSTED, POSTED)
+        )
+
+    def save_review(self, repo: str, pr_number: int, head_sha: str, body: str, comments: list[dict],
+                    fallback_body: str, complete: bool = True):
+        """Stores the final review for a head (state COMPUTED) before it is posted."""
+        self._conn().execute(
+            "INSERT INTO reviews (repo, pr_number, head_sha, state, body, comments, fallback_body, complete, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(repo, pr_number, head_sha) DO UPDATE SET state = excluded.state, body = excluded.body, "
+            "comments = excluded.comments, fallback_body = excluded.fallback_body, complete = excluded.complete, "
+            "updated_at = excluded.updated_at",
+            (repo, pr_number, head_sha, COMPUTED, body, json.dumps(comments), fallback_body, int(complete), time.time())
+        )
+
+    def get_review(self, repo: str, pr_number: int, head_sha: str) -> StoredReview | None:
+        row = self._conn().execute(
+            "SELECT state, job_id, body, comments, fallback_body, complete, progress_comment_id, updated_at FROM reviews "
+            "WHERE repo = ? AND pr_number = ? AND head_sha = ?", (repo, pr_number, head_sha)
+        ).fetchone()
+        if row is None:
+            return None
+        return StoredReview(state=row[0], job_id=row[1], body=row[2], comments=json.loads(row[3]) if row[3] else [],
+                            fallback_body=row[4], complete=bool(row[5]), progress_comment_id=row[6], updated_at=row[7])
+
+    # --- Progress Comments ---
+    def set_progress_comment(self, repo: str, pr_number: int, head_sha: str, comment_id: int | None):
+        """Records (or, with None, forgets) the placeholder comment of the review of a head."""
+        self._conn().execute(
+            "UPDATE reviews SET progress_comment_id = ? WHERE repo = ? AND pr_number = ? AND head_sha = ?",
+            (comment_id, repo, pr_number, head_sha)
+        )
+
+    def stale_progress_comments(self, repo: str, pr_number: int, head_sha: str) -> list[tuple[str, int]]:
+        """
+        (head SHA, comment id) of placeholders left on a PR by reviews of its other heads
+        that are no longer running (superseded, failed, or their worker died).
+        """
+        return self._conn().execute(
+            "SELECT head_sha, progress_comment_id FROM reviews "
+            "WHERE repo = ? AND pr_number = ? AND head_sha != ? AND progress_comment_id IS NOT NULL "
+            "AND NOT (state IN (?, ?) AND updated_at >= ?)",
+            (repo, pr_number, head_sha, *IN_FLIGHT_STATES, time.time() - REVIEW_STORE_IN_FLIGHT_SECONDS)
+        ).fetchall()
+
+
+review_store = ReviewStore()
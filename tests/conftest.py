@@ -0,0 +1,11 @@
+# tests/conftest.py
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Modules create their default stores on import; keep them out of the shared /tmp files
+_state_dir = tempfile.mkdtemp(prefix='prreviewbot-tests-')
+os.environ.setdefault('REVIEW_STORE_PATH', os.path.join(_state_dir, 'state.sqlite3'))
+os.environ.setdefault('JOB_QUEUE_PATH', os.path.join(_state_dir, 'jobs.sqlite3'))
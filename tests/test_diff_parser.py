@@ -0,0 +1,120 @@
+# tests/test_diff_parser.py
+from diff_parser import (DiffParser, FileDiff, Hunk, parse_unified_diff, chunk_file_diff, hunk_hash, hunk_starts,
+                         should_skip)
+
+DIFF = """\
+diff --git a/lib/main.dart b/lib/main.dart
+index 1111111..2222222 100644
+--- a/lib/main.dart
++++ b/lib/main.dart
+@@ -1,3 +1,4 @@ void main() {
+ import 'a.dart';
+-import 'b.dart';
++import 'c.dart';
++import 'd.dart';
+ 
+@@ -20,2 +21,2 @@ class App {
+-  final x = 1;
++  final x = 2;
+diff --git a/pubspec.lock b/pubspec.lock
+--- a/pubspec.lock
++++ b/pubspec.lock
+@@ -1,1 +1,1 @@
+-a: 1
++a: 2
+diff --git a/lib/old.dart b/lib/old.dart
+deleted file mode 100644
+--- a/lib/old.dart
++++ /dev/null
+@@ -1,1 +0,0 @@
+-gone
+diff --git a/assets/logo.png b/assets/logo.png
+Binary files a/assets/logo.png and b/assets/logo.png differ
+"""
+
+
+def parse(text: str = DIFF, **kwargs) -> list[FileDiff]:
+    return list(parse_unified_diff(text.splitlines(), **kwargs))
+
+
+def test_splits_files_and_hunks():
+    files = parse()
+    assert [f.path for f in files] == ['lib/main.dart', 'pubspec.lock', 'lib/old.dart', 'assets/logo.png']
+    main = files[0]
+    assert [h.header for h in main.hunks] == ['@@ -1,3 +1,4 @@ void main() {', '@@ -20,2 +21,2 @@ class App {']
+    assert (main.additions, main.deletions) == (3, 2)
+    assert main.header[1] == 'index 1111111..2222222 100644'
+
+
+def test_deleted_file_keeps_old_path():
+    deleted = parse()[2]
+    assert deleted.old_path == 'lib/old.dart'
+    assert deleted.header[-1] == '+++ /dev/null'
+
+
+def test_skipped_and_binary_files_keep_only_counts():
+    files = parse()
+    lock, binary = files[1], files[3]
+    assert lock.skipped_reason == '*.lock' and not lock.hunks
+    assert (lock.additions, lock.deletions) == (1, 1) and lock.skipped_chars > 0
+    assert binary.is_binary and binary.skipped_reason == 'binary'
+
+
+def test_body_lines_that_look_like_headers_stay_in_the_hunk():
+    text = "diff --git a/q.sql b/q.sql\n--- a/q.sql\n+++ b/q.sql\n@@ -1,1 +1,1 @@\n--- old comment\n+++ new comment\n"
+    (diff,) = parse(text)
+    assert diff.path == 'q.sql'
+    assert diff.hunks[0].lines == ['--- old comment', '+++ new comment']
+
+
+def test_numbered_lines_follow_the_new_file():
+    main = parse()[0]
+    numbered = list(main.hunks[0].numbered_lines())
+    assert numbered[:3] == [(1, " import 'a.dart';"), (None, "-import 'b.dart';"), (2, "+import 'c.dart';")]
+    assert main.new_lines() == [1, 2, 3, 4, 21]
+    assert main.render(numbered=True).splitlines()[5] == "    1  import 'a.dart';"
+
+
+def test_should_skip_matches_path_or_basename():
+    assert should_skip('lib/models/user.g.dart') == '*.g.dart'
+    assert should_skip('lib/main.dart') is None
+    assert should_skip('migrations/0001.py', ('migrations/*',)) == 'migrations/*'
+
+
+def test_truncate_lists_remaining_files_without_hunks():
+    parser = DiffParser()
+    files = []
+    lines = DIFF.splitlines()
+    for line in lines[:9]:  # Stop inside the first hunk of lib/main.dart
+        parser.feed(line)
+    parser.truncate()
+    for line in lines[9:]:
+        if (finished := parser.feed(line)) is not None:
+            files.append(finished)
+    files.append(parser.close())
+    main, lock, deleted, binary = files
+    assert main.truncated and len(main.hunks) == 1 and main.hunks[0].lines[-1] == "+import 'd.dart';"
+    assert (main.additions, main.deletions) == (3, 2)
+    assert deleted.truncated and not deleted.hunks and deleted.deletions == 1
+    assert all(f.truncated for f in files)
+
+
+def test_chunking_splits_between_hunks():
+    hunks = [Hunk(header=f"@@ -{i * 100},1 +{i * 100},1 @@", lines=['-a' * 200, '+b' * 200]) for i in range(1, 5)]
+    diff = FileDiff(path='big.dart', old_path='big.dart', header=['diff --git a/big.dart b/big.dart'], hunks=hunks)
+    parts = chunk_file_diff(diff, token_budget=250)
+    assert len(parts) > 1
+    assert [p.part for p in parts] == [(i + 1, len(parts)) for i in range(len(parts))]
+    assert [h for p in parts for h in p.hunks] == hunks
+    assert chunk_file_diff(diff, token_budget=100_000) == [diff]
+
+
+def test_hunk_hash_ignores_position_but_not_content():
+    main = parse()[0]
+    moved = FileDiff(path=main.path, old_path=main.old_path, header=main.header,
+                     hunks=[Hunk(header=h.header.replace('+21,2', '+41,2'), lines=h.lines) for h in main.hunks])
+    assert hunk_hash(moved) == hunk_hash(main)
+    assert hunk_starts(moved) == [1, 41]
+    edited = FileDiff(path=main.path, old_path=main.old_path,
+                      hunks=[main.hunks[0], Hunk(header=main.hunks[1].header, lines=['-  final x = 1;', '+  final x = 3;'])])
+    assert hunk_hash(edited) != hunk_hash(main)
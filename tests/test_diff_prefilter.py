@@ -0,0 +1,70 @@
+# tests/test_diff_prefilter.py
+import pytest
+
+from diff_parser import FileDiff, Hunk
+from diff_prefilter import classify_hunk, prefilter_diff, WHITESPACE_ONLY, CODE
+
+
+def hunk(removed: list[str], added: list[str]) -> Hunk:
+    return Hunk(header="@@ -1,1 +1,1 @@", lines=['-' + line for line in removed] + ['+' + line for line in added])
+
+
+def file_diff(path: str, *hunks: Hunk) -> FileDiff:
+    return FileDiff(path=path, old_path=path, header=[f"diff --git a/{path} b/{path}"], hunks=list(hunks),
+                    additions=sum(1 for h in hunks for l in h.lines if l.startswith('+')),
+                    deletions=sum(1 for h in hunks for l in h.lines if l.startswith('-')))
+
+
+@pytest.mark.parametrize('before, after', [
+    ("total = i++ + j;", "total = i + ++j;"),
+    ("return value;", "returnvalue;"),
+    ("final int count = 0;", "finalint count = 0;"),
+    ("x = a - -b;", "x = a--b;"),
+    ('Text("Hello World")', 'Text("HelloWorld")'),
+    ("char c = ' ';", "char c = '';"),
+    ("if (a) {", "if (b) {"),
+])
+def test_code_changes_are_not_formatting(before, after):
+    assert classify_hunk(hunk([before], [after]), 'lib/main.dart') == CODE
+
+
+@pytest.mark.parametrize('removed, added', [
+    (["foo(a,b);"], ["foo(a, b);"]),
+    (["if (x){"], ["if (x) {"]),
+    (["x=1;"], ["x = 1;"]),
+    (["call(first, second);"], ["call(", "    first,", "    second);"]),
+    (["  return x;"], ["    return x;"]),
+    (["a;"], ["a;", ""]),
+])
+def test_whitespace_between_tokens_is_formatting(removed, added):
+    assert classify_hunk(hunk(removed, added), 'lib/main.dart') == WHITESPACE_ONLY
+
+
+def test_indentation_counts_in_indentation_sensitive_languages():
+    dedent = hunk(["    return x"], ["return x"])
+    assert classify_hunk(dedent, 'app/views.py') == CODE
+    assert classify_hunk(dedent, 'lib/main.dart') == WHITESPACE_ONLY
+    assert classify_hunk(hunk(["x=1"], ["x = 1"]), 'app/views.py') == WHITESPACE_ONLY
+
+
+def test_code_change_keeps_the_pr_reviewable():
+    result = prefilter_diff([file_diff('lib/main.dart', hunk(["total = i++ + j;"], ["total = i + ++j;"]))])
+    assert result.has_reviewable_changes and result.dropped_hunks == 0
+
+
+def test_formatting_hunks_are_dropped_and_summarized():
+    formatting = hunk(["foo(a,b);"], ["foo(a, b);"])
+    change = hunk(["x = 1;"], ["x = 2;"])
+    result = prefilter_diff([file_diff('lib/a.dart', formatting, change), file_diff('lib/b.dart', formatting)])
+    assert [f.path for f in result.files] == ['lib/a.dart']
+    assert result.files[0].hunks == [change]
+    assert result.dropped_hunks == 2
+    assert result.summary == ["- `lib/a.dart`: 1 formatting/whitespace-only hunk skipped",
+                              "- `lib/b.dart` (+1/-1): formatting/whitespace-only changes"]
+
+
+def test_prefilter_can_be_disabled_or_narrowed():
+    formatting = file_diff('templates/page.tpl', hunk(["a  b"], ["a b"]))
+    assert prefilter_diff([formatting], enabled=False).files == [formatting]
+    assert prefilter_diff([formatting], keep_globs=('*.tpl',)).files == [formatting]
+    assert not prefilter_diff([formatting]).has_reviewable_changes
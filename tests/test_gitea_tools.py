@@ -0,0 +1,73 @@
+# tests/test_gitea_tools.py
+import asyncio
+import time
+from email.utils import formatdate
+
+import httpx
+import pytest
+
+import gitea_tools
+from gitea_tools import GiteaClient
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(gitea_tools, 'GITEA_BACKOFF_BASE_SECONDS', 0)
+
+
+def send(method, *replies):
+    """Sends one request through a mock Gitea answering with `replies` in turn; returns (outcome, requests seen)."""
+    calls = []
+
+    def handler(request):
+        reply = replies[min(len(calls), len(replies) - 1)]
+        calls.append(request)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    async def run():
+        client = GiteaClient(base_url='http://gitea.test', token='t', max_retries=2)
+        client._http = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            return await client.request(method, client.url('repos/o/r/issues/1/comments'), json={'body': 'x'})
+        except httpx.HTTPError as e:
+            return e
+        finally:
+            await client.aclose()
+    return asyncio.run(run()), len(calls)
+
+
+def test_post_5xx_is_not_retried():
+    outcome, calls = send('POST', httpx.Response(502), httpx.Response(201, json={}))
+    assert isinstance(outcome, httpx.HTTPStatusError) and calls == 1
+
+
+def test_post_503_with_retry_after_is_retried():
+    outcome, calls = send('POST', httpx.Response(503, headers={'Retry-After': '0'}), httpx.Response(201, json={}))
+    assert outcome.status_code == 201 and calls == 2
+    outcome, calls = send('POST', httpx.Response(503), httpx.Response(201, json={}))
+    assert isinstance(outcome, httpx.HTTPStatusError) and calls == 1  # No Retry-After: maybe applied
+
+
+def test_post_that_never_connected_is_retried():
+    outcome, calls = send('POST', httpx.ConnectError('refused'), httpx.Response(201, json={}))
+    assert outcome.status_code == 201 and calls == 2
+    outcome, calls = send('POST', httpx.ReadTimeout('slow'), httpx.Response(201, json={}))
+    assert isinstance(outcome, httpx.ReadTimeout) and calls == 1
+
+
+def test_get_retries_5xx_until_retries_run_out():
+    outcome, calls = send('GET', httpx.Response(502), httpx.Response(500), httpx.Response(200))
+    assert outcome.status_code == 200 and calls == 3
+    outcome, calls = send('GET', httpx.Response(504))
+    assert isinstance(outcome, httpx.HTTPStatusError) and calls == 3
+
+
+def test_retry_delay_honors_retry_after():
+    client = GiteaClient(base_url='http://gitea.test', token='t')
+    assert client._retry_delay(0, httpx.Response(503, headers={'Retry-After': '7'})) == 7
+    in_ten_seconds = formatdate(time.time() + 10, usegmt=True)
+    assert 8 <= client._retry_delay(0, httpx.Response(503, headers={'Retry-After': in_ten_seconds})) <= 10
+    assert client._retry_delay(0, httpx.Response(503, headers={'Retry-After': '9999'})) == \
+        gitea_tools.GITEA_BACKOFF_MAX_SECONDS
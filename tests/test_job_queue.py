@@ -0,0 +1,154 @@
+# tests/test_job_queue.py
+import time
+import threading
+
+import pytest
+
+import job_queue
+from job_queue import SQLiteJobQueue, RedisJobQueue, FakeRedis, WorkerPool
+
+
+@pytest.fixture(params=['sqlite', 'fakeredis'])
+def make_queue(request, tmp_path):
+    def make(**kwargs):
+        if request.param == 'sqlite':
+            return SQLiteJobQueue(str(tmp_path / 'jobs.sqlite3'), **kwargs)
+        kwargs.pop('per_repo_limit', None)  # Enforced by the worker pool for Redis
+        return RedisJobQueue(FakeRedis(), **kwargs)
+    return make
+
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(monkeypatch):
+    monkeypatch.setattr(job_queue, 'JOB_RETRY_DELAY_SECONDS', 0)
+
+
+def expire_leases(queue):
+    """What a worker that died mid-job looks like once its lease runs out."""
+    if isinstance(queue, SQLiteJobQueue):
+        queue._conn().execute("UPDATE jobs SET lease_expires_at = 0 WHERE state = 'running'")
+    else:
+        running = queue._key('running')
+        queue.client.zadd(running, {job_id: 0 for job_id in queue.client.zrangebyscore(running, 0, float('inf'))})
+
+
+def test_claim_complete_and_depth(make_queue):
+    queue = make_queue()
+    job_id = queue.enqueue('o/r', {'pr_number': 1})
+    assert queue.depth() == 1
+    job = queue.claim()
+    assert (job.id, job.repo, job.payload, job.attempts) == (job_id, 'o/r', {'pr_number': 1}, 1)
+    assert queue.claim() is None
+    assert queue.depth() == 1
+    queue.complete(job.id)
+    assert queue.depth() == 0
+
+
+def test_delayed_job_waits(make_queue):
+    queue = make_queue()
+    queue.enqueue('o/r', {}, delay=60)
+    assert queue.claim() is None
+
+
+def test_waiting_job_is_coalesced(make_queue):
+    queue = make_queue()
+    first = queue.enqueue('o/r', {'head_sha': 'a'}, coalesce_key='o/r#1', head_sha='a')
+    second = queue.enqueue('o/r', {'head_sha': 'b'}, coalesce_key='o/r#1', head_sha='b')
+    assert first == second and queue.depth() == 1
+    assert queue.claim().payload == {'head_sha': 'b'}
+    assert queue.is_superseded('o/r#1', 'a') and not queue.is_superseded('o/r#1', 'b')
+
+
+def test_running_job_is_superseded_not_replaced(make_queue):
+    queue = make_queue()
+    first = queue.enqueue('o/r', {'head_sha': 'a'}, coalesce_key='o/r#1', head_sha='a')
+    running = queue.claim()
+    second = queue.enqueue('o/r', {'head_sha': 'b'}, coalesce_key='o/r#1', head_sha='b')
+    assert running.id == first != second
+    assert queue.is_superseded('o/r#1', 'a')
+    assert queue.claim().payload == {'head_sha': 'b'}
+
+
+def test_expired_lease_is_resumed(make_queue):
+    queue = make_queue()
+    job_id = queue.enqueue('o/r', {})
+    queue.claim()
+    expire_leases(queue)
+    resumed = queue.claim()
+    assert (resumed.id, resumed.attempts) == (job_id, 2)
+
+
+def test_renew_keeps_the_job_leased(make_queue):
+    queue = make_queue()
+    queue.enqueue('o/r', {})
+    job = queue.claim()
+    expire_leases(queue)
+    assert queue.renew(job.id)
+    assert queue.claim() is None
+    queue.complete(job.id)
+    assert not queue.renew(job.id)
+
+
+def test_lost_worker_on_last_attempt_is_not_resumed(make_queue):
+    queue = make_queue(max_attempts=2)
+    queue.enqueue('o/r', {})
+    for attempt in (1, 2):
+        assert queue.claim().attempts == attempt
+        expire_leases(queue)
+    assert queue.claim() is None
+    assert queue.depth() == 0
+
+
+def test_failed_job_is_retried_then_parked(make_queue):
+    queue = make_queue(max_attempts=2)
+    job_id = queue.enqueue('o/r', {})
+    queue.fail(queue.claim().id, 'boom')
+    retried = queue.claim()
+    assert (retried.id, retried.attempts) == (job_id, 2)
+    queue.fail(retried.id, 'boom again')
+    assert queue.claim() is None
+    assert queue.depth() == 0
+
+
+def test_excluded_repos_are_skipped(make_queue):
+    queue = make_queue()
+    queue.enqueue('busy/repo', {})
+    other = queue.enqueue('idle/repo', {})
+    assert queue.claim(exclude_repos={'busy/repo'}).id == other
+
+
+def test_sqlite_caps_running_jobs_per_repo(tmp_path):
+    queue = SQLiteJobQueue(str(tmp_path / 'jobs.sqlite3'), per_repo_limit=1)
+    for _ in range(3):
+        queue.enqueue('o/r', {})
+    other = queue.enqueue('o/other', {})
+    assert queue.claim().repo == 'o/r'
+    assert queue.claim().id == other  # o/r is at its limit, even for another process sharing the file
+    assert queue.claim() is None
+    assert queue.claim(repo_limit=lambda repo: 2).repo == 'o/r'  # A profile's repo_concurrency wins
+
+
+def test_worker_pool_runs_and_retries_jobs(make_queue):
+    queue = make_queue()
+    seen, done = [], threading.Event()
+
+    def handler(job):
+        seen.append((job.payload['n'], job.attempts))
+        if job.attempts == 1 and job.payload['n'] == 0:
+            raise RuntimeError('transient')
+        if len(seen) == 4:
+            done.set()
+
+    pool = WorkerPool(queue, handler, workers=2, per_repo_limit=1, poll_interval=0.01)
+    for n in range(3):
+        queue.enqueue('o/r', {'n': n})
+    pool.start()
+    try:
+        assert done.wait(5)
+    finally:
+        pool.stop()
+    assert sorted(seen) == [(0, 1), (0, 2), (1, 1), (2, 1)]
+    deadline = time.monotonic() + 1
+    while queue.depth() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert queue.depth() == 0
@@ -0,0 +1,82 @@
+# tests/test_review_comments.py
+from diff_parser import FileDiff, Hunk
+from review_comments import parse_finding, parse_findings, build_pull_review, rebase_findings, Finding
+
+MAIN = FileDiff(
+    path='lib/src/main.dart', old_path='lib/src/main.dart',
+    hunks=[Hunk(header="@@ -10,3 +10,4 @@", lines=[" a", "-b", "+c", "+d", " e"]),
+           Hunk(header="@@ -40,2 +41,2 @@", lines=[" f", "-g", "+h"])],
+)
+LOCK = FileDiff(path='pubspec.lock', old_path='pubspec.lock', skipped_reason='*.lock')
+
+
+def test_parse_finding_variants():
+    assert parse_finding("- [warning] lib/a.dart:12: Null check missing") == \
+        Finding(path='lib/a.dart', line=12, severity='warning', message='Null check missing')
+    assert parse_finding("* **[Critical]** `./lib/a.dart:3` — Leaks the controller") == \
+        Finding(path='lib/a.dart', line=3, severity='critical', message='Leaks the controller')
+    assert parse_finding("1. [suggestion] lib/a.dart:7 - Use const") == \
+        Finding(path='lib/a.dart', line=7, severity='suggestion', message='Use const')
+    assert parse_finding("- [nit] lib/a.dart:7: unknown severity") is None
+    assert parse_finding("- General remark without a location") is None
+
+
+def test_parse_findings_keeps_continuation_lines():
+    text = "## Findings\n- [warning] lib/a.dart:5: First line\n  continues here\n- [critical] lib/b.dart:9: Other\n"
+    findings = parse_findings(text)
+    assert [(f.path, f.line) for f in findings] == [('lib/a.dart', 5), ('lib/b.dart', 9)]
+    assert findings[0].message == "First line\n  continues here"
+
+
+def test_findings_on_diff_lines_become_inline_comments():
+    review = build_pull_review(
+        "## Findings\n- [warning] lib/src/main.dart:11: Renamed without updating callers\n"
+        "- [critical] lib/src/main.dart:42: Off by one\n",
+        [MAIN, LOCK],
+    )
+    assert [(c.path, c.new_line, c.severity) for c in review.comments] == \
+        [('lib/src/main.dart', 11, 'warning'), ('lib/src/main.dart', 42, 'critical')]
+    assert review.comments[0].to_gitea() == {'path': 'lib/src/main.dart', 'new_position': 11, 'old_position': 0,
+                                             'body': '🟠 **Warning**: Renamed without updating callers'}
+    assert '## Findings' not in review.body  # Every finding of the section moved inline
+    assert '2 inline comments (1 critical, 1 warning)' in review.body
+
+
+def test_findings_snap_to_nearby_diff_lines_only():
+    review = build_pull_review(
+        "- [warning] main.dart:15: Two lines below the hunk\n"
+        "- [warning] lib/src/main.dart:30: Far from any hunk\n"
+        "- [warning] pubspec.lock:1: Skipped file\n"
+        "- [warning] lib/other.dart:3: Not in the diff\n",
+        [MAIN, LOCK],
+    )
+    assert [(c.path, c.new_line) for c in review.comments] == [('lib/src/main.dart', 13)]
+    for kept in ('lib/src/main.dart:30', 'pubspec.lock:1', 'lib/other.dart:3'):
+        assert kept in review.body
+
+
+def test_general_remarks_stay_in_the_body():
+    review = build_pull_review("Looks good overall.\n\n- Consider adding tests.", [MAIN])
+    assert review.comments == []
+    assert review.body == "Looks good overall.\n\n- Consider adding tests."
+
+
+def test_rebase_moves_findings_with_their_hunk():
+    text = ("- [warning] lib/src/main.dart:11: In the first hunk\n"
+            "- [critical] lib/src/main.dart:42: In the second hunk\n"
+            "- [warning] lib/other.dart:42: Other file\n"
+            "A remark mentioning lib/src/main.dart:11\n")
+    moved = rebase_findings(text, {'lib/src/main.dart': ([10, 41], [30, 71])})
+    assert moved.splitlines() == [
+        "- [warning] lib/src/main.dart:31: In the first hunk",
+        "- [critical] lib/src/main.dart:72: In the second hunk",
+        "- [warning] lib/other.dart:42: Other file",
+        "A remark mentioning lib/src/main.dart:11",
+    ]
+
+
+def test_rebase_accepts_shortened_paths_and_ignores_mismatched_hunks():
+    assert rebase_findings("- [warning] main.dart:11: x", {'lib/src/main.dart': ([10], [20])}) == \
+        "- [warning] main.dart:21: x"
+    assert rebase_findings("- [warning] main.dart:11: x", {'lib/src/main.dart': ([10, 40], [20])}) == \
+        "- [warning] main.dart:11: x"
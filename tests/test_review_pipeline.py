@@ -0,0 +1,41 @@
+# tests/test_review_pipeline.py
+from diff_parser import FileDiff, Hunk
+from agent import REVIEW_INSTRUCTION, profile_instruction
+from review_pipeline import split_chunk_review, merge_chunk_reviews
+
+MAIN = FileDiff(path='lib/main.dart', old_path='lib/main.dart',
+                hunks=[Hunk(header="@@ -1,1 +1,2 @@", lines=[" a", "+b"])])
+UTIL = FileDiff(path='lib/util.dart', old_path='lib/util.dart',
+                hunks=[Hunk(header="@@ -5,1 +5,2 @@", lines=[" c", "+d"])])
+
+
+def test_chunk_review_is_split_per_file():
+    heading, per_unit = split_chunk_review([MAIN, UTIL], (
+        "AI Code Review Analysis:\n\n"
+        "- [warning] lib/main.dart:2: Unused variable\n"
+        "- util.dart swallows the exception\n"
+        "- No major issues identified in this analysis.\n"
+    ))
+    assert heading == "AI Code Review Analysis:"
+    assert per_unit == [["- [warning] lib/main.dart:2: Unused variable"], ["- util.dart swallows the exception"]]
+
+
+def test_chunk_review_with_an_unowned_item_is_not_split():
+    for item in ("- The two files duplicate the parsing logic", "- main.dart and util.dart both leak"):
+        heading, per_unit = split_chunk_review([MAIN, UTIL], (
+            "AI Code Review Analysis:\n\n- [warning] lib/main.dart:2: Unused variable\n" + item
+        ))
+        assert per_unit is None
+
+
+def test_single_file_review_keeps_its_whole_body():
+    assert split_chunk_review([MAIN], "AI Code Review Analysis:\n\nSome prose\n- a bullet") == \
+        ("AI Code Review Analysis:", [["Some prose\n- a bullet"]])
+
+
+def test_merged_review_follows_the_instruction_in_use():
+    no_issues = "AI Code Review Analysis:\n\n- No major issues identified in this analysis."
+    assert merge_chunk_reviews([([MAIN], no_issues), ([UTIL], no_issues)], instruction=profile_instruction("Go.")) == \
+        "AI Code Review Analysis:\n\nNo major issues identified in this analysis."
+    assert merge_chunk_reviews([([MAIN], "- a"), ([UTIL], "- b")], instruction=REVIEW_INSTRUCTION) == \
+        "AI Flutter/Dart Code Review Analysis:\n\n#### `lib/main.dart`\n- a\n\n#### `lib/util.dart`\n- b"
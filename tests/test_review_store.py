@@ -0,0 +1,194 @@
+# tests/test_review_store.py
+import sqlite3
+
+import pytest
+
+import review_store as rs
+from review_store import ReviewStore, QUEUED, RUNNING, POSTED, DONE, SUPERSEDED, FAILED
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ReviewStore(str(tmp_path / 'state.sqlite3'))
+
+
+def test_redelivered_id_is_a_duplicate(store):
+    assert store.claim_delivery('d1', 'o/r', 1, 'aaa') is None
+    assert store.claim_delivery('d1', 'o/r', 1, 'aaa') == 'delivery'
+    assert store.get_review('o/r', 1, 'aaa').state == QUEUED
+
+
+def test_head_in_flight_or_settled_is_a_duplicate(store):
+    store.claim_delivery('d1', 'o/r', 1, 'aaa')
+    assert store.claim_delivery('d2', 'o/r', 1, 'aaa') == QUEUED
+    store.set_state('o/r', 1, 'aaa', RUNNING)
+    assert store.claim_delivery('d3', 'o/r', 1, 'aaa') == RUNNING
+    for settled in (DONE, POSTED):
+        store.set_state('o/r', 1, 'aaa', settled)
+        assert store.claim_delivery('d4', 'o/r', 1, 'aaa') == settled
+    assert store.claim_delivery('d5', 'o/r', 1, 'bbb') is None  # A new push is reviewed
+
+
+@pytest.mark.parametrize('state', [FAILED, SUPERSEDED])
+def test_unsettled_head_accepts_a_new_delivery(store, state):
+    store.claim_delivery('d1', 'o/r', 1, 'aaa')
+    store.set_state('o/r', 1, 'aaa', state)
+    assert store.claim_delivery('d2', 'o/r', 1, 'aaa') is None
+    assert store.get_review('o/r', 1, 'aaa').state == QUEUED
+
+
+def test_stale_in_flight_head_accepts_a_new_delivery(store, monkeypatch):
+    store.claim_delivery('d1', 'o/r', 1, 'aaa')
+    store.set_state('o/r', 1, 'aaa', RUNNING)
+    monkeypatch.setattr(rs, 'REVIEW_STORE_IN_FLIGHT_SECONDS', 0)
+    assert store.claim_delivery('d2', 'o/r', 1, 'aaa') is None
+
+
+def test_released_delivery_can_be_claimed_again(store):
+    store.claim_delivery('d1', 'o/r', 1, 'aaa')
+    store.release_delivery('d1', 'o/r', 1, 'aaa')
+    assert store.get_review('o/r', 1, 'aaa') is None
+    assert store.claim_delivery('d1', 'o/r', 1, 'aaa') is None
+
+
+def test_posted_never_moves_back(store):
+    store.set_state('o/r', 1, 'aaa', POSTED)
+    store.set_state('o/r', 1, 'aaa', FAILED)
+    store.set_state('o/r', 1, 'aaa', QUEUED, job_id='j2', only_from=RUNNING)
+    assert store.get_review('o/r', 1, 'aaa').state == POSTED
+
+
+def test_only_from_guards_the_transition(store):
+    store.set_state('o/r', 1, 'aaa', QUEUED)
+    store.set_state('o/r', 1, 'aaa', DONE, only_from=RUNNING)
+    assert store.get_review('o/r', 1, 'aaa').state == QUEUED
+    store.set_state('o/r', 1, 'aaa', QUEUED, job_id='j1', only_from=QUEUED)
+    assert store.get_review('o/r', 1, 'aaa').job_id == 'j1'
+
+
+def test_saved_review_round_trips(store):
+    comments = [{'path': 'a.dart', 'body': 'x', 'new_position': 3, 'old_position': 0}]
+    store.save_review('o/r', 1, 'aaa', 'body', comments, 'fallback', complete=False)
+    review = store.get_review('o/r', 1, 'aaa')
+    assert (review.state, review.body, review.comments, review.fallback_body, review.complete) == \
+        (rs.COMPUTED, 'body', comments, 'fallback', False)
+
+
+def test_reviewed_head_is_per_pr(store):
+    assert store.last_reviewed_head('o/r', 1) is None
+    store.record_reviewed_head('o/r', 1, 'aaa')
+    store.record_reviewed_head('o/r', 1, 'bbb')
+    store.record_reviewed_head('o/r', 2, 'ccc')
+    assert store.last_reviewed_head('o/r', 1) == 'bbb'
+
+
+def test_stale_progress_comments_skip_running_heads(store):
+    for head, state, comment_id in (('aaa', SUPERSEDED, 11), ('bbb', RUNNING, 12), ('ccc', FAILED, None)):
+        store.set_state('o/r', 1, head, state)
+        store.set_progress_comment('o/r', 1, head, comment_id)
+    store.set_state('o/r', 1, 'ddd', RUNNING)
+    store.set_progress_comment('o/r', 1, 'ddd', 13)
+    assert store.stale_progress_comments('o/r', 1, 'ddd') == [('aaa', 11)]
+
+
+def test_older_store_file_is_upgraded(tmp_path):
+    path = str(tmp_path / 'old.sqlite3')
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE reviews (repo TEXT NOT NULL, pr_number INTEGER NOT NULL, head_sha TEXT NOT NULL, "
+                 "state TEXT NOT NULL, job_id TEXT, body TEXT, comments TEXT, fallback_body TEXT, "
+                 "updated_at REAL NOT NULL, PRIMARY KEY (repo, pr_number, head_sha))")
+    conn.execute("INSERT INTO reviews VALUES ('o/r', 1, 'aaa', 'computed', NULL, 'body', '[]', 'fb', 1.0)")
+    conn.commit()
+    conn.close()
+    review = ReviewStore(path).get_review('o/r', 1, 'aaa')
+    assert (review.body, review.complete, review.progress_comment_id) == ('body', True, None)
+
+
+# --- Job Outcomes ---
+class _Queue:
+    def is_superseded(self, coalesce_key, head_sha):
+        return False
+
+
+@pytest.fixture
+def run_job(store, monkeypatch):
+    import receiver
+    from job_queue import Job
+    monkeypatch.setattr(receiver, 'review_store', store)
+    monkeypatch.setattr(receiver, 'job_queue', _Queue())
+
+    def run(outcome):
+        def process(*args, **kwargs):
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+        monkeypatch.setattr(receiver, 'process_pr_review', process)
+        store.claim_delivery(None, 'o/r', 1, 'aaa')
+        job = Job(id='j1', repo='o/r', payload={'repo_full_name': 'o/r', 'pr_number': 1, 'head_sha': 'aaa'})
+        receiver.run_review_job(job)
+        return store.get_review('o/r', 1, 'aaa').state
+    return run
+
+
+@pytest.mark.parametrize('outcome, state', [
+    ('empty', DONE), ('prefiltered', DONE), ('over_budget', DONE), ('disabled', DONE),
+    ('superseded', SUPERSEDED), ('failed', FAILED), ('no_result', FAILED),
+])
+def test_job_outcome_settles_only_terminal_reviews(run_job, outcome, state):
+    assert run_job(outcome) == state
+
+
+def test_job_that_raises_leaves_the_head_failed(run_job, store):
+    with pytest.raises(RuntimeError):
+        run_job(RuntimeError('Failed to fetch the diff'))
+    assert store.get_review('o/r', 1, 'aaa').state == FAILED
+    assert store.claim_delivery('d2', 'o/r', 1, 'aaa') is None  # Gitea's redelivery is accepted
+
+
+def test_posted_review_stays_posted(run_job, store):
+    store.set_state('o/r', 1, 'aaa', POSTED)
+    assert run_job('posted') == POSTED
+
+
+# --- Webhook Dedup ---
+class _Pool:
+    def notify(self):
+        pass
+
+
+@pytest.fixture
+def deliver(store, tmp_path, monkeypatch):
+    import asyncio
+    import json
+    import httpx
+    import receiver
+    from job_queue import SQLiteJobQueue
+    queue = SQLiteJobQueue(str(tmp_path / 'jobs.sqlite3'))
+    monkeypatch.setattr(receiver, 'review_store', store)
+    monkeypatch.setattr(receiver, 'job_queue', queue)
+    monkeypatch.setattr(receiver, 'worker_pool', _Pool())
+    monkeypatch.setattr(receiver, 'GITEA_WEBHOOK_SECRET', None)
+    monkeypatch.setattr(receiver, 'REVIEW_DEBOUNCE_SECONDS', 0)
+
+    def send(delivery, head_sha):
+        body = {'action': 'synchronized', 'number': 1, 'repository': {'full_name': 'o/r'},
+                'pull_request': {'head': {'sha': head_sha}}}
+
+        async def post():
+            transport = httpx.ASGITransport(app=receiver.app)
+            async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+                return await client.post('/webhook', content=json.dumps(body), headers={
+                    'X-Gitea-Event': 'pull_request', 'X-Gitea-Delivery': delivery})
+        return asyncio.run(post()).json()
+    send.queue = queue
+    return send
+
+
+def test_force_push_back_to_a_coalesced_head_is_queued(deliver, store):
+    assert 'job_id' in deliver('d1', 'aaa')
+    assert 'job_id' in deliver('d2', 'bbb')  # Replaces the waiting job for aaa
+    assert store.get_review('o/r', 1, 'aaa').state == SUPERSEDED
+    assert 'job_id' in deliver('d3', 'aaa')
+    assert deliver('d4', 'aaa')['reason'] == QUEUED
+    assert store.get_review('o/r', 1, 'bbb').state == SUPERSEDED
+    assert deliver.queue.claim().payload['head_sha'] == 'aaa'
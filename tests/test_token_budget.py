@@ -0,0 +1,117 @@
+# tests/test_token_budget.py
+import token_budget
+from diff_parser import FileDiff, Hunk, HUNK_HEADER_RE
+from token_budget import trim_hunk_context, trim_file_context, plan_review, model_limits, DEFAULT_MODEL_LIMITS
+
+CONTEXT = [f" line {n}" for n in range(10)]
+HUNK = Hunk(
+    header="@@ -10,22 +10,23 @@ class App {",
+    lines=[*CONTEXT, "-old a", "+new a", "+new b", *CONTEXT, "-old c", "+new c"],
+)
+
+
+def _numbered(hunks: list[Hunk]) -> dict[str, int]:
+    return {line: n for hunk in hunks for n, line in hunk.numbered_lines() if n is not None}
+
+
+def _old_numbered(hunks: list[Hunk]) -> dict[str, int]:
+    out = {}
+    for hunk in hunks:
+        old_line = int(HUNK_HEADER_RE.match(hunk.header).group(1))
+        for line in hunk.lines:
+            if not line.startswith('+'):
+                out[line] = old_line
+                old_line += 1
+    return out
+
+
+def test_trimming_splits_on_long_context_and_rewrites_headers():
+    pieces = trim_hunk_context(HUNK, context_lines=1)
+    assert [p.header for p in pieces] == [
+        "@@ -19,3 +19,4 @@ class App {",
+        "@@ -30,2 +31,2 @@ class App {",
+    ]
+    assert pieces[0].lines == [" line 9", "-old a", "+new a", "+new b", " line 0"]
+    assert pieces[1].lines == [" line 9", "-old c", "+new c"]
+
+
+def test_trimmed_pieces_keep_original_line_numbers():
+    for context_lines in (0, 1, 3):
+        pieces = trim_hunk_context(HUNK, context_lines)
+        new_numbers, old_numbers = _numbered(pieces), _old_numbered(pieces)
+        for line in ("+new a", "+new b", "+new c"):
+            assert new_numbers[line] == _numbered([HUNK])[line]
+        for line in ("-old a", "-old c"):
+            assert old_numbers[line] == _old_numbered([HUNK])[line]
+        for piece in pieces:
+            match = HUNK_HEADER_RE.match(piece.header)
+            assert int(match.group(2)) == sum(1 for l in piece.lines if not l.startswith('+'))
+            assert int(match.group(4)) == sum(1 for l in piece.lines if not l.startswith('-'))
+
+
+def test_wide_context_keeps_the_hunk_whole():
+    (piece,) = trim_hunk_context(HUNK, context_lines=10)
+    assert piece.lines == HUNK.lines
+    assert piece.header == "@@ -10,22 +10,23 @@ class App {"
+
+
+def test_no_newline_marker_stays_with_its_line():
+    hunk = Hunk(header="@@ -1,3 +1,3 @@", lines=[" a", " b", "-c", "+d", "\\ No newline at end of file"])
+    (piece,) = trim_hunk_context(hunk, context_lines=0)
+    assert piece.header == "@@ -3,1 +3,1 @@"
+    assert piece.lines == ["-c", "+d", "\\ No newline at end of file"]
+
+
+def test_unparseable_header_is_left_alone():
+    hunk = Hunk(header="@@ garbage @@", lines=[" a", "+b"])
+    assert trim_hunk_context(hunk, context_lines=0) == [hunk]
+
+
+def test_trim_file_context_trims_every_hunk():
+    diff = FileDiff(path='lib/app.dart', old_path='lib/app.dart', hunks=[HUNK, HUNK])
+    assert len(trim_file_context(diff, context_lines=1).hunks) == 4
+
+
+def test_model_limits_fall_back_by_prefix():
+    assert model_limits('gemini-2.5-pro-preview-06-05') == model_limits('gemini-2.5-pro')
+    assert model_limits('some-other-model') == DEFAULT_MODEL_LIMITS
+
+
+def _file(path: str, changes: int = 4, context: int = 40) -> FileDiff:
+    lines = [f" ctx {n}" for n in range(context)] + [f"+added {n}" for n in range(changes)] + [f" ctx {n}" for n in range(context)]
+    return FileDiff(path=path, old_path=path, header=[f"diff --git a/{path} b/{path}"],
+                    hunks=[Hunk(header=f"@@ -1,{2 * context} +1,{2 * context + changes} @@", lines=lines)],
+                    additions=changes)
+
+
+def test_plan_keeps_the_complete_diff_when_it_fits(monkeypatch):
+    monkeypatch.setattr(token_budget, 'REVIEW_TOKEN_BUDGET', 100_000)
+    files = [_file('lib/a.dart'), _file('README.md')]
+    plan = plan_review(files, 'gemini-2.5-pro', 'Review this.')
+    assert plan.files == files and not plan.context_trimmed and not plan.omitted
+
+
+def test_plan_trims_context_before_dropping_files(monkeypatch):
+    files = [_file('lib/a.dart'), _file('README.md')]
+    full = plan_review(files, 'gemini-2.5-pro', 'Review this.').required_tokens
+    monkeypatch.setattr(token_budget, 'REVIEW_TOKEN_BUDGET', full - 1)
+    plan = plan_review(files, 'gemini-2.5-pro', 'Review this.')
+    assert plan.context_trimmed and not plan.omitted
+    assert [f.path for f in plan.files] == ['lib/a.dart', 'README.md']
+    assert plan.estimated_tokens <= plan.budget < plan.required_tokens
+
+
+def test_plan_drops_low_value_files_first(monkeypatch):
+    files = [_file('README.md'), _file('lib/a.dart')]
+    one_file = plan_review([trim_file_context(files[1])], 'gemini-2.5-pro', 'Review this.').estimated_tokens
+    monkeypatch.setattr(token_budget, 'REVIEW_TOKEN_BUDGET', one_file)
+    plan = plan_review(files, 'gemini-2.5-pro', 'Review this.')
+    assert [f.path for f in plan.files] == ['lib/a.dart']
+    assert [f.path for f in plan.omitted] == ['README.md']
+    assert '`README.md` (+4/-0)' in plan.render_omitted()
+
+
+def test_plan_without_files_means_nothing_fits(monkeypatch):
+    monkeypatch.setattr(token_budget, 'REVIEW_TOKEN_BUDGET', 1)
+    plan = plan_review([_file('lib/a.dart')], 'gemini-2.5-pro', 'Review this.')
+    assert not plan.fits and [f.path for f in plan.omitted] == ['lib/a.dart']
@@ -0,0 +1,210 @@
+# token_budget.py
+import os
+import math
+import threading
+from fnmatch import fnmatch
+from dataclasses import dataclass, field, replace
+
+from diff_parser import FileDiff, Hunk, HUNK_HEADER_RE, estimate_tokens, DIFF_CHUNK_TOKEN_BUDGET
+
+
+@dataclass(frozen=True)
+class ModelLimits:
+    context_tokens: int      # Input window of a single call
+    max_output_tokens: int
+    review_budget: int       # Default cap on prompt tokens spent on one PR review (all calls)
+
+
+# Looked up by exact name, then by longest matching prefix (so dated previews inherit their family)
+MODEL_LIMITS = {
+    'gemini-2.5-pro': ModelLimits(context_tokens=1_048_576, max_output_tokens=65_536, review_budget=200_000),
+    'gemini-2.5-flash': ModelLimits(context_tokens=1_048_576, max_output_tokens=65_536, review_budget=400_000),
+    'gemini-2.0-flash': ModelLimits(context_tokens=1_048_576, max_output_tokens=8_192, review_budget=400_000),
+    'gemini-1.5-pro': ModelLimits(context_tokens=2_097_152, max_output_tokens=8_192, review_budget=200_000),
+    'gemini-1.5-flash': ModelLimits(context_tokens=1_048_576, max_output_tokens=8_192, review_budget=400_000),
+}
+DEFAULT_MODEL_LIMITS = ModelLimits(context_tokens=128_000, max_output_tokens=8_192, review_budget=100_000)
+
+REVIEW_TOKEN_BUDGET = int(os.environ.get('REVIEW_TOKEN_BUDGET', '0'))  # Per-PR prompt tokens, 0 = model default
+REVIEW_OUTPUT_TOKEN_RESERVE = int(os.environ.get('REVIEW_OUTPUT_TOKEN_RESERVE', '8192'))
+REVIEW_MIN_CONTEXT_LINES = int(os.environ.get('REVIEW_MIN_CONTEXT_LINES', '1'))  # Context kept around changes when trimming
+
+# Review value of a file by path (first match wins); low-value files are dropped first when over budget
+FILE_REVIEW_WEIGHTS = (
+    ('*_test.dart', 0.5), ('test/*', 0.5), ('*/test/*', 0.5), ('integration_test/*', 0.5),
+    ('*.dart', 1.0),
+    ('*.kt', 0.7), ('*.swift', 0.7), ('*.java', 0.7), ('*.m', 0.7), ('*.js', 0.7), ('*.ts', 0.7),
+    ('*.gradle', 0.5), ('*.yaml', 0.4), ('*.yml', 0.4), ('*.json', 0.3), ('*.xml', 0.3),
+    ('*.md', 0.2), ('*.txt', 0.2),
+)
+DEFAULT_FILE_WEIGHT = 0.6
+
+
+def model_limits(model: str) -> ModelLimits:
+    if model in MODEL_LIMITS:
+        return MODEL_LIMITS[model]
+    prefixes = [name for name in MODEL_LIMITS if model.startswith(name)]
+    return MODEL_LIMITS[max(prefixes, key=len)] if prefixes else DEFAULT_MODEL_LIMITS
+
+
+def review_token_budget(model: str) -> int:
+    return REVIEW_TOKEN_BUDGET or model_limits(model).review_budget
+
+
+def call_token_budget(model: str, instruction_tokens: int) -> int:
+    """Diff tokens per model call: the chunk budget, capped by what fits in the model's window."""
+    limits = model_limits(model)
+    window = limits.context_tokens - instruction_tokens - min(limits.max_output_tokens, REVIEW_OUTPUT_TOKEN_RESERVE)
+    return max(1, min(DIFF_CHUNK_TOKEN_BUDGET, window))
+
+
+def file_weight(path: str) -> float:
+    for pattern, weight in FILE_REVIEW_WEIGHTS:
+        if fnmatch(path, pattern):
+            return weight
+    return DEFAULT_FILE_WEIGHT
+
+
+# --- Context Trimming ---
+def trim_hunk_context(hunk: Hunk, context_lines: int) -> list[Hunk]:
+    """
+    Keeps only `context_lines` unchanged lines around each change. Long unchanged
+    stretches split the hunk; every piece gets a header with correct line numbers.
+    """
+    match = HUNK_HEADER_RE.match(hunk.header)
+    if not match:
+        return [hunk]
+    old_line, new_line, section = int(match.group(1)), int(match.group(3)), match.group(5)
+
+    positions = []
+    for line in hunk.lines:
+        positions.append((old_line, new_line))
+        if line.startswith('-'):
+            old_line += 1
+        elif line.startswith('+'):
+            new_line += 1
+        elif not line.startswith(('\\', '...')):
+            old_line += 1
+            new_line += 1
+
+    keep = set()
+    for index, line in enumerate(hunk.lines):
+        if line.startswith(('+', '-')):
+            keep.update(range(index - context_lines, index + context_lines + 1))
+        elif line.startswith(('\\', '...')) and index - 1 in keep:
+            keep.add(index)
+
+    pieces, run = [], []
+    for index in range(len(hunk.lines) + 1):
+        if index < len(hunk.lines) and index in keep:
+            run.append(index)
+            continue
+        if run:
+            lines = [hunk.lines[i] for i in run]
+            old_count = sum(1 for l in lines if not l.startswith(('+', '\\', '...')))
+            new_count = sum(1 for l in lines if not l.startswith(('-', '\\', '...')))
+            old_start, new_start = positions[run[0]]
+            pieces.append(Hunk(header=f"@@ -{old_start},{old_count} +{new_start},{new_count} @@{section}", lines=lines))
+            run = []
+    return pieces or [hunk]
+
+
+def trim_file_context(file_diff: FileDiff, context_lines: int = REVIEW_MIN_CONTEXT_LINES) -> FileDiff:
+    return replace(file_diff, hunks=[piece for hunk in file_diff.hunks for piece in trim_hunk_context(hunk, context_lines)])
+
+
+# --- Budget Planning ---
+@dataclass
+class BudgetPlan:
+    """The files to review under the token budget, and what had to be left out."""
+    model: str
+    budget: int
+    files: list[FileDiff]
+    omitted: list[FileDiff] = field(default_factory=list)
+    estimated_tokens: int = 0     # Prompt tokens for the planned files, instruction included per call
+    required_tokens: int = 0      # Same estimate for the untrimmed, complete diff
+    context_trimmed: bool = False
+
+    @property
+    def fits(self) -> bool:
+        return bool(self.files)
+
+    def render_omitted(self) -> str:
+        if not self.omitted:
+            return ""
+        return (
+            f"<details><summary>Not reviewed: {len(self.omitted)} lower-priority "
+            f"file{'s' if len(self.omitted) != 1 else ''} over the token budget</summary>\n\n"
+            + '\n'.join(f"- `{f.path}` (+{f.additions}/-{f.deletions})" for f in self.omitted) + "\n</details>"
+        )
+
+
+def _prompt_tokens(diff_tokens: int, call_budget: int, instruction_tokens: int) -> int:
+    """The numbered diff plus the instruction once per expected call."""
+    calls = math.ceil(diff_tokens / call_budget) if diff_tokens else 0
+    return diff_tokens + calls * instruction_tokens
+
+
+def estimate_prompt_tokens(files: list[FileDiff], call_budget: int, instruction_tokens: int) -> int:
+    return _prompt_tokens(sum(estimate_tokens(f.render(numbered=True)) for f in files), call_budget, instruction_tokens)
+
+
+def plan_review(files: list[FileDiff], model: str, instruction: str) -> BudgetPlan:
+    """
+    Fits a PR under the per-review token budget for `model`:
+      1. the complete diff, if it fits;
+      2. otherwise the diff with context trimmed to REVIEW_MIN_CONTEXT_LINES around changes;
+      3. otherwise the highest-value files (by FILE_REVIEW_WEIGHTS, smaller first) that fit.
+    A plan with no files means not even one file fits; callers should fail fast.
+    """
+    budget = review_token_budget(model)
+    instruction_tokens = estimate_tokens(instruction)
+    call_budget = call_token_budget(model, instruction_tokens)
+
+    required = estimate_prompt_tokens(files, call_budget, instruction_tokens)
+    if required <= budget:
+        return BudgetPlan(model=model, budget=budget, files=files, estimated_tokens=required, required_tokens=required)
+
+    trimmed = [trim_file_context(f) for f in files]
+    sizes = [estimate_tokens(f.render(numbered=True)) for f in trimmed]
+    trimmed_cost = _prompt_tokens(sum(sizes), call_budget, instruction_tokens)
+    if trimmed_cost <= budget:
+        return BudgetPlan(model=model, budget=budget, files=trimmed, estimated_tokens=trimmed_cost,
+                          required_tokens=required, context_trimmed=True)
+
+    ranked = sorted(range(len(trimmed)), key=lambda i: (-file_weight(trimmed[i].path), sizes[i], trimmed[i].path))
+    kept, omitted, diff_tokens = [], [], 0
+    for index in ranked:
+        if _prompt_tokens(diff_tokens + sizes[index], call_budget, instruction_tokens) <= budget:
+            kept.append(index)
+            diff_tokens += sizes[index]
+        else:
+            omitted.append(index)
+    return BudgetPlan(
+        model=model, budget=budget,
+        files=[trimmed[i] for i in sorted(kept)], omitted=[trimmed[i] for i in sorted(omitted)],
+        estimated_tokens=_prompt_tokens(diff_tokens, call_budget, instruction_tokens),
+        required_tokens=required, context_trimmed=True
+    )
+
+
+# --- Usage Tracking ---
+class TokenUsage:
+    """Estimated vs reported tokens for one review, accumulated across its concurrent model calls."""
+
+    def __init__(self):
+        self.estimated_in = 0
+        self.actual_in = 0
+        self.actual_out = 0
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def add_estimate(self, tokens: int):
+        with self._lock:
+            self.estimated_in += tokens
+            self.calls += 1
+
+    def add_actual(self, tokens_in: int, tokens_out: int):
+        with self._lock:
+            self.actual_in += tokens_in
+            self.actual_out += tokens_out
@@ -0,0 +1,278 @@
+# tracing.py
+import os
+import json
+import time
+import uuid
+import atexit
+import hashlib
+import logging
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+# --- Configuration ---
+# Comma-separated: none (default), memory, file, otlp
+TRACE_EXPORTER = os.environ.get('TRACE_EXPORTER', 'none')
+TRACE_FILE = os.environ.get('TRACE_FILE', '/tmp/prreviewbot-traces.jsonl')
+TRACE_MEMORY_MAX_SPANS = int(os.environ.get('TRACE_MEMORY_MAX_SPANS', '10000'))
+# OTLP/HTTP JSON endpoint of a collector, e.g. http://otel-collector:4318/v1/traces
+TRACE_OTLP_ENDPOINT = os.environ.get('OTEL_EXPORTER_OTLP_TRACES_ENDPOINT', 'http://localhost:4318/v1/traces')
+TRACE_SERVICE_NAME = os.environ.get('OTEL_SERVICE_NAME', 'prreviewbot')
+TRACE_MAX_EVENTS_PER_SPAN = 128
+
+
+# --- Spans ---
+@dataclass
+class Span:
+    """One timed operation. Ids are hex strings in the W3C/OpenTelemetry format (32 and 16 characters)."""
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: str | None
+    start_ns: int
+    end_ns: int | None = None
+    attributes: dict = field(default_factory=dict)
+    events: list = field(default_factory=list)
+    error: str | None = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def event(self, name: str, **attributes):
+        """Records a point in time inside the span (e.g. one model stream event)."""
+        if len(self.events) < TRACE_MAX_EVENTS_PER_SPAN:
+            self.events.append({'name': name, 'time_ns': time.time_ns(), 'attributes': attributes})
+
+    @property
+    def duration(self) -> float | None:
+        return (self.end_ns - self.start_ns) / 1e9 if self.end_ns is not None else None
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name, 'trace_id': self.trace_id, 'span_id': self.span_id, 'parent_id': self.parent_id,
+            'start_ns': self.start_ns, 'end_ns': self.end_ns, 'duration_s': self.duration,
+            'attributes': self.attributes, 'events': self.events, 'error': self.error, 'pid': os.getpid(),
+        }
+
+
+_current: contextvars.ContextVar[Span | None] = contextvars.ContextVar('current_span', default=None)
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex
+
+
+def trace_id_from_delivery(delivery_id: str | None) -> str:
+    """Gitea delivery ids are UUIDs, which are valid trace ids as-is; anything else is hashed."""
+    if not delivery_id:
+        return new_trace_id()
+    try:
+        return uuid.UUID(delivery_id).hex
+    except ValueError:
+        return hashlib.sha256(delivery_id.encode('utf-8')).hexdigest()[:32]
+
+
+def current() -> Span | None:
+    return _current.get()
+
+
+def context() -> dict | None:
+    """The current trace position, serializable into a job payload (see `span(parent=...)`)."""
+    active = _current.get()
+    return {'trace_id': active.trace_id, 'parent_id': active.span_id} if active else None
+
+
+@contextmanager
+def span(name: str, trace_id: str | None = None, parent: dict | None = None, **attributes):
+    """
+    Times the enclosed block as a child of the current span. A new trace starts
+    when there is no current span, using `trace_id` or the trace position in
+    `parent` (from `context()`, e.g. carried across the job queue) when given.
+    Exceptions mark the span as failed and propagate.
+    """
+    active = _current.get()
+    if parent:
+        trace_id, parent_id = parent.get('trace_id'), parent.get('parent_id')
+    elif active is not None:
+        trace_id, parent_id = active.trace_id, active.span_id
+    else:
+        parent_id = None
+    opened = Span(name=name, trace_id=trace_id or new_trace_id(), span_id=uuid.uuid4().hex[:16],
+                  parent_id=parent_id, start_ns=time.time_ns(), attributes=attributes)
+    token = _current.set(opened)
+    try:
+        yield opened
+    except BaseException as e:
+        opened.error = f"{type(e).__name__}: {e}"[:500]
+        raise
+    finally:
+        _current.reset(token)
+        opened.end_ns = time.time_ns()
+        _export(opened)
+
+
+def record(name: str, start: float, end: float, parent: dict | None = None, **attributes):
+    """Exports a span for an interval measured elsewhere (epoch seconds), e.g. time spent in the queue."""
+    active = _current.get()
+    position = parent or ({'trace_id': active.trace_id, 'parent_id': active.span_id} if active else {})
+    _export(Span(name=name, trace_id=position.get('trace_id') or new_trace_id(), span_id=uuid.uuid4().hex[:16],
+                 parent_id=position.get('parent_id'), start_ns=int(start * 1e9), end_ns=int(end * 1e9),
+                 attributes=attributes))
+
+
+def wrap(fn):
+    """Binds `fn` to the caller's trace context, for running it on another thread (executors)."""
+    ctx = contextvars.copy_context()
+    return lambda *args, **kwargs: ctx.run(fn, *args, **kwargs)
+
+
+async def bind(coro, active: Span | None):
+    """Runs `coro` with `active` as its current span (coroutines submitted to another event loop)."""
+    token = _current.set(active)
+    try:
+        return await coro
+    finally:
+        _current.reset(token)
+
+
+# --- Exporters ---
+class InMemoryExporter:
+    """Keeps the most recent spans in memory (tests, local profiling)."""
+
+    def __init__(self, max_spans: int = TRACE_MEMORY_MAX_SPANS):
+        self._spans = deque(maxlen=max_spans)
+
+    def export(self, finished: Span):
+        self._spans.append(finished)
+
+    def spans(self, trace_id: str | None = None) -> list[Span]:
+        return [s for s in list(self._spans) if trace_id is None or s.trace_id == trace_id]
+
+    def clear(self):
+        self._spans.clear()
+
+
+class FileExporter:
+    """Appends one JSON line per span. Each line is a single write, so worker processes can share the file."""
+
+    def __init__(self, path: str = TRACE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, finished: Span):
+        line = (json.dumps(finished.to_dict(), default=str) + '\n').encode('utf-8')
+        with self._lock:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def _otlp_attributes(attributes: dict) -> list[dict]:
+    return [{'key': key, 'value': _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+class OTLPHttpExporter:
+    """
+    Sends spans to an OpenTelemetry collector as OTLP/HTTP JSON, batched on a
+    background thread (no OpenTelemetry SDK needed). Spans are dropped, not
+    queued without bound, when the collector is unreachable.
+    """
+
+    def __init__(self, endpoint: str = TRACE_OTLP_ENDPOINT, service_name: str = TRACE_SERVICE_NAME,
+                 batch_size: int = 512, interval: float = 2.0, max_queue: int = 10000):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = deque(maxlen=max_queue)
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def export(self, finished: Span):
+        self._queue.append(finished)
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:  # Started lazily so it survives gunicorn's fork
+                    self._thread = threading.Thread(target=self._run, name='trace-exporter', daemon=True)
+                    self._thread.start()
+                    atexit.register(self.flush)
+        if len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+
+    def _payload(self, spans: list[Span]) -> dict:
+        return {'resourceSpans': [{
+            'resource': {'attributes': _otlp_attributes({'service.name': self.service_name, 'process.pid': os.getpid()})},
+            'scopeSpans': [{'scope': {'name': 'prreviewbot'}, 'spans': [{
+                'traceId': s.trace_id, 'spanId': s.span_id, 'parentSpanId': s.parent_id or '',
+                'name': s.name, 'kind': 1, 'startTimeUnixNano': str(s.start_ns), 'endTimeUnixNano': str(s.end_ns),
+                'attributes': _otlp_attributes(s.attributes),
+                'events': [{'name': e['name'], 'timeUnixNano': str(e['time_ns']), 'attributes': _otlp_attributes(e['attributes'])}
+                           for e in s.events],
+                'status': {'code': 2, 'message': s.error} if s.error else {'code': 1},
+            } for s in spans]}],
+        }]}
+
+    def flush(self):
+        import httpx  # Only needed when this exporter is used
+        while self._queue:
+            batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+            try:
+                httpx.post(self.endpoint, json=self._payload(batch), timeout=5).raise_for_status()
+            except httpx.HTTPError as e:
+                logging.warning(f"Dropped {len(batch)} spans: OTLP export to {self.endpoint} failed: {e}")
+                return
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+def create_exporters(names: str = TRACE_EXPORTER) -> list:
+    exporters = []
+    for name in (n.strip().lower() for n in names.split(',')):
+        if name in ('', 'none'):
+            continue
+        if name == 'memory':
+            exporters.append(InMemoryExporter())
+        elif name == 'file':
+            exporters.append(FileExporter())
+        elif name == 'otlp':
+            exporters.append(OTLPHttpExporter())
+        else:
+            logging.error(f"Unknown TRACE_EXPORTER '{name}'. Ignoring it.")
+    if exporters:
+        logging.info(f"Tracing enabled: {', '.join(type(e).__name__ for e in exporters)}")
+    return exporters
+
+
+exporters = create_exporters()
+
+
+def add_exporter(exporter):
+    """Registers another exporter (anything with `export(span)`)."""
+    exporters.append(exporter)
+
+
+def _export(finished: Span):
+    for exporter in exporters:
+        try:
+            exporter.export(finished)
+        except Exception as e:
+            logging.warning(f"Trace exporter {type(exporter).__name__} failed: {e}")